@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+'''
+Benchmarks for the StoryDatabase backends, all run over the same synthetic stories so their
+numbers can be compared.  Run `python benchmark.py --help` for the options.  The mongo backend
+is only benchmarked if a mongod is reachable on localhost.  The extract section compares the
+link extraction engines; the newspaper one is skipped if newspaper isn't installed.
+'''
+
+import sys, os, time, random, tempfile, shutil, copy, json, argparse, resource
+from mediacloud.storage import MongoStoryDatabase, SqliteStoryDatabase, MemoryStoryDatabase, FieldCompressionCodec
+
+BENCHMARK_DB_NAME = 'mediacloud-benchmark'
+DEFAULT_STORY_COUNT = 2000
+BACKENDS = ['memory', 'sqlite', 'sqlite+z', 'mongo']
+SECTIONS = ['core', 'codec', 'prepare', 'extract']
+
+WORDS = ['media', 'cloud', 'story', 'link', 'news', 'report', 'police', 'city', 'vote', 'court',
+         'president', 'election', 'minister', 'said', 'officials', 'market', 'health', 'school']
+
+def _sentence(word_count=20):
+    return ' '.join(random.choice(WORDS) for i in range(word_count))
+
+def fakeStory(stories_id, sentence_count=30, link_count=40, raw_html_kb=0):
+    '''
+    A synthetic story shaped like what the linker ingester saves.  The ingester drops the raw
+    html before saving, so it is only included if you ask for some with raw_html_kb.
+    '''
+    story = {
+        'stories_id': stories_id,
+        'processed_stories_id': stories_id,
+        'media_id': random.randint(1, 100),
+        'publish_date': '2015-%02d-%02d 12:00:00' % (random.randint(1, 12), random.randint(1, 28)),
+        'guid': 'http://example.com/story/%d' % stories_id,
+        'url': 'http://example.com/story/%d' % stories_id,
+        'title': _sentence(8),
+        'language': 'en',
+        'story_sentences': [ {'sentence_number': i, 'sentence': _sentence()} for i in range(sentence_count) ],
+        'story_links': [ {
+            'href': 'http://example.com/other/%d' % random.randint(1, 100000),
+            'anchor': _sentence(4),
+            'inlink': random.random() < 0.5,
+            'para': i,
+            '_raw_attrs': {'href': 'http://example.com/other/%d?ref=rss' % i, 'class': ['story-link']}
+        } for i in range(link_count) ],
+        'wordcount': sentence_count * 20,
+        'grafcount': sentence_count / 3
+    }
+    if raw_html_kb > 0:
+        paragraph = '<p>%s <a href="http://example.com/">%s</a></p>\n' % (_sentence(), _sentence(3))
+        story['raw_first_download_file'] = '<html><body>%s</body></html>' % (paragraph * (raw_html_kb*1024/len(paragraph) + 1))
+    return story
+
+def fakeArticleHtml(paragraph_count=20, link_count=40):
+    '''
+    A synthetic news article page: navigation, then a story body with the links spread over
+    its paragraphs, then a footer
+    '''
+    paragraphs = [ [_sentence(40)] for i in range(paragraph_count) ]
+    for i in range(link_count):
+        paragraphs[i % paragraph_count].append('<a href="http://example.com/other/%d?ref=story" class="story-link">%s</a> %s'
+                                               % (random.randint(1, 100000), _sentence(3), _sentence(10)))
+    return ('<html><head><title>%s</title><script>var page = 1;</script></head><body>'
+            '<ul class="nav">%s</ul><div class="story-body">%s</div><div class="footer">%s</div></body></html>') % (
+        _sentence(8),
+        ''.join('<li><a href="http://example.com/section/%d">%s</a></li>' % (i, _sentence(1)) for i in range(10)),
+        ''.join('<p>%s</p>' % ' '.join(p) for p in paragraphs),
+        _sentence(12))
+
+def fakeStorySentences(stories_id, sentence_count=30):
+    '''
+    Sentences shaped like the ones MediaCloud.sentenceList returns, for addStoryFromSentences
+    '''
+    return [ {
+        'stories_id': stories_id,
+        'story_sentences_id': str(stories_id*1000 + i),
+        'sentence_number': i,
+        'sentence': _sentence(),
+        'media_id': 1,
+        'publish_date': '2015-01-01T00:00:00Z',
+        'language': 'en'
+    } for i in range(sentence_count) ]
+
+def _timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def _latencies(fn, args):
+    timings = []
+    for arg in args:
+        start = time.time()
+        fn(arg)
+        timings.append(time.time() - start)
+    return sorted(timings)
+
+def _percentileMs(sorted_timings, pct):
+    return sorted_timings[min(len(sorted_timings)-1, int(len(sorted_timings)*pct/100.0))] * 1000
+
+def _rssMb():
+    # current resident memory on linux, the peak so far anywhere else
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1048576.0
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _commit(db):
+    if hasattr(db, 'commit'):
+        db.commit()
+
+def benchmarkDb(db, stories, bulk_size=500):
+    '''
+    Run the core benchmarks against an empty database and return the results.  Half the stories
+    are written one at a time with addStory and the other half in bulk with addStories.
+    '''
+    results = {}
+    half = len(stories) / 2
+    db.createDatabase(BENCHMARK_DB_NAME)
+    db.deleteDatabase(BENCHMARK_DB_NAME)
+    add_time, ignored = _timed(lambda: [db.addStory(s) for s in stories[:half]])
+    _commit(db)
+    results['add_per_sec'] = half / add_time
+    bulk_time, ignored = _timed(lambda: [db.addStories(stories[i:i+bulk_size]) for i in range(half, len(stories), bulk_size)])
+    _commit(db)
+    results['bulk_add_per_sec'] = (len(stories)-half) / bulk_time
+    sentence_lists = [ fakeStorySentences(len(stories)+i+1) for i in range(max(1, len(stories)/10)) ]
+    sentences_time, ignored = _timed(lambda: [db.addStoryFromSentences(s) for s in sentence_lists])
+    _commit(db)
+    results['from_sentences_per_sec'] = len(sentence_lists) / sentences_time
+    ids = [ s['stories_id'] for s in stories ]
+    random.shuffle(ids)
+    timings = _latencies(db.getStory, ids)
+    for pct in [50, 95, 99]:
+        results['get_p%d_ms' % pct] = _percentileMs(timings, pct)
+    results['max_id_p50_ms'] = _percentileMs(_latencies(lambda i: db.getMaxStoryId(), range(100)), 50)
+    results['count_p50_ms'] = _percentileMs(_latencies(lambda i: db.storyCount(), range(100)), 50)
+    results['count_estimated_p50_ms'] = _percentileMs(_latencies(lambda i: db.storyCount(exact=False), range(100)), 50)
+    rss_before = peak_rss = _rssMb()
+    start = time.time()
+    scanned = 0
+    for story in db.scanStories(batch_size=bulk_size):
+        scanned += 1
+        if scanned % bulk_size == 0:
+            peak_rss = max(peak_rss, _rssMb())
+    results['scan_per_sec'] = scanned / (time.time()-start)
+    results['scan_rss_growth_mb'] = max(peak_rss, _rssMb()) - rss_before
+    db.deleteDatabase(BENCHMARK_DB_NAME)
+    return results
+
+CORE_COLUMNS = [    # result, heading, format
+    ('add_per_sec', 'add/s', '%9.0f'),
+    ('bulk_add_per_sec', 'bulk/s', '%9.0f'),
+    ('from_sentences_per_sec', 'sents/s', '%9.0f'),
+    ('get_p50_ms', 'get p50', '%9.3f'),
+    ('get_p95_ms', 'get p95', '%9.3f'),
+    ('get_p99_ms', 'get p99', '%9.3f'),
+    ('max_id_p50_ms', 'maxid ms', '%9.3f'),
+    ('count_p50_ms', 'count ms', '%9.3f'),
+    ('count_estimated_p50_ms', 'est count', '%10.3f'),
+    ('scan_per_sec', 'scan/s', '%9.0f'),
+    ('scan_rss_growth_mb', 'scan MB', '%9.1f'),
+]
+
+def printCoreResults(results):
+    print '%-9s' % 'backend' + ''.join('%*s' % (len(fmt % 0), heading) for ignored, heading, fmt in CORE_COLUMNS)
+    for label, r in results:
+        print '%-9s' % label + ''.join(fmt % r[key] for key, ignored, fmt in CORE_COLUMNS)
+
+def benchmarkCodec(stories, db_dir):
+    '''
+    Compare a sqlite database with and without the heavy fields compressed: size on disk, and
+    full scans that read only light fields vs. the sentences too
+    '''
+    results = []
+    for label, codec in [('sqlite', None), ('sqlite+z', FieldCompressionCodec())]:
+        db_name = BENCHMARK_DB_NAME + ('-codec' if codec else '')
+        db = SqliteStoryDatabase(db_name, db_dir=db_dir)
+        db.setCodec(codec)
+        db.addStories(stories)
+        db.close()
+        db = SqliteStoryDatabase(db_name, db_dir=db_dir)
+        db.setCodec(codec)
+        light_time, ignored = _timed(lambda: [s['title'] for s in db.scanStories()])
+        full_time, ignored = _timed(lambda: [s['story_sentences'] for s in db.scanStories()])
+        results.append( (label, {
+            'size_mb': os.path.getsize(os.path.join(db_dir, db_name+'.sqlite')) / 1048576.0,
+            'ratio': codec.compressionRatio() if codec else 1.0,
+            'title_scan_per_sec': len(stories) / light_time,
+            'sentence_scan_per_sec': len(stories) / full_time
+        }) )
+        db.close()
+    return results
+
+def printCodecResults(results):
+    for label, r in results:
+        print '%-9s %6.1fMB on disk (ratio %4.1fx)   title scan %8.0f/sec   sentence scan %8.0f/sec' % (
+            label, r['size_mb'], r['ratio'], r['title_scan_per_sec'], r['sentence_scan_per_sec'])
+
+def _deepCopyPrepare(story, extra_attributes):
+    # how StoryDatabase used to prepare every story before saving it
+    story_to_save = copy.deepcopy( story )
+    story_to_save = dict(story_to_save.items() + extra_attributes.items())
+    story_to_save['_stories_id'] = story['stories_id']
+    if 'story_sentences' in story:
+        story_to_save['story_sentences_count'] = len(story['story_sentences'])
+    return story_to_save
+
+def _newContainers(story_to_save, story):
+    '''
+    Count the dicts and lists in story_to_save that weren't already in the caller's story, and
+    how many bytes they take up
+    '''
+    def containers(obj, found):
+        if isinstance(obj, (dict, list)) and id(obj) not in found:
+            found[id(obj)] = sys.getsizeof(obj)
+            for child in (obj.itervalues() if isinstance(obj, dict) else obj):
+                containers(child, found)
+        return found
+    existing = containers(story, {})
+    new = dict( (k, v) for k, v in containers(story_to_save, {}).iteritems() if k not in existing )
+    return len(new), sum(new.values())
+
+def benchmarkStoryPreparation(stories):
+    '''
+    Compare the old deepcopy-based save preparation with the current shallow overlay
+    '''
+    extra_attributes = {'wordcount': 500, 'grafcount': 10}
+    db = MemoryStoryDatabase()
+    results = []
+    for label, prepare in [('deepcopy', _deepCopyPrepare), ('overlay', db._prepareNewStory)]:
+        prep_time, prepared = _timed(lambda: [prepare(s, extra_attributes) for s in stories])
+        counts = [ _newContainers(story_to_save, story) for story_to_save, story in zip(prepared, stories) ]
+        results.append( (label, {
+            'prepare_us': prep_time*1000000/len(stories),
+            'new_containers': sum(c[0] for c in counts)/float(len(counts)),
+            'new_bytes': sum(c[1] for c in counts)/float(len(counts))
+        }) )
+    return results
+
+def printPreparationResults(results):
+    for label, r in results:
+        print '%-9s prepare %8.1fus/story   %6.1f new containers/story   %8.0f new bytes/story' % (
+            label, r['prepare_us'], r['new_containers'], r['new_bytes'])
+
+def benchmarkExtraction(article_count, link_count):
+    '''
+    Compare newspaper's link extraction with the lxml engine over the same articles
+    '''
+    from linker.extractor import ENGINES
+    articles = [ fakeArticleHtml(link_count=link_count) for i in range(article_count) ]
+    results = []
+    for label in sorted(ENGINES):
+        engine = ENGINES[label]
+        try:
+            engine('http://example.com/story/0', html=articles[0], source_url='http://example.com')
+        except ImportError as e:
+            sys.stderr.write('%s skipped (%s)\n' % (label, e))
+            continue
+        extract_time, extracted = _timed(lambda: [engine('http://example.com/story/%d' % i, html=html, source_url='http://example.com').extract()
+                                                  for i, html in enumerate(articles)])
+        results.append( (label, {
+            'articles_per_sec': article_count / extract_time,
+            'links': sum(len(data['story_links']) for data in extracted)
+        }) )
+    return results
+
+def printExtractionResults(results):
+    for label, r in results:
+        print '%-9s extract %8.1f articles/sec   %8d links' % (label, r['articles_per_sec'], r['links'])
+
+def _openDb(backend, db_dir):
+    if backend == 'memory':
+        return MemoryStoryDatabase()
+    if backend in ['sqlite', 'sqlite+z']:
+        db = SqliteStoryDatabase(db_dir=db_dir)
+        if backend == 'sqlite+z':
+            db.setCodec(FieldCompressionCodec())
+        return db
+    if backend == 'mongo':
+        return MongoStoryDatabase()
+    raise ValueError('Unknown backend %s (pick from %s)' % (backend, ', '.join(BACKENDS)))
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark the StoryDatabase backends')
+    parser.add_argument('story_count', nargs='?', type=int, default=DEFAULT_STORY_COUNT)
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated, from '+', '.join(BACKENDS))
+    parser.add_argument('--sections', default=','.join(SECTIONS), help='comma separated, from '+', '.join(SECTIONS))
+    parser.add_argument('--sentences', type=int, default=30, help='sentences per story')
+    parser.add_argument('--links', type=int, default=40, help='links per story')
+    parser.add_argument('--raw-html-kb', type=int, default=0, help='size of the raw html to save with each story')
+    parser.add_argument('--json', action='store_true', help='print the results as json instead of tables')
+    options = parser.parse_args(args)
+    random.seed(0)  # the same stories every run
+    stories = [ fakeStory(i+1, options.sentences, options.links, options.raw_html_kb) for i in range(options.story_count) ]
+    sections = options.sections.split(',')
+    output = { 'story_count': options.story_count }
+    db_dir = tempfile.mkdtemp()
+    try:
+        if 'core' in sections:
+            output['core'] = []
+            for backend in options.backends.split(','):
+                try:
+                    db = _openDb(backend, db_dir)
+                except ValueError:
+                    raise
+                except Exception as e:
+                    sys.stderr.write('%s skipped (%s)\n' % (backend, e))
+                    continue
+                output['core'].append( (backend, benchmarkDb(db, stories)) )
+        if 'codec' in sections:
+            output['codec'] = benchmarkCodec(stories, db_dir)
+        if 'prepare' in sections:
+            output['prepare'] = benchmarkStoryPreparation(stories)
+        if 'extract' in sections:
+            output['extract'] = benchmarkExtraction(min(options.story_count, 200), options.links)
+    finally:
+        shutil.rmtree(db_dir)
+    if options.json:
+        print json.dumps(output, indent=2, sort_keys=True)
+        return
+    print 'Benchmarked with %d stories' % options.story_count
+    if 'core' in output:
+        printCoreResults(output['core'])
+    if 'codec' in output:
+        printCodecResults(output['codec'])
+    if 'prepare' in output:
+        printPreparationResults(output['prepare'])
+    if 'extract' in output:
+        printExtractionResults(output['extract'])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
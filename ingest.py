@@ -1,8 +1,12 @@
+import os
 import sys
 import csv
 import re
+import itertools
+import logging
 from datetime import date
 from linker.ingester import MediaCloudIngester, LinkSpider
+from linker.cache import ExtractionCache
 from linker.querier import CustomStoryDatabase, CsvQuerier
 
 DB_NAME = 'mclinksspider'
@@ -11,30 +15,51 @@ END = date(2015,5,1)
 #MEDIA_ID = 1751
 MEDIA_ID = 104828
 MEDIA_SET_ID = None
-LAST_ID = 352446818
+LAST_ID = 352446818     # only used the first time, after that the job resumes from its checkpoint
+WORKERS = 4     # processes extracting links
+CHECKPOINT_DIR = 'checkpoints'
+WINDOW_DAYS = 7     # ingest the date range a week at a time
+CONCURRENT_WINDOWS = 4
+SKIP_EXISTING = True    # don't download raw html again for stories we already have
+ENGINE = 'newspaper'    # or 'lxml', which is much faster but doesn't clean up the article like newspaper does
+EXTRACTION_CACHE = os.path.join(CHECKPOINT_DIR, 'extraction_cache.sqlite')    # or None to parse every story
+LOG_LEVEL = logging.INFO    # DEBUG logs every story saved, which slows big ingests down
 #LAST_ID = 167885185
 
 
 def ingest():
-    m = MediaCloudIngester(db_name=DB_NAME)
-    m.time_series_ingest(START,END,
-        media_id=MEDIA_ID,
-        media_set_id=MEDIA_SET_ID,
-        last_id=LAST_ID)
+    cache = ExtractionCache(EXTRACTION_CACHE) if EXTRACTION_CACHE else None
+    m = MediaCloudIngester(db_name=DB_NAME, workers=WORKERS, checkpoint_dir=CHECKPOINT_DIR,
+        skip_existing=SKIP_EXISTING, log_level=LOG_LEVEL, engine=ENGINE, extraction_cache=cache)
+    try:
+        m.time_series_ingest(START,END,
+            media_id=MEDIA_ID,
+            media_set_id=MEDIA_SET_ID,
+            last_id=LAST_ID,
+            window_days=WINDOW_DAYS,
+            concurrent_windows=CONCURRENT_WINDOWS)
+    finally:
+        m.close()
+        if cache is not None:
+            cache.close()
 
 def spider(url):
-    return LinkSpider(DB_NAME).spider_from(url)
+    return LinkSpider(DB_NAME, engine=ENGINE, workers=WORKERS).spider_from(url)
 
 def _writeToCsv(rows, outfile='out/outfile.csv'):
-    if not rows:
+    # rows can be a list or a stream, so peek at the first one for the headers
+    rows = iter(rows)
+    try:
+        first_row = next(rows)
+    except StopIteration:
         return None
     with open(outfile, 'w+') as f:
-        if isinstance(rows[0], dict):
-            writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        if isinstance(first_row, dict):
+            writer = csv.DictWriter(f, fieldnames=first_row.keys())
             writer.writeheader()
         else:
             writer = csv.writer(f)
-        for row in rows:
+        for row in itertools.chain([first_row], rows):
             try:
                 writer.writerow(row)
             except UnicodeEncodeError:
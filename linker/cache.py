@@ -0,0 +1,127 @@
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+import collections
+
+class ExtractionCache(object):
+	"""
+	Remembers link extraction results by a hash of the html they came from plus whatever else
+	the result depends on (extractor, its version, urls, options), so a page that hasn't
+	changed is never parsed twice.  Results are kept as json in memory, least recently used
+	first out once they take up more than memory_bytes, and zlib'd in a sqlite file, oldest
+	first out once it holds more than disk_bytes.  Safe to share between threads.
+
+	:param path: sqlite file for the disk cache, or None to only cache in memory
+	:param memory_bytes: most json to keep in memory
+	:param disk_bytes: most compressed json to keep on disk
+	"""
+
+	def __init__(self, path=None, memory_bytes=64*1024*1024, disk_bytes=1024*1024*1024):
+		self.path = path
+		self.memory_bytes = memory_bytes
+		self.disk_bytes = disk_bytes
+		self._memory = collections.OrderedDict()
+		self._memory_used = 0
+		self._lock = threading.Lock()
+		self._counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+		self._conn = None
+		if path is not None:
+			if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+			self._conn.execute('PRAGMA journal_mode=WAL')
+			self._conn.execute('PRAGMA synchronous=NORMAL')
+			self._conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data BLOB, size INTEGER)')
+			self._conn.commit()
+			self._disk_used = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+	@staticmethod
+	def key(html, *options):
+		"""
+		The cache key for a result extracted from html with the given options, which must
+		include everything else the result depends on.
+		"""
+		if isinstance(html, unicode):
+			html = html.encode('utf-8')
+		digest = hashlib.sha1(html)
+		digest.update('\0' + json.dumps(options))
+		return digest.hexdigest()
+
+	def get(self, key):
+		"""Returns the result cached under key, or None."""
+		with self._lock:
+			raw = self._memory.pop(key, None)
+			if raw is not None:
+				self._memory[key] = raw    # now the most recently used
+				self._counts['memory_hits'] += 1
+				return json.loads(raw)
+			row = None
+			if self._conn is not None:
+				row = self._conn.execute('SELECT data FROM results WHERE key=?', (key,)).fetchone()
+			if row is None:
+				self._counts['misses'] += 1
+				return None
+			self._counts['disk_hits'] += 1
+			raw = zlib.decompress(str(row[0]))
+			self._remember(key, raw)
+			return json.loads(raw)
+
+	def put(self, key, result):
+		raw = json.dumps(result)
+		with self._lock:
+			self._remember(key, raw)
+			if self._conn is not None:
+				data = zlib.compress(raw)
+				cursor = self._conn.execute('INSERT OR IGNORE INTO results (key, data, size) VALUES (?, ?, ?)',
+					(key, sqlite3.Binary(data), len(data)))
+				if cursor.rowcount > 0:
+					self._disk_used += len(data)
+					if self._disk_used > self.disk_bytes:
+						self._trimDisk()
+				self._conn.commit()
+
+	def _remember(self, key, raw):
+		old = self._memory.pop(key, None)
+		if old is not None:
+			self._memory_used -= len(old)
+		self._memory[key] = raw
+		self._memory_used += len(raw)
+		while self._memory_used > self.memory_bytes and self._memory:
+			self._memory_used -= len(self._memory.popitem(last=False)[1])
+
+	def _trimDisk(self):
+		# other processes may be writing to the same file, so recount before throwing anything out
+		self._disk_used = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+		excess = self._disk_used - self.disk_bytes
+		if excess <= 0:
+			return
+		last_rowid = None
+		for rowid, size in self._conn.execute('SELECT rowid, size FROM results ORDER BY rowid'):
+			last_rowid = rowid
+			excess -= size
+			self._disk_used -= size
+			if excess <= 0:
+				break
+		self._conn.execute('DELETE FROM results WHERE rowid <= ?', (last_rowid,))
+
+	def stats(self):
+		with self._lock:
+			lookups = sum(self._counts.values())
+			stats = dict(self._counts)
+			stats.update({
+				'lookups': lookups,
+				'hit_rate': float(lookups - self._counts['misses']) / lookups if lookups else 0.0,
+				'memory_entries': len(self._memory),
+				'memory_bytes': self._memory_used,
+				'disk_bytes': self._disk_used if self._conn is not None else 0
+			})
+			return stats
+
+	def close(self):
+		with self._lock:
+			if self._conn is not None:
+				self._conn.close()
+				self._conn = None
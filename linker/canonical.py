@@ -0,0 +1,94 @@
+import struct
+import hashlib
+from urlparse import urlsplit, urlunsplit
+
+# urls containing these are left exactly as they are, because their query string is what
+# identifies the page
+EXEMPT_URLS = ('on.nytimes.com/public/overview', 'query.nytimes.com')
+
+# query parameters that only say where a click came from
+TRACKING_PARAMS = ('ref', 'src', 'smid', 'smtyp', 'partner', 'hp', 'mod', 'mc', 'emc', 'mtrref',
+	'_r', 'rss', 'fbclid', 'gclid', 'cmp', 'ito', 'wt.mc_id', 'ncid', 'ocid', 'ftag', 'intcmp')
+TRACKING_PARAM_PREFIXES = ('utm_', 'pk_')
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+class UrlCanonicalizer(object):
+	"""
+	Rewrites urls into one canonical form, so that the same page linked in different ways
+	gets the same url, and fingerprints them into compact fixed-size keys.
+
+	:param scheme: scheme to give http, https and scheme-relative (//) urls, or None to leave it
+	:param lowercase_host: lowercase the host and drop default ports
+	:param strip_query: drop the whole query string, as the extractor always has
+	:param tracking_params: query parameters to drop when the rest of the query is kept;
+		anything starting with one of TRACKING_PARAM_PREFIXES is dropped too
+	:param strip_fragment: drop the #fragment
+	:param strip_all_suffix: turn the /all/ (single page) version of a url into the plain one
+	:param strip_trailing_slash: drop the slash at the end of a path, other than the root
+	:param exempt: urls containing any of these are left exactly as they are
+	"""
+
+	def __init__(self, scheme='http', lowercase_host=True, strip_query=True, tracking_params=TRACKING_PARAMS,
+			strip_fragment=True, strip_all_suffix=True, strip_trailing_slash=True, exempt=EXEMPT_URLS):
+		self.scheme = scheme
+		self.lowercase_host = lowercase_host
+		self.strip_query = strip_query
+		self.tracking_params = frozenset(p.lower() for p in tracking_params)
+		self.strip_fragment = strip_fragment
+		self.strip_all_suffix = strip_all_suffix
+		self.strip_trailing_slash = strip_trailing_slash
+		self.exempt = tuple(e.lower() for e in exempt)
+
+	def canonicalize(self, url):
+		if self.exempt and any(e in url.lower() for e in self.exempt):
+			return url
+		try:
+			scheme, netloc, path, query, fragment = urlsplit(url)
+		except ValueError:
+			return url    # too broken to take apart, e.g. an unclosed [ in the host
+		if netloc:
+			if self.lowercase_host:
+				netloc = netloc.lower()
+				port = DEFAULT_PORTS.get(scheme)
+				if port and netloc.endswith(port):
+					netloc = netloc[:-len(port)]
+			if self.scheme is not None and scheme in ('', 'http', 'https'):
+				scheme = self.scheme
+		if self.strip_all_suffix and path.endswith('/all/'):
+			path = path[:-4]
+		if self.strip_trailing_slash and len(path) > 1 and path.endswith('/'):
+			path = path.rstrip('/') or '/'
+		elif netloc and self.strip_trailing_slash and not path:
+			path = '/'
+		if self.strip_query:
+			query = ''
+		elif query:
+			query = '&'.join(param for param in query.split('&') if not self._isTracking(param))
+		if self.strip_fragment:
+			fragment = ''
+		return urlunsplit((scheme, netloc, path, query, fragment))
+
+	def _isTracking(self, param):
+		name = param.split('=', 1)[0].lower()
+		return name in self.tracking_params or name.startswith(TRACKING_PARAM_PREFIXES)
+
+	def fingerprint(self, url):
+		"""
+		A signed 64 bit integer identifying the canonical form of the url.  Cheaper to keep in
+		sets and indexes than the url itself, and fits in a mongo long.
+		"""
+		canonical = self.canonicalize(url)
+		if isinstance(canonical, unicode):
+			canonical = canonical.encode('utf-8')
+		return struct.unpack('>q', hashlib.md5(canonical).digest()[:8])[0]
+
+# the rules for comparing and deduplicating urls (graph nodes, spider fingerprints); the query
+# is kept, less its tracking parameters, since on many sites (ie. ?p=123) it names the page
+DEFAULT_CANONICALIZER = UrlCanonicalizer(strip_query=False)
+
+def canonicalize(url):
+	return DEFAULT_CANONICALIZER.canonicalize(url)
+
+def fingerprint(url):
+	return DEFAULT_CANONICALIZER.fingerprint(url)
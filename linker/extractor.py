@@ -1,7 +1,17 @@
 from urlparse import urlparse
+import re
+import threading
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+from datetime import datetime
 import tldextract
-from newspaper import Article
+import requests
+import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
+from canonical import EXEMPT_URLS
 
 DEFAULT_CONTENT_NODE_TYPES = ['p']
 
@@ -13,32 +23,127 @@ def content_nodes(elem, node_types=None):
 def is_valid_weblink(attr):
 	return attr and not attr.startswith('mailto:')
 
+def is_absolute(url):
+	"""Relative links are always inlinks, so only absolute ones need their domain checked."""
+	return url.startswith('http') or url.startswith('//')
+
 def is_inlink(target_url, src_urls):
 	"""Checks the target_url domain against all possible src_urls, and returns true if there are any domain matches."""
 	if not isinstance(src_urls, list):
 		src_urls = [src_urls]
-	if target_url.startswith('http') or target_url.startswith('//'):
-		target_url_domain = get_domain(target_url)
-		source_url_domains = map(lambda u: get_domain(u), src_urls)
-		if not any(target_url_domain == d for d in source_url_domains):
-			return False
+	if is_absolute(target_url):
+		return get_domain(target_url) in source_domains(src_urls)
 	return True
 
 def strip_args(url):
-    """ Accepts URL as a string and strips arguments, avoiding flags """
-    FLAGS = ['on.nytimes.com/public/overview', 'query.nytimes.com']
-    
-    if not any(flag in url.lower() for flag in FLAGS):
-        for i in range(len(url)):
-            if url[i] == "?" or url[i] == "#":
-                url_str = url[:i]
-                if url_str.endswith('/all/'):
-                    url_str = url_str[:-4]
-                return url_str
-    return url
+	""" Accepts URL as a string and strips arguments, avoiding flags """
+	# extracted hrefs are cut at the first ? or # (and lose an /all/ suffix only then), but
+	# otherwise stay exactly as written, so they match the ones already stored
+	if any(flag in url.lower() for flag in EXEMPT_URLS):
+		return url
+	args = re.search('[?#]', url)
+	if args is None:
+		return url
+	url = url[:args.start()]
+	if url.endswith('/all/'):
+		url = url[:-4]
+	return url
+
+# the host part of a url, which is all tldextract looks at
+HOST_PATTERN = re.compile(r'^(?:[A-Za-z][A-Za-z0-9+.-]*:)?//([^/?#]*)')
+
+class DomainResolver(object):
+	"""
+	Works out the registered domain of urls with tldextract, remembering the answer for the
+	maxsize most recently used hosts.  Urls are cached by host, so every link to a popular
+	site costs a dictionary lookup after the first.  Safe to share between threads.
+
+	:param maxsize: most hosts to remember
+	"""
+
+	def __init__(self, maxsize=10000):
+		self.maxsize = maxsize
+		self._domains = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def domain(self, url):
+		match = HOST_PATTERN.match(url)
+		key = match.group(1) if match else url
+		with self._lock:
+			domain = self._domains.pop(key, None)
+			if domain is not None:
+				self.hits += 1
+				self._domains[key] = domain    # now the most recently used
+				return domain
+			self.misses += 1
+		domain = tldextract.extract(key).domain
+		with self._lock:
+			self._domains[key] = domain
+			while len(self._domains) > self.maxsize:
+				self._domains.popitem(last=False)
+		return domain
+
+	def domains(self, urls):
+		"""Resolves a batch of urls at once, returning a dict of url to domain."""
+		resolved = {}
+		for url in urls:
+			if url not in resolved:
+				resolved[url] = self.domain(url)
+		return resolved
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'hosts': len(self._domains),
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': float(self.hits) / lookups if lookups else 0.0
+			}
+
+	def clear(self):
+		with self._lock:
+			self._domains.clear()
+			self.hits = 0
+			self.misses = 0
+
+# every extractor in a process shares one resolver
+DOMAINS = DomainResolver()
 
 def get_domain(url):
-	return tldextract.extract(url).domain
+	return DOMAINS.domain(url)
+
+def source_domains(src_urls):
+	"""The domains an article counts as its own, from its url, canonical link and publication url."""
+	return frozenset(DOMAINS.domains(u for u in src_urls if u is not None).itervalues())
+
+def link_data(href, anchor, attrs, para, inlink):
+	"""The story_links entry for one <a> tag, as every extraction engine reports it."""
+	link = strip_args(href)
+	if link.startswith('//'):
+		link = 'http:' + link
+	return {
+		'href': link,
+		'anchor': anchor,
+		'inlink': inlink,
+		'para': para,
+		'_raw_attrs': attrs
+	}
+
+def story_links(anchors, src_urls):
+	"""
+	Builds the story_links of an article from its anchors, given as (href, anchor text,
+	attributes, paragraph number) tuples.  The article's own domains are worked out once, and
+	the domains of all its absolute links are resolved in one batch.
+
+	:param src_urls: urls of the article and its publication, for inlink checking
+	"""
+	sources = source_domains(src_urls)
+	domains = DOMAINS.domains(href for href, anchor, attrs, para in anchors if is_absolute(href))
+	return [link_data(href, anchor, attrs, para, href not in domains or domains[href] in sources)
+		for href, anchor, attrs, para in anchors]
 
 class LinkExtractor:
 	"""
@@ -47,39 +152,47 @@ class LinkExtractor:
 	:param url: URL of article (can be none)
 	:param html: html of article (if provided, it won't use the URL param)
 	:param source_url: url of the article's publication, for inlink checking
+	:param config: newspaper configuration from make_config(), to share between articles
 	"""
 
-	def __init__(self, url, html=None, source_url=u''):
-		article = Article(url, language='en', keep_article_html=True)
+	# bump when the output changes, so cached results from the old version aren't used
+	VERSION = 1
+
+	def __init__(self, url, html=None, source_url=u'', config=None):
+		# newspaper is only imported when it's used, so the lxml engine works without it
+		from newspaper import Article
+		if config is None:
+			article = Article(url, language='en', keep_article_html=True)
+		else:
+			article = Article(url, config=config)
 		article.download(html=html)
 		article.parse()
 		self.extractor = article
 		self.source_url = source_url
 
+	@staticmethod
+	def make_config():
+		from newspaper import Config
+		config = Config()
+		config.language = 'en'
+		config.keep_article_html = True
+		return config
+
 	def article_soup(self):
 		soup = BeautifulSoup(self.extractor.article_html)
 		return soup
 
 	def extract(self, get_meta=False):
-		links = []
+		anchors = []
 		article_soup = self.article_soup()
 		all_nodes = content_nodes(article_soup) or [article_soup]
 		wordcount = 0
 		for i, n in enumerate(all_nodes):
 			wordcount += len(n.text.split())
 			for a in n.find_all('a', href=is_valid_weblink):
-				link = strip_args(a['href'])
-				if link.startswith('//'):
-					link = 'http:' + link
-				links.append({
-					'href': link,
-					'anchor': a.get_text(),
-					'inlink': is_inlink(a['href'], [self.extractor.url, self.extractor.canonical_link, self.source_url]),
-					'para': i+1,
-					'_raw_attrs': a.attrs
-				})
+				anchors.append((a['href'], a.get_text(), a.attrs, i+1))
 		data = {
-			'story_links': links,
+			'story_links': story_links(anchors, [self.extractor.url, self.extractor.canonical_link, self.source_url]),
 			'wordcount': wordcount,
 			'grafcount': len(all_nodes)
 		}
@@ -95,3 +208,296 @@ class LinkExtractor:
 				'url': self.extractor.url
 				})
 		return data
+
+# elements whose text is never part of an article
+NON_CONTENT_TAGS = ['script', 'style', 'noscript', 'iframe', 'form']
+# elements the content region is scored on, as newspaper does
+SCORED_TAGS = ('p', 'pre', 'td')
+# attributes BeautifulSoup splits into lists of words on an <a> tag
+MULTI_VALUED_ATTRS = ('class', 'rel', 'rev', 'accesskey', 'dropzone')
+
+_parsers = threading.local()
+
+def _html_parser():
+	# lxml parsers can't be shared between threads, so each thread gets its own
+	if not hasattr(_parsers, 'parser'):
+		_parsers.parser = lxml.html.HTMLParser(encoding='utf-8', remove_comments=True)
+	return _parsers.parser
+
+def parse_html(html):
+	"""
+	Parses an html document with lxml, or returns None if there is nothing in it to parse.
+	Unicode is parsed as utf-8 so that any encoding declaration in it is ignored.
+	"""
+	if isinstance(html, unicode):
+		html = html.encode('utf-8')
+		parser = _html_parser()
+	else:
+		parser = None    # let lxml work out the encoding of raw bytes
+	try:
+		return lxml.html.document_fromstring(html, parser=parser)
+	except (etree.ParserError, ValueError):
+		return None
+
+def content_region(doc):
+	"""
+	Finds the element that holds the article text, the way newspaper does: every paragraph
+	with a few words in it that aren't mostly link text scores its word count for its parent
+	and half that for its grandparent, and the best scoring element wins.  Falls back to the
+	whole document.
+	"""
+	scores = {}
+	for node in doc.iter(*SCORED_TAGS):
+		words = len(node.text_content().split())
+		if words <= 2:
+			continue
+		link_words = sum(len(a.text_content().split()) for a in node.iter('a'))
+		if link_words * 2 > words:
+			continue
+		parent = node.getparent()
+		if parent is None:
+			continue
+		scores[parent] = scores.get(parent, 0) + words
+		grandparent = parent.getparent()
+		if grandparent is not None:
+			scores[grandparent] = scores.get(grandparent, 0) + words / 2.0
+	if not scores:
+		return doc
+	return max(scores, key=scores.get)
+
+def soup_attrs(attrib):
+	"""The attributes of an lxml element, shaped like BeautifulSoup's tag.attrs"""
+	attrs = dict(attrib)
+	for name in MULTI_VALUED_ATTRS:
+		if name in attrs:
+			attrs[name] = attrs[name].split()
+	return attrs
+
+class LxmlLinkExtractor:
+	"""
+	Extract metadata about all the links in a news article, like LinkExtractor, but from a
+	single lxml parse of the html instead of newspaper's pipeline plus a BeautifulSoup parse
+	of its output.  Much faster; the content region it picks is newspaper's on typical
+	articles, but it doesn't do newspaper's cleanup of it.
+
+	:param url: URL of article (can be none)
+	:param html: html of article (if provided, it won't use the URL param)
+	:param source_url: url of the article's publication, for inlink checking
+	:param config: unused, each thread reuses its own lxml parser anyway
+	"""
+
+	VERSION = 1
+
+	def __init__(self, url, html=None, source_url=u'', config=None):
+		if html is None:
+			html = requests.get(url).content
+		self.url = url
+		self.source_url = source_url
+		self.doc = parse_html(html)
+
+	@staticmethod
+	def make_config():
+		return None
+
+	def _meta(self, *names):
+		for name in names:
+			for attr in ('property', 'name', 'itemprop'):
+				values = self.doc.xpath('//meta[@%s=$name]/@content' % attr, name=name)
+				if values and values[0].strip():
+					return values[0].strip()
+		return None
+
+	def canonical_link(self):
+		if self.doc is None:
+			return self.url
+		links = self.doc.xpath('//link[@rel="canonical"]/@href')
+		return (links[0].strip() if links else None) or self._meta('og:url') or self.url
+
+	def extract(self, get_meta=False):
+		anchors = []
+		wordcount = 0
+		if self.doc is None:
+			all_nodes = [None]    # an empty article still counts as one paragraph
+		else:
+			for elem in list(self.doc.iter(*NON_CONTENT_TAGS)):
+				elem.drop_tree()
+			region = content_region(self.doc)
+			all_nodes = list(region.iter('p')) or [region]
+			for i, n in enumerate(all_nodes):
+				wordcount += len(n.text_content().split())
+				for a in n.iter('a'):
+					href = a.get('href')
+					if is_valid_weblink(href):
+						anchors.append((href, a.text_content(), soup_attrs(a.attrib), i+1))
+		data = {
+			'story_links': story_links(anchors, [self.url, self.canonical_link(), self.source_url]),
+			'wordcount': wordcount,
+			'grafcount': len(all_nodes)
+		}
+		if get_meta:
+			data.update(self.metadata())
+		return data
+
+	def metadata(self):
+		"""Title, publish date, authors and url, from the page's meta tags"""
+		if self.doc is None:
+			return {'title': u'', 'publish_date': '', 'authors': [], 'url': self.url}
+		titles = self.doc.xpath('//title/text()')
+		title = self._meta('og:title') or (titles[0].strip() if titles else u'')
+		date = ''
+		published = self._meta('article:published_time', 'pubdate', 'datePublished', 'date')
+		for length, format in ((19, '%Y-%m-%d %H:%M:%S'), (10, '%Y-%m-%d')):
+			try:
+				date = datetime.strptime(published[:length].replace('T', ' '), format).strftime('%Y-%m-%d %H:%M:%S')
+				break
+			except (TypeError, ValueError):
+				pass
+		authors = [a.strip() for a in self.doc.xpath('//meta[@name="author" or @property="article:author"]/@content') if a.strip()]
+		return {'title': title, 'publish_date': date, 'authors': authors, 'url': self.url}
+
+# the extraction engines, by the name the ingester takes
+ENGINES = {
+	'newspaper': LinkExtractor,
+	'lxml': LxmlLinkExtractor
+}
+
+class BatchExtractor(object):
+	"""
+	Extracts the links from many articles with one engine, sharing its configuration between
+	them, and optionally spreading the work over a pool of worker processes or threads.
+	Failures don't raise; each article's result is (data, None) or (None, error message).
+
+	:param engine: name of the engine in ENGINES
+	:param get_meta: add each article's title, publish date, authors and url to its data
+	:param cache: an ExtractionCache, so html seen before isn't parsed again
+	:param workers: processes (or threads) to extract with; 1 extracts in the calling thread
+	:param processes: use worker processes rather than threads, which only help with lxml
+	:param download: have the engine download articles that come without html, instead of
+		reporting them as failures
+	:param lookup_hook: called with the cache hits and misses of each batch
+	"""
+
+	def __init__(self, engine='newspaper', get_meta=False, cache=None, workers=1, processes=True, download=False,
+			lookup_hook=None):
+		if engine not in ENGINES:
+			raise ValueError('Unknown extraction engine %s, expected one of %s' % (engine, ', '.join(sorted(ENGINES))))
+		self.engine = engine
+		self.get_meta = get_meta
+		self.cache = cache
+		self.workers = workers
+		self.processes = processes
+		self.download = download
+		self.lookup_hook = lookup_hook
+		self._engine = ENGINES[engine]
+		self._config = self._engine.make_config()
+		self._pool = None
+		self._pool_lock = threading.Lock()
+		self.start()
+
+	def start(self):
+		"""
+		Starts the worker pool, if there is one and it isn't running (ie. after close).  Call it
+		before starting any other threads: worker processes forked while another thread holds a
+		lock (like logging's) inherit it held, and deadlock the first time they take it.
+		"""
+		if self.workers > 1:
+			self._getPool()
+
+	def extract(self, url, html=None, source_url=u''):
+		"""Extracts the links from one article, returning (data, None) or (None, error message)."""
+		if html is None and not self.download:
+			return None, 'no raw download'
+		try:
+			return self._engine(url, html=html, source_url=source_url, config=self._config).extract(get_meta=self.get_meta), None
+		except Exception as e:
+			return None, '%s: %s' % (type(e).__name__, e)
+
+	def extract_many(self, documents, batch_size=500):
+		"""
+		Extracts the links from a stream of (url, html, source_url) documents, yielding each
+		one's result in the same order, as soon as it is ready.  Documents are taken batch_size
+		at a time, so the stream can be as long as you like.
+		"""
+		documents = iter(documents)
+		while True:
+			batch = list(itertools.islice(documents, batch_size))
+			if not batch:
+				return
+			for result in self._extractBatch(batch):
+				yield result
+
+	def _extractBatch(self, documents):
+		if self.cache is None:
+			for result in self._run(documents):
+				yield result
+			return
+		# cached results are looked up here, so only the misses go to the workers
+		keys = [self._cacheKey(*document) for document in documents]
+		cached = [self.cache.get(key) if key is not None else None for key in keys]
+		misses = [document for document, data in zip(documents, cached) if data is None]
+		if self.lookup_hook is not None:
+			self.lookup_hook(len(documents) - len(misses), len(misses))
+		results = self._run(misses)
+		for key, data in zip(keys, cached):
+			if data is not None:
+				yield data, None
+				continue
+			data, error = next(results)
+			if error is None and key is not None:
+				self.cache.put(key, data)
+			yield data, error
+
+	def _cacheKey(self, url, html, source_url=u''):
+		if html is None:
+			return None
+		return self.cache.key(html, self.engine, self._engine.VERSION, url, source_url, self.get_meta)
+
+	def _run(self, documents):
+		if self.workers <= 1 or len(documents) <= 1:
+			return (self.extract(*document) for document in documents)
+		chunksize = max(1, len(documents) / (self.workers * 4))
+		# imap hands results back in the order of the documents, as soon as each one is ready
+		if self.processes:
+			return self._getPool().imap(_extract_in_worker, documents, chunksize=chunksize)
+		return self._getPool().imap(lambda document: self.extract(*document), documents, chunksize=chunksize)
+
+	def _getPool(self):
+		with self._pool_lock:
+			if self._pool is None:
+				if self.processes:
+					# each worker process sets up its own extractor once, instead of once per article
+					self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+						initargs=(self.engine, self.get_meta, self.download))
+				else:
+					self._pool = multiprocessing.pool.ThreadPool(self.workers)
+			return self._pool
+
+	def close(self):
+		"""Shuts down the worker pool, if one was started."""
+		with self._pool_lock:
+			if self._pool is not None:
+				self._pool.close()
+				self._pool.join()
+				self._pool = None
+
+# the extractor of a worker process in a BatchExtractor's pool
+_worker_extractor = None
+
+def _init_worker(engine, get_meta, download):
+	global _worker_extractor
+	_worker_extractor = BatchExtractor(engine, get_meta=get_meta, download=download)
+
+def _extract_in_worker(document):
+	return _worker_extractor.extract(*document)
+
+def extract_many(documents, engine='newspaper', **kwargs):
+	"""
+	Extracts the links from a stream of (url, html, source_url) documents, yielding (data,
+	None) or (None, error message) for each in order.  Takes the same options as BatchExtractor.
+	"""
+	extractor = BatchExtractor(engine, **kwargs)
+	try:
+		for result in extractor.extract_many(documents):
+			yield result
+	finally:
+		extractor.close()
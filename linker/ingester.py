@@ -3,40 +3,189 @@ import os
 import sys
 import re
 import hashlib
+import datetime
+import json
+import collections
+import itertools
+import multiprocessing.pool
+import threading
+import time
+import Queue
+import urlparse
 from mediacloud.api import CustomMediaCloud
 from mediacloud.error import CustomMCException
-from .extractor import LinkExtractor
+from mediacloud.checkpoint import FileCheckpoint
+from .extractor import ENGINES, BatchExtractor
+from .canonical import fingerprint
 from .querier import CustomStoryDatabase
+from .telemetry import IngestTelemetry, TelemetryReporter, format_snapshot
 
 loghandler = logging.StreamHandler(stream=sys.stdout)
-def setHandling(logger):
-	logger.addHandler(loghandler)
-	logger.setLevel(logging.DEBUG)
+def setHandling(logger, level=logging.DEBUG):
+	if loghandler not in logger.handlers:
+		logger.addHandler(loghandler)
+	logger.setLevel(level)
 	return logger
 
 DB_NAME = 'mclinks'
+SKIPPED_STORIES_FILE = 'skipped_stories.jsonl'
 API_KEY = os.environ.get('MEDIA_CLOUD_API_KEY') or None
 
 class MCLinkerException(CustomMCException):
 	def __init__(self, message, status_code=0, mc_resp=None):
 		CustomMCException.__init__(self, message, status_code, mc_resp)
 
+class StageStats(object):
+	"""
+	What one stage of the ingest pipeline has done: the pages and stories it handled, the
+	seconds it spent working on them, waiting for input and blocked on the next stage, and the
+	deepest its input queue got.  The slowest stage is the one that hardly ever waits.
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.pages = 0
+		self.stories = 0
+		self.busy_seconds = 0.0
+		self.waiting_seconds = 0.0
+		self.blocked_seconds = 0.0
+		self.max_queue_depth = 0
+
+	def record(self, stories, seconds):
+		self.pages += 1
+		self.stories += len(stories)
+		self.busy_seconds += seconds
+
+	def as_dict(self):
+		return dict((key, value) for key, value in self.__dict__.iteritems() if key != 'name')
+
+	def __str__(self):
+		return '%s: %d stories in %d pages, %.1fs busy, %.1fs waiting, %.1fs blocked, max queue %d' % (
+			self.name, self.stories, self.pages, self.busy_seconds, self.waiting_seconds, self.blocked_seconds, self.max_queue_depth)
+
+
+class PageSizer(object):
+	"""
+	Picks how many rows to ask for in each storyList request.  It aims for pages of about
+	target_bytes of raw html that come back within target_seconds, going by the bytes and
+	seconds per story seen so far, and stays between min_rows and max_rows.  A failed request
+	halves the page size, and it doesn't grow while many recent requests are failing.  To
+	always ask for the same number of rows, make min_rows and max_rows equal.
+	"""
+
+	def __init__(self, rows=100, min_rows=5, max_rows=500, target_bytes=8*1024*1024, target_seconds=15.0):
+		self.min_rows = min_rows
+		self.max_rows = max_rows
+		self.target_bytes = target_bytes
+		self.target_seconds = target_seconds
+		self.error_rate = 0.0    # decaying average over recent requests
+		self._rows = self._bounded(rows)
+
+	def rows(self):
+		return int(self._rows)
+
+	def record(self, story_count, byte_count, seconds):
+		"""
+		Adjusts the page size after a successful request.
+		"""
+		self.error_rate *= 0.8
+		if story_count == 0:
+			return
+		ideal = self.target_seconds / max(seconds / story_count, 1e-6)
+		if byte_count > 0:
+			ideal = min(ideal, self.target_bytes / (float(byte_count) / story_count))
+		if self.error_rate > 0.2:
+			ideal = min(ideal, self._rows)
+		# move halfway there, and never more than doubling at once
+		self._rows = self._bounded(min((self._rows + ideal) / 2, self._rows * 2))
+
+	def recordError(self):
+		"""
+		Shrinks the page size after a failed request.
+		"""
+		self.error_rate = self.error_rate * 0.8 + 0.2
+		self._rows = self._bounded(self._rows / 2)
+
+	def _bounded(self, rows):
+		return max(self.min_rows, min(self.max_rows, rows))
+
 
 class MediaCloudIngester:
 	"""
 	Bringing together the API, the database, and the link extractor.
+
+	:param workers: number of processes to extract links with (1 extracts in this process)
+	:param store_threads: number of threads saving each page of stories to the database
+	:param queue_size: pages that can wait between two stages of ingest_all's pipeline
+	:param checkpoint_dir: directory to keep each ingest_all job's progress in, so it can resume
+	:param skip_existing: list each page without raw downloads first, and only download the
+		stories that aren't in the database yet
+	:param log_level: level for the ingester's, database's and API client's loggers; DEBUG
+		logs every story saved, which slows big ingests down
+	:param metrics_hook: called with a dict of telemetry (see IngestTelemetry.snapshot) every
+		report_interval seconds while ingesting; by default the telemetry is logged instead
+	:param report_interval: seconds between telemetry reports, or None for no reports
+	:param engine: link extraction engine, 'newspaper' or 'lxml' (see extractor.ENGINES)
+	:param extraction_cache: an ExtractionCache, so stories whose html was seen before aren't
+		parsed again
 	"""
 
-	def __init__(self, api_key=None, db_name=None):
+	STAGES = ('fetch', 'extract', 'store')
+	# bad stories that can't be skipped past are left out with the filter, at most this many
+	MAX_EXCLUDED_STORIES = 50
+	# times in a row ingest_all retries a failed page, with fewer rows each time, before giving up
+	PAGE_RETRIES = 3
+
+	def __init__(self, api_key=None, db_name=None, workers=1, store_threads=1, queue_size=2, checkpoint_dir=None,
+			skip_existing=False, log_level=logging.INFO, metrics_hook=None, report_interval=60, engine='newspaper',
+			extraction_cache=None):
 		db = db_name or DB_NAME
 		key = api_key or API_KEY
 		db = CustomStoryDatabase(db)
-		db._logger = setHandling(db._logger)
+		db._logger = setHandling(db._logger, log_level)
 		self.db = db
 		api = CustomMediaCloud(key)
-		api._logger = setHandling(api._logger)
+		api._logger = setHandling(api._logger, log_level)
 		self.api = api
-		self._logger = setHandling(logging.getLogger(__name__))
+		self._logger = setHandling(logging.getLogger(__name__), log_level)
+		self.telemetry = IngestTelemetry()
+		self._reporter = None
+		if report_interval is not None:
+			self._reporter = TelemetryReporter(self.telemetry, metrics_hook or self._logTelemetry, report_interval)
+		self.workers = workers
+		self.store_threads = store_threads
+		self.queue_size = queue_size
+		self.checkpoint_dir = checkpoint_dir
+		self.skip_existing = skip_existing
+		self.engine = engine
+		self.extraction_cache = extraction_cache
+		# with more than one worker the extraction is spread over a pool of processes
+		self.extractor = BatchExtractor(engine, cache=extraction_cache, workers=workers,
+			lookup_hook=self.telemetry.countCacheLookups)
+		self.skipped_story_ids = set()
+		self._skipped_lock = threading.Lock()
+		self._excluded_story_ids = collections.deque(maxlen=self.MAX_EXCLUDED_STORIES)
+		if checkpoint_dir is not None and not os.path.isdir(checkpoint_dir):
+			os.makedirs(checkpoint_dir)
+		self._store_pool = None
+		self._pool_lock = threading.Lock()    # time_series_ingest runs windows in several threads
+
+	def close(self):
+		"""
+		Shuts down the extraction worker processes and store threads, if any were started, and
+		sends a last telemetry report.
+		"""
+		if self._reporter is not None and self._reporter.running():
+			self._reporter.stop()
+			self._reporter.report()
+		self.extractor.close()
+		if self._store_pool is not None:
+			self._store_pool.close()
+			self._store_pool.join()
+		self._store_pool = None
+
+	def _logTelemetry(self, snapshot):
+		self._logger.info('Ingested %s' % format_snapshot(snapshot))
 
 	def getStories(self, solr_query='', solr_filter='', last_processed_stories_id=0, rows=20, raw_1st_download=True):
 		return self.api.storyList(
@@ -51,105 +200,455 @@ class MediaCloudIngester:
 		"""
 		Extracts links from a story and saves it to the database.
 		"""
-		data = LinkExtractor(story['url'], 
+		data = ENGINES[self.engine](story['url'], 
 			html=story.pop('raw_first_download_file'), 
 			source_url=story['media_url'])\
 			.extract()
 		self.db.addStory(story, extra_attributes=data)
 		return story, data
 
+	def processStories(self, stories):
+		"""
+		Extracts links from a page of stories and saves them to the database in page order.
+		With more than one worker the extraction is spread over a pool of processes.  Stories
+		that fail are logged and skipped.  Returns the (story, data) pairs that were saved.
+		"""
+		return self._storeStories(stories, self._extractLinks(stories))
+
+	def _extractLinks(self, stories):
+		# the raw html only goes to the extractor, it isn't saved with the story
+		documents = [(story.get('url'), story.pop('raw_first_download_file', None), story.get('media_url')) for story in stories]
+		return self.extractor.extract_many(documents, batch_size=max(1, len(documents)))
+
+	def _storeStories(self, stories, results):
+		if self.store_threads > 1:
+			with self._pool_lock:
+				if self._store_pool is None:
+					self._store_pool = multiprocessing.pool.ThreadPool(self.store_threads)
+			saved = self._store_pool.map(self._storeStory, zip(stories, results))
+		else:
+			saved = map(self._storeStory, itertools.izip(stories, results))
+		return [pair for pair in saved if pair is not None]
+
+	def _storeStory(self, job):
+		story, (data, error) = job
+		stage = 'extract'
+		if error is None:
+			stage = 'store'
+			try:
+				self.db.addStory(story, extra_attributes=data)
+			except Exception as e:
+				error = '%s: %s' % (type(e).__name__, e)
+		if error is not None:
+			self._skipStory(story, error, stage)
+			return None
+		self.telemetry.countStored(1, len(data['story_links']))
+		return story, data
+
+	def _fetchPage(self, solr_query, solr_filter, last_processed_stories_id, rows):
+		"""
+		Gets the next page of stories to process.  Returns the stories and the
+		processed_stories_id the page ends at (None if there are no more stories).  That id can
+		be past the last story returned, when stories with bad downloads were skipped or, with
+		skip_existing, stories already in the database were left out before their raw downloads
+		were fetched.
+		"""
+		if not self.skip_existing:
+			return self._listStories(solr_query, solr_filter, last_processed_stories_id, rows, True)
+		listed, page_last_id = self._listStories(solr_query, solr_filter, last_processed_stories_id, rows, False)
+		if not listed:
+			return [], page_last_id
+		existing = self.db.existingStoryIds(story['stories_id'] for story in listed)
+		missing = [story['stories_id'] for story in listed if story['stories_id'] not in existing]
+		self._logger.debug('Skipping %d of %d stories already in the database' % (len(existing), len(listed)))
+		# a bad download cuts a request short, so keep asking from where it stopped until every
+		# missing story has been fetched or skipped
+		processed_ids = dict((story['stories_id'], story['processed_stories_id']) for story in listed)
+		stories = []
+		cursor = last_processed_stories_id
+		while missing:
+			missing_filter = self._andFilter(solr_filter, '+stories_id:(%s)' % ' '.join(str(story_id) for story_id in missing))
+			fetched, cursor = self._listStories(solr_query, missing_filter, cursor, len(missing), True)
+			if cursor is None:
+				break
+			stories.extend(fetched)
+			missing = [story_id for story_id in missing if processed_ids[story_id] > cursor]
+		return stories, page_last_id
+
+	def _listStories(self, solr_query, solr_filter, last_processed_stories_id, rows, raw_1st_download):
+		"""
+		Lists up to rows stories after last_processed_stories_id, and the processed_stories_id
+		they end at (None if there are no more stories).
+
+		A story whose raw download MediaCloud can't serve fails the whole request.  Rather than
+		retrying the page, it is listed again without downloads to find the bad story, then
+		only the stories before it are requested, and the bad story is skipped and recorded (see
+		readSkippedStories).  A bad story that isn't on the page is recorded too, and left out
+		with the filter instead, keeping at most MAX_EXCLUDED_STORIES of those.
+		"""
+		cursor = last_processed_stories_id
+		bad_story = None    # the story right after the ones being requested, if it is a bad one
+		while True:
+			try:
+				stories = self.getStories(solr_query=solr_query, solr_filter=self._excludingFilter(solr_filter),
+					last_processed_stories_id=cursor, rows=rows, raw_1st_download=raw_1st_download)
+			except CustomMCException as e:
+				bad_story_id = self._badDownloadStoryId(e)
+				listed = self.getStories(solr_query=solr_query, solr_filter=self._excludingFilter(solr_filter),
+					last_processed_stories_id=cursor, rows=rows, raw_1st_download=False)
+				positions = [i for i, story in enumerate(listed) if story['stories_id'] == bad_story_id]
+				if not positions:
+					self._logger.warn('Bad download for story %s, leaving it out with the filter' % bad_story_id)
+					self._excluded_story_ids.append(bad_story_id)
+					# it isn't on this page, so where it is in the stream isn't known
+					self._skipStory({'stories_id': bad_story_id, 'processed_stories_id': None}, 'unsuccessful download')
+				elif positions[0] == 0:
+					self._skipStory(listed[0], 'unsuccessful download')
+					cursor = listed[0]['processed_stories_id']
+					bad_story = None
+				else:
+					rows = positions[0]
+					bad_story = listed[positions[0]]
+				continue
+			if bad_story is not None and len(stories) == rows:
+				self._skipStory(bad_story, 'unsuccessful download')
+				return stories, bad_story['processed_stories_id']
+			if stories:
+				return stories, stories[-1]['processed_stories_id']
+			return [], cursor if cursor != last_processed_stories_id else None
+
+	def _badDownloadStoryId(self, e):
+		# the stories_id of the bad download that made a request fail, or raises if it failed for another reason
+		mc_err_msg = e.mc_resp.json()['error']
+		self._logger.warn('Failed with message %s' % mc_err_msg)
+		match = re.search(r'unsuccessful download ([0-9]+)', mc_err_msg)
+		if match is None:
+			raise MCLinkerException(mc_err_msg, e.status_code, e.mc_resp)
+		# this is the download id so we need to query the API for the story id
+		try:
+			return self.api.download(match.group(1))['stories_id']
+		except CustomMCException as err:
+			raise MCLinkerException(err.mc_resp.json()['error'], err.status_code, err.mc_resp)
+
+	def _excludingFilter(self, solr_filter):
+		excluded = list(self._excluded_story_ids)
+		if not excluded:
+			return solr_filter
+		return self._andFilter(solr_filter, '-stories_id:(%s)' % ' '.join(str(story_id) for story_id in excluded))
+
+	def _andFilter(self, solr_filter, clause):
+		if solr_filter in ('', '*'):
+			return clause
+		return '(%s) AND %s' % (solr_filter, clause)
+
+	def _skipStory(self, story, reason, stage='fetch'):
+		# failures are counted by stage and exception type, ie. "extract: ValueError"
+		self.telemetry.countFailure('%s: %s' % (stage, reason.split(':', 1)[0]))
+		self._logger.warn('Skipping story processed_id %s stories_id %s (%s)' % (story['processed_stories_id'], story['stories_id'], reason))
+		with self._skipped_lock:
+			self.skipped_story_ids.add(story['stories_id'])
+			if self.checkpoint_dir is not None:
+				with open(os.path.join(self.checkpoint_dir, SKIPPED_STORIES_FILE), 'a') as f:
+					f.write(json.dumps({'stories_id': story['stories_id'], 'processed_stories_id': story['processed_stories_id'],
+						'reason': reason}) + '\n')
+
+	def readSkippedStories(self):
+		"""
+		Returns the stories skipped so far because of bad downloads or failed extraction, as
+		dicts with their stories_id, processed_stories_id and the reason, so they can be
+		reprocessed later.  processed_stories_id is None for a bad download that wasn't on the
+		page being fetched.  They are kept in the checkpoint_dir, so this needs one.
+		"""
+		path = os.path.join(self.checkpoint_dir, SKIPPED_STORIES_FILE)
+		if not os.path.exists(path):
+			return []
+		with open(path) as f:
+			return [json.loads(line) for line in f if line.strip()]
 
 	def ingest(self, solr_query='', solr_filter='', last_processed_stories_id=0, rows=20):
 		"""
 		Queries MediaCloud for a set of stories, extracts its links and saves the results to the database.
 		"""
 		self._logger.debug('Querying with last_id of %s' % last_processed_stories_id)
-		try:
-			stories = self.getStories(solr_query=solr_query, solr_filter=solr_filter, last_processed_stories_id=last_processed_stories_id, rows=rows)
-		except CustomMCException as e:
-			mc_err_msg = e.mc_resp.json()['error']
-			self._logger.warn('Failed with message %s' % mc_err_msg)
-			if 'unsuccessful download' in mc_err_msg:
-				bad_id = re.search(r'unsuccessful download ([0-9]+)', mc_err_msg).groups()[0]
-				# this is the download id so we need to query the API for the story id
-				try:
-					bad_story_id = self.api.download(bad_id)['stories_id']
-				except CustomMCException as err:
-					raise MCLinkerException(err.mc_resp.json()['error'], err.status_code, err.mc_resp)
-				solr_filter = solr_filter[:-1] + ' OR ' + str(bad_story_id) + solr_filter[-1]
-				self._logger.warn('Bad download id of %s, changing solr_filter' % bad_id)
-				return self.ingest(solr_query=solr_query, solr_filter=solr_filter, last_processed_stories_id=last_processed_stories_id, rows=rows)
-			else:
-				raise MCLinkerException(mc_err_msg, e.status_code, e.mc_resp)
-		for story in stories:
-			try:
-				story, data = self.processStory(story)
-				self._logger.debug('Found story processed_id %s with %d links' % (story['processed_stories_id'], len(data['story_links'])))
-			except:
-				self._logger.warn('Failed on story processed_id %s guid %s' % (story['processed_stories_id'], story['guid']))
+		stories, page_last_id = self._fetchPage(solr_query, solr_filter, last_processed_stories_id, rows)
+		self.processStories(stories)
 		if not stories:
 			self._logger.debug('No stories')
 		return stories
 
-	def ingest_all(self, solr_query=None, solr_filter=None, last_id=0):
+	def ingest_all(self, solr_query=None, solr_filter=None, last_id=0, rows=100, page_sizer=None, job_name=None):
 		"""
 		Continuously queries MediaCloud for all stories matching the given query until it's done.
 		Extracts links from each story and saves it to the database.
+
+		Fetching, extracting and saving run as a pipeline, so network, CPU and database time
+		overlap: a thread fetches pages ahead, another hands them to the extraction workers, and
+		this thread saves them in order.  At most queue_size pages wait between two stages.
+		Returns each stage's StageStats as a dict, keyed by stage name.
+
+		With a checkpoint_dir, the last processed_stories_id of each page is saved once the
+		page's stories are all stored, and running the same query and filter again picks up
+		from there (instead of from last_id).  If fetching a page still fails after PAGE_RETRIES
+		retries, the pages already fetched are still stored and checkpointed before the error is
+		raised.
+
+		The rows asked for in each request start at rows and are adjusted by page_sizer (a
+		PageSizer with its default targets if you don't pass one).
+
+		With a job_name, the cursor and stories stored so far are kept in the telemetry under
+		that name while the job runs, so the periodic report shows how far it has got.
 		"""
-		rows = 100
 		solr_query = solr_query or '*'
 		solr_filter = solr_filter or '*'
 		self._logger.debug('Starting mass ingestion with query %s and filter %s' % (solr_query, solr_filter))
-		while True:
+		checkpoint = self.checkpoint(solr_query, solr_filter)
+		if checkpoint is not None:
+			progress = checkpoint.load()
+			if progress is not None:
+				last_id = progress['last_id']
+				self._logger.info('Resuming from processed_stories_id %s' % last_id)
+		if page_sizer is None:
+			page_sizer = PageSizer(rows)
+		# before any of the pipeline threads are running, see BatchExtractor.start
+		self.extractor.start()
+		stats = dict((name, StageStats(name)) for name in self.STAGES)
+		pages = Queue.Queue(self.queue_size)
+		extracted = Queue.Queue(self.queue_size)
+		stop = threading.Event()
+		errors = []
+
+		def fetch():
+			page_last_id = last_id
+			failures = 0
 			try:
-				stories = self.ingest(solr_query, solr_filter, last_id, rows)
-			except CustomMCException as e:
-				self._logger.error('Failed with message %s' % e.message)
-				break
-			if not stories:
-				self._logger.debug('No more stories. Done ingesting.')
-				break
-			last_id = stories[-1]['processed_stories_id']
+				while not stop.is_set():
+					start = time.time()
+					try:
+						stories, page_end_id = self._fetchPage(solr_query, solr_filter, page_last_id, page_sizer.rows())
+					except Exception as e:
+						self.telemetry.countFailure('fetch: %s' % type(e).__name__)
+						failures += 1
+						if failures > self.PAGE_RETRIES:
+							raise
+						page_sizer.recordError()
+						self._logger.warn('Failed with message %s, retrying with %d rows' % (e, page_sizer.rows()))
+						continue
+					failures = 0
+					seconds = time.time() - start
+					page_sizer.record(len(stories), sum(len(story.get('raw_first_download_file') or '') for story in stories), seconds)
+					stats['fetch'].record(stories, seconds)
+					self.telemetry.countPage()
+					self.telemetry.addStageTime('fetch', seconds)
+					if page_end_id is None:
+						self._logger.debug('No more stories. Done ingesting.')
+						break
+					page_last_id = page_end_id
+					self._handOff(pages, (stories, page_last_id), stop, stats['fetch'])
+			except Exception as e:
+				self._logger.error('Failed with message %s' % e)
+				errors.append(e)
+			finally:
+				self._handOff(pages, None, stop, stats['fetch'])
 
-	def time_series_ingest(self, start_date, end_date, media_id=None, media_set_id=None, last_id=0):
+		def extract():
+			try:
+				while True:
+					page = self._take(pages, stop, stats['extract'])
+					if page is None:
+						break
+					stories, page_last_id = page
+					start = time.time()
+					results = list(self._extractLinks(stories))
+					stats['extract'].record(stories, time.time() - start)
+					self.telemetry.addStageTime('extract', time.time() - start)
+					self._handOff(extracted, (stories, page_last_id, results), stop, stats['extract'])
+			except Exception as e:
+				errors.append(e)
+			finally:
+				self._handOff(extracted, None, stop, stats['extract'])
+
+		if self._reporter is not None:
+			self._reporter.start()
+		threads = [threading.Thread(target=fetch), threading.Thread(target=extract)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		try:
+			while True:
+				page = self._take(extracted, stop, stats['store'])
+				if page is None:
+					break
+				stories, page_last_id, results = page
+				start = time.time()
+				self._storeStories(stories, results)
+				stats['store'].record(stories, time.time() - start)
+				self.telemetry.addStageTime('store', time.time() - start)
+				if checkpoint is not None:
+					checkpoint.save({'solr_query': solr_query, 'solr_filter': solr_filter, 'last_id': page_last_id})
+				if job_name is not None:
+					self.telemetry.updateJob(job_name, page_last_id, stats['store'].stories)
+		finally:
+			if job_name is not None:
+				self.telemetry.finishJob(job_name)
+			stop.set()
+			for thread in threads:
+				thread.join()
+		if errors:
+			raise errors[0]
+		for name in self.STAGES:
+			self._logger.info('%s' % stats[name])
+		return dict((name, stats[name].as_dict()) for name in self.STAGES)
+
+	def checkpoint(self, solr_query, solr_filter):
+		"""
+		The FileCheckpoint that ingest_all keeps a job's progress in, or None if this ingester
+		has no checkpoint_dir.  A job is one solr_query and solr_filter pair.
+		"""
+		if self.checkpoint_dir is None:
+			return None
+		job = hashlib.md5((u'%s\n%s' % (solr_query, solr_filter)).encode('utf-8')).hexdigest()
+		return FileCheckpoint(os.path.join(self.checkpoint_dir, 'ingest_%s.json' % job))
+
+	def _handOff(self, queue, item, stop, stats):
+		# put the item on the next stage's queue, giving up if the pipeline is stopping
+		start = time.time()
+		while not stop.is_set():
+			try:
+				queue.put(item, timeout=0.1)
+				stats.blocked_seconds += time.time() - start
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	def _take(self, queue, stop, stats):
+		# get the next item from the previous stage, or None if the pipeline is stopping
+		start = time.time()
+		stats.max_queue_depth = max(stats.max_queue_depth, queue.qsize())
+		self.telemetry.observeQueue(stats.name, queue.qsize())
+		while not stop.is_set():
+			try:
+				item = queue.get(timeout=0.1)
+				stats.waiting_seconds += time.time() - start
+				return item
+			except Queue.Empty:
+				pass
+		return None
+
+	def time_series_ingest(self, start_date, end_date, media_id=None, media_set_id=None, last_id=0,
+			window_days=None, concurrent_windows=1):
 		"""
 		Continuously queries MediaCloud for all stories matching the given
 		start_date, end_date, media_id and media_set_id.
+
+		Set window_days (ie. 1 for daily, 7 for weekly) to split the date range into windows
+		that are ingested as separate ingest_all jobs, each with its own cursor and checkpoint,
+		concurrent_windows of them at a time.  A window that fails doesn't stop the others; the
+		first error is raised once they are all done, and running again resumes the unfinished
+		windows from their checkpoints.  The periodic telemetry report shows each running
+		window's cursor and stored stories.  Returns the stage stats of each window, keyed by its
+		(start_date, end_date).
 		"""
+		if window_days is None:
+			solr_filter = self._timeSeriesFilter(start_date, end_date, media_id, media_set_id)
+			return self.ingest_all(solr_filter=solr_filter, last_id=last_id)
+		windows = []
+		window_start = start_date
+		while window_start <= end_date:
+			window_end = min(window_start + datetime.timedelta(days=window_days - 1), end_date)
+			windows.append((window_start, window_end))
+			window_start = window_end + datetime.timedelta(days=1)
+
+		def ingest_window(window):
+			solr_filter = self._timeSeriesFilter(window[0], window[1], media_id, media_set_id)
+			job_name = 'window %s to %s' % window
+			try:
+				# processed_stories_id is one sequence across all dates, so last_id holds for every window
+				return window, self.ingest_all(solr_filter=solr_filter, last_id=last_id, job_name=job_name), None
+			except Exception as e:
+				return window, None, e
+
+		window_stats = {}
+		errors = []
+		# the windows' ingest_all calls run in threads, so fork any extraction workers first
+		self.extractor.start()
+		pool = multiprocessing.pool.ThreadPool(concurrent_windows)
+		try:
+			for window, stats, error in pool.imap_unordered(ingest_window, windows):
+				if error is not None:
+					self._logger.error('Window %s to %s failed with message %s' % (window[0], window[1], error))
+					errors.append(error)
+				else:
+					window_stats[window] = stats
+					self._logger.info('Window %s to %s done with %d stories, %d of %d windows done' % (
+						window[0], window[1], stats['store']['stories'], len(window_stats), len(windows)))
+		finally:
+			pool.close()
+			pool.join()
+		if errors:
+			raise errors[0]
+		return window_stats
+
+	def _timeSeriesFilter(self, start_date, end_date, media_id, media_set_id):
 		start_datestr = start_date.strftime('%Y-%m-%d')
 		end_datestr = end_date.strftime('%Y-%m-%d')
 		solr_filter = '+publish_date:[{start}T00:00:00Z TO {end}T23:59:59Z]'.format(
-			start=start_date, end=end_date)
+			start=start_datestr, end=end_datestr)
 		if media_id is not None:
 			solr_filter += ' AND +media_id:{media}'.format(media=media_id)
 		if media_set_id is not None:
 			solr_filter += ' AND +media_sets_id:{media_set}'.format(media_set=media_set_id)
-		self.ingest_all(solr_filter=solr_filter, last_id=last_id)
+		return solr_filter
 
 class LinkSpider(object):
+	"""
+	Crawls outward from a url along its inlinks, saving every page it reaches.  Pages are
+	downloaded and extracted batch_size at a time, over workers threads.
+	"""
 
-	def __init__(self, db_name=None):
+	def __init__(self, db_name=None, engine='newspaper', workers=1, batch_size=20):
 		db_name = db_name or DB_NAME
 		self.db = CustomStoryDatabase(db_name)
-		self.hrefs = set()
-		self.queue = set()
+		self.hrefs = set()    # fingerprints of the canonical urls crawled, so variants of a url are only crawled once
+		self.queue = {}    # url to crawl, by fingerprint
+		self.batch_size = batch_size
+		# threads rather than processes, since most of the time goes on downloading
+		self.extractor = BatchExtractor(engine, get_meta=True, workers=workers, processes=False, download=True)
 
 	def spider_from(self, url, limit=20000):
-		print '%d links crawled, %d links in queue. url %s' % (len(self.hrefs), len(self.queue), url)
-		if url not in self.hrefs:
-			self.hrefs |= set([url])
-			data = LinkExtractor(url).extract(get_meta=True)
-			data.update({
-				'guid': url,
-				'stories_id': hashlib.md5(url).hexdigest()
-			})
-			story = self.db.addStory(data)
-			limit -= 1
-			# Add the inlinks to a queue so we get the closest links first
-			self.queue |= set([link['href'] for link in data['story_links']
-							  if link['inlink'] is True and link['href'] not in self.hrefs and not any((subl in link['href'] for subl in ('topics.nytimes', 'movies.nytimes')))])
-		else:
-			print '--> Already crawled'
-		if self.queue:
-			return self.spider_from(self.queue.pop(), limit=limit)
+		self.queue.setdefault(fingerprint(url), url)
+		try:
+			while self.queue and limit > 0:
+				batch = []
+				while self.queue and len(batch) < min(self.batch_size, limit):
+					key, url = self.queue.popitem()
+					if key in self.hrefs:
+						print '--> Already crawled %s' % url
+						continue
+					self.hrefs.add(key)
+					batch.append(url)
+				limit -= len(batch)
+				results = self.extractor.extract_many((url, None, u'') for url in batch)
+				for url, (data, error) in itertools.izip(batch, results):
+					print '%d links crawled, %d links in queue. url %s' % (len(self.hrefs), len(self.queue), url)
+					if error is not None:
+						print '--> Failed (%s)' % error
+						continue
+					self._saveAndQueue(url, data)
+		finally:
+			self.extractor.close()
 		return len(self.hrefs)
+
+	def _saveAndQueue(self, url, data):
+		data.update({
+			'guid': url,
+			'stories_id': hashlib.md5(url).hexdigest()
+		})
+		self.db.addStory(data)
+		# Add the inlinks to a queue so we get the closest links first
+		for link in data['story_links']:
+			if link['inlink'] is True and not any((subl in link['href'] for subl in ('topics.nytimes', 'movies.nytimes'))):
+				href = urlparse.urljoin(url, link['href'])
+				link_key = fingerprint(href)
+				if link_key not in self.hrefs:
+					self.queue.setdefault(link_key, href)
@@ -2,14 +2,35 @@ import csv
 import itertools
 import networkx as nx
 from mediacloud.storage import MongoStoryDatabase
+from canonical import DEFAULT_CANONICALIZER
+
+# Story fields the graph methods attach to their nodes; skips sentences, text and raw html
+GRAPH_FIELDS = ['guid', 'url', 'stories_id', 'media_id', 'title', 'publish_date', 'wordcount', 'grafcount', 'story_links']
 
 class CustomStoryDatabase(MongoStoryDatabase):
 
-    def getStories(self, query):
+    # graph nodes are canonical urls, so the same page linked in different ways is one node;
+    # set to None to key them by the raw guids and hrefs
+    url_canonicalizer = DEFAULT_CANONICALIZER
+
+    def setCodec(self, codec):
+        # getPatternData aggregates on story_links in mongo, which can't look inside compressed fields
+        if codec is not None and 'story_links' in codec.fields:
+            raise ValueError("story_links can't be compressed, the link queries aggregate on it")
+        super(CustomStoryDatabase, self).setCodec(codec)
+
+    def _node(self, url):
+        if self.url_canonicalizer is None:
+            return url
+        return self.url_canonicalizer.canonicalize(url)
+
+    def getStories(self, query, fields=None):
         """
         Just gets stories based on a query, fun.
+
+        :param fields: Optional list of fields to return, instead of whole stories.
         """
-        return self._db.stories.find( query )
+        return self.findStories(query, fields)
 
     def getEdges(self, query=None):
         """
@@ -20,7 +41,7 @@ class CustomStoryDatabase(MongoStoryDatabase):
         """
         if query is None:
             query = {}
-        stories = self.getStories(query)
+        stories = self.getStories(query, ['guid', 'story_links.href', 'story_links.inlink'])
         graph = self.buildGraph(stories)
         return graph.edges()
 
@@ -33,12 +54,12 @@ class CustomStoryDatabase(MongoStoryDatabase):
         """
         graph = nx.DiGraph()
         for story in stories:
-            node = story['guid']
+            node = self._node(story['guid'])
             graph.add_node(node, story)
             for link in story['story_links']:
                 if inlinks_only is True and link['inlink'] is False:
                     continue
-                linknode = link['href']
+                linknode = self._node(link['href'])
                 graph.add_node(linknode)
                 graph.add_edge(node, linknode, link)
         return graph
@@ -51,7 +72,8 @@ class CustomStoryDatabase(MongoStoryDatabase):
         :param url: The URL in the database.
         :param query: Limit the graph of the query.
         """
-        stories = self.getStories(query)
+        url = self._node(url)
+        stories = self.getStories(query, GRAPH_FIELDS)
         graph = self.buildGraph(stories, inlinks_only=True)
         cocites = set()
         for predecessor in graph.predecessors_iter(url):
@@ -68,6 +90,7 @@ class CustomStoryDatabase(MongoStoryDatabase):
         :param spider: How many levels to spider out from the original URL.
         :return: List of links, ordered by relevancy.
         """
+        url = self._node(url)
         subgraph = self.getSpiderSubgraph(url, query, spider)
         stories = sorted(subgraph.in_degree_iter(subgraph.nodes()), key=lambda s: s[1], reverse=True)
         return [subgraph.node[s[0]] or {'href': s[0]} for s in stories if s[0] != url]
@@ -81,9 +104,9 @@ class CustomStoryDatabase(MongoStoryDatabase):
         :param spider: How many levels to spider out from the original URL.
         :return: networkx graph with the spidered links.
         """
-        stories = self.getStories(query)
+        stories = self.getStories(query, GRAPH_FIELDS)
         graph = self.buildGraph(stories, inlinks_only=True)
-        urls = [url]
+        urls = [self._node(url)]
         all_results = set()
         for i in range(spider):
             new_results = set()
@@ -102,7 +125,8 @@ class CustomStoryDatabase(MongoStoryDatabase):
         :param query: Limit the scope of the graph.
         :return: List of links with detailed metadata.
         """
-        stories = self.getStories(query)
+        url = self._node(url)
+        stories = self.getStories(query, GRAPH_FIELDS)
         graph = self.buildGraph(stories, inlinks_only=True)
         if url not in graph:
             return []
@@ -149,20 +173,24 @@ class CustomStoryDatabase(MongoStoryDatabase):
         :param with_metadata: Get meta information about the links along with the stories.
         :return: List or dict, depending on whether `with_metadata` is enabled.
         """
-        stories = self._db.stories.aggregate([
-                {'$match': query},
-                {'$project': {
-                    'guid': 1,
-                    'hrefs': '$story_links.href',
-                    'num_links': {'$size': '$story_links'},
-                    # I can't get this to actually work; it just returns a list of 1s and 0s, and you need to sum it afterwards
-                    # I probably need to use $unwind
-                    'num_inlinks': {'$map': {'input': '$story_links', 'as': 'link', 'in': {'$cond': ['$$link.inlink',1,0]}}},
-                    'wordcount': 1,
-                    'grafcount': 1
-                }},
-                {'$sort': {'_id': 1}}
-            ])['result']
+        stories = []
+        for partition in self._partitionsForQuery(query):
+            stories += self._db[partition].aggregate([
+                    {'$match': query},
+                    {'$project': {
+                        'guid': 1,
+                        'hrefs': '$story_links.href',
+                        'num_links': {'$size': '$story_links'},
+                        # I can't get this to actually work; it just returns a list of 1s and 0s, and you need to sum it afterwards
+                        # I probably need to use $unwind
+                        'num_inlinks': {'$map': {'input': '$story_links', 'as': 'link', 'in': {'$cond': ['$$link.inlink',1,0]}}},
+                        'wordcount': 1,
+                        'grafcount': 1
+                    }},
+                    {'$sort': {'_id': 1}}
+                ])['result']
+        if len(stories) > 1:
+            stories.sort(key=lambda s: s['_id'])
         # Fix the problem here
 
         if not stories:
@@ -220,8 +248,13 @@ class CsvQuerier(object):
         self.patterns = patterns or ()
         self.use_guid = use_guid
 
-    def getNodeRows(self, query):
-        return [{
+    NODE_ROW_FIELDS = ['guid', 'url', 'stories_id', 'media_id', 'title', 'publish_date', 'story_links.href', 'story_links.inlink']
+
+    def getNodeRows(self, query, batch_size=1000):
+        """
+        Streams one row per story matching the query, without holding the whole scan in memory.
+        """
+        return ({
             '_id': s['_id'],
             'guid': s['guid'],
             'url': s['url'],
@@ -232,7 +265,7 @@ class CsvQuerier(object):
             'num_links': len(s['story_links']),
             'num_inlinks': len([l for l in s['story_links'] if l['inlink'] is True]),
             'hrefs': ', '.join([i['href'] for i in s['story_links']])
-        } for s in self.db.getStories(query)]
+        } for s in self.db.scanStories(query, self.NODE_ROW_FIELDS, batch_size))
 
     def getEdgeRows(self, query=None):
         edges = self.db.getEdges(query)
@@ -296,16 +329,14 @@ class CsvQuerier(object):
                 nodes.append(node)
         return nodes
 
-    def customizeStoryData(self, infile='out/spider_links_mod.csv', id_field='id'):
+    def customizeStoryData(self, infile='out/spider_links_mod.csv', id_field='id', batch_size=1000):
         """
+        Streams the stories that appear in the csv, with the csv columns merged in.
         """
         nodes = self.getDictFromCsv(infile)
         node_dict = { node[id_field]: node for node in nodes }
-        stories = self.db.getStories({})
-        s = []
-        for story in stories:
+        for story in self.db.scanStories({}, batch_size=batch_size):
             if story['guid'] in node_dict:
                 copy = story.copy()
                 copy.update(node_dict[story['guid']])
-                s.append(copy)
-        return s
+                yield copy
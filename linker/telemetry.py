@@ -0,0 +1,152 @@
+import threading
+import time
+
+STAGES = ('fetch', 'extract', 'store')
+
+class IngestTelemetry(object):
+	"""
+	Thread-safe running totals for an ingester: stories stored, links extracted, pages
+	fetched, seconds spent in each pipeline stage, failures by type, the depth of the queues
+	between stages and where each running job is.  snapshot() turns them into rates for
+	reporting.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._started = time.time()
+		self._stories = 0
+		self._links = 0
+		self._pages = 0
+		self._stage_seconds = dict((stage, 0.0) for stage in STAGES)
+		self._failures = {}
+		self._queue_depths = {}
+		self._cache_hits = 0
+		self._cache_misses = 0
+		self._jobs = {}
+		self._last_snapshot = (self._started, 0, 0)
+
+	def countStored(self, story_count, link_count):
+		with self._lock:
+			self._stories += story_count
+			self._links += link_count
+
+	def countPage(self):
+		with self._lock:
+			self._pages += 1
+
+	def addStageTime(self, stage, seconds):
+		with self._lock:
+			self._stage_seconds[stage] += seconds
+
+	def countFailure(self, kind):
+		with self._lock:
+			self._failures[kind] = self._failures.get(kind, 0) + 1
+
+	def countCacheLookups(self, hits, misses):
+		with self._lock:
+			self._cache_hits += hits
+			self._cache_misses += misses
+
+	def updateJob(self, name, cursor, stories):
+		"""
+		Remembers how far a running job (ie. one window of a time series) has got: the cursor
+		it would resume from and the stories it has stored.
+		"""
+		with self._lock:
+			self._jobs[name] = {'cursor': cursor, 'stories': stories}
+
+	def finishJob(self, name):
+		with self._lock:
+			self._jobs.pop(name, None)
+
+	def observeQueue(self, stage, depth):
+		"""
+		Remembers the deepest the queue in front of a stage got since the last snapshot.
+		"""
+		with self._lock:
+			self._queue_depths[stage] = max(self._queue_depths.get(stage, 0), depth)
+
+	def snapshot(self):
+		"""
+		Returns the totals so far as a dict, with stories and links per second both since the
+		last snapshot and overall.
+		"""
+		with self._lock:
+			now = time.time()
+			last_time, last_stories, last_links = self._last_snapshot
+			interval = max(now - last_time, 1e-6)
+			elapsed = max(now - self._started, 1e-6)
+			snapshot = {
+				'elapsed_seconds': elapsed,
+				'stories': self._stories,
+				'links': self._links,
+				'pages': self._pages,
+				'stories_per_sec': (self._stories - last_stories) / interval,
+				'links_per_sec': (self._links - last_links) / interval,
+				'overall_stories_per_sec': self._stories / elapsed,
+				'overall_links_per_sec': self._links / elapsed,
+				'stage_seconds': dict(self._stage_seconds),
+				'failures': dict(self._failures),
+				'queue_depths': self._queue_depths,
+				'cache_hits': self._cache_hits,
+				'cache_misses': self._cache_misses,
+				'jobs': dict((name, dict(job)) for name, job in self._jobs.iteritems())
+			}
+			self._last_snapshot = (now, self._stories, self._links)
+			self._queue_depths = {}
+			return snapshot
+
+def format_snapshot(snapshot):
+	"""
+	One log line summing up a snapshot from IngestTelemetry.
+	"""
+	busy = sum(snapshot['stage_seconds'].values()) or 1.0
+	line = '%d stories (%.1f/sec), %d links (%.1f/sec), time %s, queues %s, failures %s' % (
+		snapshot['stories'], snapshot['stories_per_sec'], snapshot['links'], snapshot['links_per_sec'],
+		' '.join('%s %d%%' % (stage, 100 * snapshot['stage_seconds'][stage] / busy) for stage in STAGES),
+		' '.join('%s %d' % item for item in sorted(snapshot['queue_depths'].items())) or 'empty',
+		', '.join('%s %d' % item for item in sorted(snapshot['failures'].items())) or 'none')
+	lookups = snapshot['cache_hits'] + snapshot['cache_misses']
+	if lookups > 0:
+		line += ', extraction cache %d%% hits' % (100 * snapshot['cache_hits'] / lookups)
+	if snapshot['jobs']:
+		line += ', running %s' % '; '.join('%s at %s with %d stories' % (name, job['cursor'], job['stories'])
+			for name, job in sorted(snapshot['jobs'].items()))
+	return line
+
+class TelemetryReporter(object):
+	"""
+	Hands a snapshot of the telemetry to hook every interval seconds, from a background thread.
+	"""
+
+	def __init__(self, telemetry, hook, interval=60):
+		self.telemetry = telemetry
+		self.hook = hook
+		self.interval = interval
+		self._stopping = threading.Event()
+		self._thread = None
+		self._lock = threading.Lock()    # several ingest jobs can start it at once
+
+	def start(self):
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run)
+				self._thread.daemon = True
+				self._thread.start()
+
+	def running(self):
+		return self._thread is not None
+
+	def report(self):
+		self.hook(self.telemetry.snapshot())
+
+	def stop(self):
+		if self._thread is not None:
+			self._stopping.set()
+			self._thread.join()
+			self._thread = None
+			self._stopping.clear()
+
+	def _run(self):
+		while not self._stopping.wait(self.interval):
+			self.report()
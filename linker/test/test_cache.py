@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cache import ExtractionCache
+
+RESULT = {'story_links': [{'href': 'http://example.com/a', 'anchor': u'a', 'inlink': True, 'para': 1, '_raw_attrs': {}}],
+	'wordcount': 10, 'grafcount': 1}
+
+class ExtractionCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self._dir = tempfile.mkdtemp()
+		self._path = os.path.join(self._dir, 'cache.sqlite')
+
+	def tearDown(self):
+		shutil.rmtree(self._dir)
+
+	def testKey(self):
+		key = ExtractionCache.key(u'<p>hi</p>', 'lxml', 1, 'http://example.com/')
+		self.assertEqual(key, ExtractionCache.key('<p>hi</p>', 'lxml', 1, 'http://example.com/'))
+		self.assertNotEqual(key, ExtractionCache.key('<p>hi</p>', 'lxml', 2, 'http://example.com/'))
+		self.assertNotEqual(key, ExtractionCache.key('<p>hi!</p>', 'lxml', 1, 'http://example.com/'))
+
+	def testHitsAndMisses(self):
+		cache = ExtractionCache()
+		self.assertEqual(cache.get('a'), None)
+		cache.put('a', RESULT)
+		self.assertEqual(cache.get('a'), RESULT)
+		stats = cache.stats()
+		self.assertEqual((stats['memory_hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+
+	def testCopies(self):
+		cache = ExtractionCache()
+		cache.put('a', RESULT)
+		cache.get('a')['story_links'].pop()
+		self.assertEqual(cache.get('a'), RESULT)
+
+	def testMemoryBounded(self):
+		cache = ExtractionCache(memory_bytes=500)
+		for i in range(20):
+			cache.put(str(i), RESULT)
+		self.assertTrue(cache.stats()['memory_bytes'] <= 500)
+		self.assertEqual(cache.get('0'), None)
+		self.assertEqual(cache.get('19'), RESULT)
+
+	def testDisk(self):
+		cache = ExtractionCache(self._path, memory_bytes=0)
+		cache.put('a', RESULT)
+		cache.close()
+		cache = ExtractionCache(self._path)
+		self.assertEqual(cache.get('a'), RESULT)
+		self.assertEqual(cache.get('a'), RESULT)
+		stats = cache.stats()
+		self.assertEqual((stats['disk_hits'], stats['memory_hits']), (1, 1))
+		cache.close()
+
+	def testDiskBounded(self):
+		cache = ExtractionCache(self._path, memory_bytes=0, disk_bytes=1000)
+		for i in range(100):
+			cache.put(str(i), dict(RESULT, wordcount=i))
+		self.assertTrue(cache.stats()['disk_bytes'] <= 1000)
+		self.assertEqual(cache.get('0'), None)
+		self.assertEqual(cache.get('99')['wordcount'], 99)
+		cache.close()
@@ -0,0 +1,43 @@
+import unittest
+import canonical
+
+class UrlCanonicalizerTest(unittest.TestCase):
+
+	def setUp(self):
+		self._canonicalizer = canonical.UrlCanonicalizer()
+
+	def testVariantsMatch(self):
+		variants = [
+			'http://www.example.com/2015/03/story',
+			'https://www.example.com/2015/03/story/',
+			'//WWW.Example.com/2015/03/story?utm_source=twitter',
+			'http://www.example.com:80/2015/03/story#comments',
+			'http://www.example.com/2015/03/story/all/?page=2'
+		]
+		self.assertEqual(set(self._canonicalizer.canonicalize(url) for url in variants), set(['http://www.example.com/2015/03/story']))
+		self.assertEqual(len(set(self._canonicalizer.fingerprint(url) for url in variants)), 1)
+
+	def testExempt(self):
+		url = 'http://query.nytimes.com/search/sitesearch/?action=click#/obama'
+		self.assertEqual(self._canonicalizer.canonicalize(url), url)
+
+	def testTrackingParams(self):
+		canonicalizer = canonical.UrlCanonicalizer(strip_query=False)
+		self.assertEqual(canonicalizer.canonicalize('http://example.com/a?id=5&utm_medium=rss&ref=hp&page=2#top'),
+			'http://example.com/a?id=5&page=2')
+
+	def testLeavesScheme(self):
+		canonicalizer = canonical.UrlCanonicalizer(scheme=None, lowercase_host=False, strip_trailing_slash=False)
+		self.assertEqual(canonicalizer.canonicalize('//Example.com/a/?x=1'), '//Example.com/a/')
+		self.assertEqual(canonicalizer.canonicalize('/relative/all/#top'), '/relative/')
+
+	def testDefaultKeepsQuery(self):
+		self.assertNotEqual(canonical.canonicalize('http://blog.example.com/?p=123'), canonical.canonicalize('http://blog.example.com/?p=456'))
+		self.assertEqual(canonical.canonicalize('https://blog.example.com/?p=123&utm_source=rss#more'), 'http://blog.example.com/?p=123')
+		self.assertNotEqual(canonical.fingerprint('http://blog.example.com/?p=123'), canonical.fingerprint('http://blog.example.com/?p=456'))
+
+	def testFingerprint(self):
+		key = canonical.fingerprint(u'http://example.com/caf\xe9')
+		self.assertTrue(isinstance(key, (int, long)))
+		self.assertTrue(-2**63 <= key < 2**63)
+		self.assertNotEqual(key, canonical.fingerprint('http://example.com/cafe'))
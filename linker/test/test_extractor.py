@@ -1,6 +1,14 @@
+import os
+import codecs
 import unittest
 import extractor
 
+try:
+	import newspaper
+except ImportError:
+	newspaper = None    # only the lxml engine can be tested
+
+@unittest.skipUnless(newspaper, 'newspaper is not installed')
 class ExtractorTest(unittest.TestCase):
 
 	TEST_URL = 'http://www.theguardian.com/us-news/2015/mar/21/police-killings-us-government-statistics'
@@ -15,3 +23,145 @@ class ExtractorTest(unittest.TestCase):
 		link = data['links'][1]
 		for attr in ('para', 'anchor', 'href', 'inlink'):
 			assert link.has_key(attr)
+
+class DomainResolverTest(unittest.TestCase):
+
+	def setUp(self):
+		self._resolver = extractor.DomainResolver(maxsize=2)
+
+	def testDomain(self):
+		self.assertEqual(self._resolver.domain('http://www.nytimes.com/2015/03/21/us/story.html?ref=rss'), 'nytimes')
+		self.assertEqual(self._resolver.domain('//blogs.nytimes.com/'), 'nytimes')
+		self.assertEqual(self._resolver.domain('https://www.bbc.co.uk/news'), 'bbc')
+
+	def testCachedByHost(self):
+		self._resolver.domain('http://www.nytimes.com/a')
+		self._resolver.domain('http://www.nytimes.com/b')
+		self._resolver.domain('https://www.nytimes.com/c')
+		stats = self._resolver.stats()
+		self.assertEqual((stats['hits'], stats['misses'], stats['hosts']), (2, 1, 1))
+
+	def testLeastRecentlyUsedEvicted(self):
+		self._resolver.domains(['http://a.com/', 'http://b.com/'])
+		self._resolver.domain('http://a.com/x')
+		self._resolver.domain('http://c.com/')
+		self.assertEqual(self._resolver.stats()['hosts'], 2)
+		self._resolver.domain('http://a.com/y')
+		self.assertEqual(self._resolver.stats()['misses'], 3)
+		self._resolver.domain('http://b.com/y')
+		self.assertEqual(self._resolver.stats()['misses'], 4)
+
+	def testBatch(self):
+		domains = self._resolver.domains(['http://www.nytimes.com/a', 'http://www.nytimes.com/a', '//www.cnn.com/b'])
+		self.assertEqual(domains, {'http://www.nytimes.com/a': 'nytimes', '//www.cnn.com/b': 'cnn'})
+
+	def testStripArgs(self):
+		self.assertEqual(extractor.strip_args('http://www.example.com/story/all/?page=2#top'), 'http://www.example.com/story/')
+		self.assertEqual(extractor.strip_args('HTTP://www.example.com/story#top'), 'HTTP://www.example.com/story')
+		# without arguments the url is left alone, /all/ and all
+		self.assertEqual(extractor.strip_args('http://www.example.com/story/all/'), 'http://www.example.com/story/all/')
+		self.assertEqual(extractor.strip_args('http://query.nytimes.com/search?q=x'), 'http://query.nytimes.com/search?q=x')
+
+	def testStoryLinks(self):
+		links = extractor.story_links([
+			('http://www.nytimes.com/2015/a.html?ref=rss', 'a', {}, 1),
+			('/section/b', 'b', {}, 1),
+			('//www.cnn.com/c', 'c', {}, 2)
+		], ['http://www.nytimes.com/2015/story.html', None, 'http://nytimes.com'])
+		self.assertEqual([(l['href'], l['inlink'], l['para']) for l in links], [
+			('http://www.nytimes.com/2015/a.html', True, 1),
+			('/section/b', True, 1),
+			('http://www.cnn.com/c', False, 2)
+		])
+
+class EngineCompatibilityTest(unittest.TestCase):
+
+	FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'article.html')
+	TEST_URL = 'http://www.example-news.com/2015/03/21/city-council-budget'
+	SOURCE_URL = 'http://www.example-news.com'
+
+	def setUp(self):
+		with codecs.open(self.FIXTURE, 'r', 'utf-8') as f:
+			self._html = f.read()
+
+	def _extract(self, engine):
+		return engine(self.TEST_URL, html=self._html, source_url=self.SOURCE_URL).extract(get_meta=True)
+
+	def _links(self, data):
+		return [(l['href'], l['anchor'].strip(), l['inlink'], l['para'], l['_raw_attrs']) for l in data['story_links']]
+
+	@unittest.skipUnless(newspaper, 'newspaper is not installed')
+	def testSameOutput(self):
+		expected = self._extract(extractor.LinkExtractor)
+		actual = self._extract(extractor.LxmlLinkExtractor)
+		self.assertEqual(self._links(actual), self._links(expected))
+		self.assertEqual(actual['wordcount'], expected['wordcount'])
+		self.assertEqual(actual['grafcount'], expected['grafcount'])
+		self.assertEqual(actual['url'], expected['url'])
+
+	def testLinks(self):
+		data = self._extract(extractor.LxmlLinkExtractor)
+		self.assertEqual(data['grafcount'], 6)
+		self.assertEqual([(l['href'], l['inlink'], l['para']) for l in data['story_links']], [
+			('http://www.example-news.com/2015/02/10/mayor-budget-proposal', True, 2),
+			('https://twitter.com/example_council/status/579', False, 3),
+			('http://www.citybudgetwatch.org/reports/2015', False, 4),
+			('http://www.example-news.com/documents/budget-2015.pdf', True, 5),
+			('http://www.cityhall.example.gov/hearings/', False, 6)
+		])
+		self.assertEqual(data['story_links'][0]['_raw_attrs']['class'], ['story-link', 'related'])
+		self.assertEqual(data['publish_date'], '2015-03-21 09:30:00')
+		self.assertEqual(data['authors'], ['Jane Reporter'])
+
+	def testEmptyHtml(self):
+		data = extractor.LxmlLinkExtractor(self.TEST_URL, html=u'').extract()
+		self.assertEqual(data, {'story_links': [], 'wordcount': 0, 'grafcount': 1})
+
+class BatchExtractorTest(unittest.TestCase):
+
+	def setUp(self):
+		self._documents = [('http://www.example.com/%d' % i,
+			'<html><body><p>story number %d <a href="http://www.example.com/%d?ref=rss">next</a></p></body></html>' % (i, i+1),
+			'http://www.example.com') for i in range(20)]
+		self._documents.insert(5, ('http://www.example.com/missing', None, 'http://www.example.com'))
+
+	def _check(self, results):
+		self.assertEqual(len(results), 21)
+		self.assertEqual(results[5], (None, 'no raw download'))
+		hrefs = [data['story_links'][0]['href'] for data, error in results if error is None]
+		self.assertEqual(hrefs, ['http://www.example.com/%d' % (i+1) for i in range(20)])
+
+	def testInOrder(self):
+		self._check(list(extractor.extract_many(self._documents, engine='lxml')))
+
+	def testProcessPool(self):
+		self._check(list(extractor.extract_many(iter(self._documents), engine='lxml', workers=3)))
+
+	def testThreadPool(self):
+		self._check(list(extractor.extract_many(self._documents, engine='lxml', workers=3, processes=False)))
+
+	def testPoolStartsBeforeExtracting(self):
+		# so the workers are forked before the caller starts any threads of its own
+		batch_extractor = extractor.BatchExtractor('lxml', workers=2)
+		try:
+			self.assertTrue(batch_extractor._pool is not None)
+			batch_extractor.close()
+			self.assertTrue(batch_extractor._pool is None)
+			batch_extractor.start()
+			self.assertTrue(batch_extractor._pool is not None)
+			self._check(list(batch_extractor.extract_many(self._documents)))
+		finally:
+			batch_extractor.close()
+		self.assertTrue(extractor.BatchExtractor('lxml')._pool is None)
+
+	def testBatches(self):
+		batch_extractor = extractor.BatchExtractor('lxml')
+		self._check(list(batch_extractor.extract_many(self._documents, batch_size=4)))
+
+	def testCache(self):
+		from cache import ExtractionCache
+		lookups = []
+		batch_extractor = extractor.BatchExtractor('lxml', cache=ExtractionCache(), lookup_hook=lambda hits, misses: lookups.append((hits, misses)))
+		self._check(list(batch_extractor.extract_many(self._documents)))
+		self._check(list(batch_extractor.extract_many(self._documents)))
+		self.assertEqual(lookups, [(0, 21), (20, 1)])
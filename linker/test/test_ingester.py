@@ -0,0 +1,275 @@
+import re
+import time
+import shutil
+import datetime
+import logging
+import tempfile
+import unittest
+from mediacloud.error import CustomMCException
+from linker.ingester import MediaCloudIngester, PageSizer
+from linker.telemetry import format_snapshot
+
+DOWNLOAD_ID_OFFSET = 50000
+
+class FakeResponse(object):
+
+	def __init__(self, error, status_code=500):
+		self.error = error
+		self.status_code = status_code
+
+	def json(self):
+		return {'error': self.error}
+
+class FakeMediaCloud(object):
+	"""
+	Serves stories 1001 to 1000+total, with processed_stories_id 1 to total, like storyList does.
+	Requests with raw downloads fail if they include a story in bad, or while the stories_id
+	in off_page (a bad story that never shows up in a listing) isn't filtered out.  Every
+	request after processed_stories_id fail_after fails, as if the connection were down.  The
+	stories in no_html come without their raw download.
+	"""
+
+	def __init__(self, total=10, bad=(), off_page=None, fail_after=None, no_html=()):
+		self.total = total
+		self.bad = set(bad)
+		self.no_html = set(no_html)
+		self.off_page = off_page
+		self.fail_after = fail_after
+		self.calls = []
+
+	def storyList(self, solr_query='', solr_filter='', last_processed_stories_id=0, rows=20, raw_1st_download=False):
+		self.calls.append((solr_filter, last_processed_stories_id, rows, raw_1st_download))
+		if self.fail_after is not None and last_processed_stories_id >= self.fail_after:
+			raise IOError('Connection reset by peer')
+		wanted = self._ids(r'\+stories_id:\(([0-9 ]+)\)', solr_filter)
+		excluded = self._ids(r'-stories_id:\(([0-9 ]+)\)', solr_filter) or set()
+		stories = [self._story(i, raw_1st_download) for i in range(last_processed_stories_id+1, self.total+1)
+			if (wanted is None or 1000+i in wanted) and 1000+i not in excluded][:rows]
+		if raw_1st_download:
+			bad = [story['stories_id'] for story in stories if story['stories_id'] in self.bad]
+			if self.off_page is not None and self.off_page not in excluded:
+				bad.insert(0, self.off_page)
+			if bad:
+				raise CustomMCException('Error', 500, FakeResponse('unsuccessful download %d' % (bad[0] + DOWNLOAD_ID_OFFSET)))
+		return stories
+
+	def download(self, downloads_id):
+		return {'stories_id': int(downloads_id) - DOWNLOAD_ID_OFFSET}
+
+	def _ids(self, pattern, solr_filter):
+		match = re.search(pattern, solr_filter or '')
+		return set(int(story_id) for story_id in match.group(1).split()) if match else None
+
+	def _story(self, i, raw_1st_download):
+		story = {'stories_id': 1000+i, 'processed_stories_id': i, 'url': 'http://example.com/%d' % i,
+			'guid': 'http://example.com/%d' % i, 'media_url': 'http://example.com', 'media_id': 1,
+			'publish_date': '2015-01-01 00:00:00'}
+		if raw_1st_download:
+			story['raw_first_download_file'] = None if 1000+i in self.no_html else '<html><body><p>story %d <a href="http://example.com/%d">next</a></p></body></html>' % (i, i+1)
+		return story
+
+class IngesterTest(unittest.TestCase):
+
+	TEST_DB_NAME = 'mclinks-test'
+
+	def setUp(self):
+		self._checkpoint_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		self._ingester.db.deleteDatabase(self.TEST_DB_NAME)
+		self._ingester.close()
+		shutil.rmtree(self._checkpoint_dir)
+
+	def _makeIngester(self, api, **kwargs):
+		options = dict(engine='lxml', report_interval=None, log_level=logging.CRITICAL)
+		options.update(kwargs)
+		self._ingester = MediaCloudIngester(api_key='test', db_name=self.TEST_DB_NAME, checkpoint_dir=self._checkpoint_dir,
+			**options)
+		self._ingester.api = api
+		return self._ingester
+
+	def _ingestAll(self, ingester, rows=5):
+		return ingester.ingest_all(page_sizer=PageSizer(rows, min_rows=rows, max_rows=rows))
+
+	def _storedIds(self, ingester):
+		return sorted(story['stories_id'] for story in ingester.db.findStories({}, ['stories_id']))
+
+	def _checkBadStory(self, bad_story_id, processed_stories_id, **kwargs):
+		ingester = self._makeIngester(FakeMediaCloud(10, bad=[bad_story_id]), **kwargs)
+		self._ingestAll(ingester)
+		self.assertEqual(self._storedIds(ingester), [1000+i for i in range(1, 11) if 1000+i != bad_story_id])
+		self.assertEqual(ingester.skipped_story_ids, set([bad_story_id]))
+		self.assertEqual(ingester.readSkippedStories(), [{'stories_id': bad_story_id,
+			'processed_stories_id': processed_stories_id, 'reason': 'unsuccessful download'}])
+
+	def testBadStoryFirstOnPage(self):
+		self._checkBadStory(1006, 6)
+
+	def testBadStoryMidPage(self):
+		self._checkBadStory(1003, 3)
+
+	def testBadStoryOffPage(self):
+		ingester = self._makeIngester(FakeMediaCloud(10, off_page=5000))
+		self._ingestAll(ingester)
+		self.assertEqual(self._storedIds(ingester), range(1001, 1011))
+		self.assertEqual(ingester.skipped_story_ids, set([5000]))
+		self.assertEqual(ingester.readSkippedStories(), [{'stories_id': 5000,
+			'processed_stories_id': None, 'reason': 'unsuccessful download'}])
+
+	def testBadStorySkippingExisting(self):
+		self._checkBadStory(1004, 4, skip_existing=True)
+
+	def testBadStoryAfterExisting(self):
+		ingester = self._makeIngester(FakeMediaCloud(10, bad=[1004]), skip_existing=True)
+		ingester.db.addStory({'stories_id': 1002, 'processed_stories_id': 2, 'guid': 'http://example.com/2'})
+		self._ingestAll(ingester, rows=10)
+		self.assertEqual(self._storedIds(ingester), [1001, 1002, 1003] + range(1005, 1011))
+		self.assertEqual(ingester.skipped_story_ids, set([1004]))
+
+	def testWorkerPoolExtraction(self):
+		api = FakeMediaCloud(12, no_html=[1004])
+		ingester = self._makeIngester(api, workers=3)
+		saved = ingester.processStories(api.storyList(rows=12, raw_1st_download=True))
+		self.assertTrue(ingester.extractor._pool is not None)
+		# saved in page order, each with its own links, and the story that failed left out
+		self.assertEqual([story['stories_id'] for story, data in saved], [1000+i for i in range(1, 13) if i != 4])
+		for story, data in saved:
+			self.assertEqual([link['href'] for link in data['story_links']], ['http://example.com/%d' % (story['stories_id'] - 999)])
+		self.assertEqual(self._storedIds(ingester), [story['stories_id'] for story, data in saved])
+		self.assertEqual(ingester.readSkippedStories(), [{'stories_id': 1004, 'processed_stories_id': 4, 'reason': 'no raw download'}])
+
+	def testPipelineStages(self):
+		ingester = self._makeIngester(FakeMediaCloud(10), queue_size=1, store_threads=2)
+		stats = self._ingestAll(ingester, rows=2)
+		self.assertEqual(self._storedIds(ingester), range(1001, 1011))
+		# fetching also counts the empty page that ends the run
+		self.assertEqual([(stats[name]['pages'], stats[name]['stories']) for name in MediaCloudIngester.STAGES],
+			[(6, 10), (5, 10), (5, 10)])
+		for name in MediaCloudIngester.STAGES:
+			self.assertTrue(stats[name]['max_queue_depth'] <= 1)
+
+	def testSkipExistingDownloadsOnlyMissing(self):
+		api = FakeMediaCloud(10)
+		ingester = self._makeIngester(api, skip_existing=True)
+		for story_id in [1002] + range(1006, 1011):
+			ingester.db.addStory({'stories_id': story_id, 'processed_stories_id': story_id - 1000, 'guid': 'http://example.com/%d' % story_id})
+		self._ingestAll(ingester)
+		self.assertEqual(self._storedIds(ingester), range(1001, 1011))
+		# pages are listed without raw downloads, then only the missing stories are downloaded
+		downloaded = []
+		for solr_filter, last_id, rows, raw_1st_download in api.calls:
+			if raw_1st_download:
+				downloaded += [int(story_id) for story_id in re.search(r'\+stories_id:\(([0-9 ]+)\)', solr_filter).group(1).split()]
+		self.assertEqual(downloaded, [1001, 1003, 1004, 1005])
+		# the second page was all there already, so it made no download request at all
+		self.assertEqual(len([call for call in api.calls if call[3]]), 1)
+
+	def testTelemetryReports(self):
+		reports = []
+		ingester = self._makeIngester(FakeMediaCloud(10, bad=[1003]), metrics_hook=reports.append, report_interval=0.01)
+		self._ingestAll(ingester)
+		deadline = time.time() + 5
+		while not reports and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertTrue(len(reports) > 0)
+		# close stops the reporter and sends a last report with the totals
+		ingester.close()
+		report_count = len(reports)
+		time.sleep(0.05)
+		self.assertEqual(len(reports), report_count)
+		report = reports[-1]
+		self.assertEqual((report['stories'], report['links']), (9, 9))
+		self.assertEqual(report['failures'], {'fetch: unsuccessful download': 1})
+		self.assertEqual(sorted(report['stage_seconds']), sorted(MediaCloudIngester.STAGES))
+		self.assertTrue(report['overall_stories_per_sec'] > 0)
+		self.assertTrue('9 stories' in format_snapshot(report))
+
+	def testFetchFailuresRaiseAfterStoringEarlierPages(self):
+		api = FakeMediaCloud(10, fail_after=5)
+		ingester = self._makeIngester(api)
+		self.assertRaises(IOError, self._ingestAll, ingester)
+		self.assertEqual(self._storedIds(ingester), range(1001, 1006))
+		self.assertEqual(ingester.checkpoint('*', '*').load()['last_id'], 5)
+		failed_calls = [call for call in api.calls if call[1] >= 5]
+		self.assertEqual(len(failed_calls), 1 + MediaCloudIngester.PAGE_RETRIES)
+
+	def testResumeFromCheckpoint(self):
+		api = FakeMediaCloud(10, fail_after=5)
+		ingester = self._makeIngester(api)
+		self.assertRaises(IOError, self._ingestAll, ingester)
+		ingester.close()
+		api.fail_after = None
+		api.calls = []
+		ingester = self._makeIngester(api)
+		stats = self._ingestAll(ingester)
+		self.assertEqual(self._storedIds(ingester), range(1001, 1011))
+		# only the stories after the checkpoint were fetched and extracted again
+		self.assertEqual(min(call[1] for call in api.calls), 5)
+		self.assertEqual(stats['extract']['stories'], 5)
+		self.assertEqual(stats['store']['stories'], 5)
+
+	def testTimeSeriesWindowProgress(self):
+		ingester = self._makeIngester(FakeMediaCloud(10))
+		progress = []
+		update_job = ingester.telemetry.updateJob
+		def record_progress(name, cursor, stories):
+			update_job(name, cursor, stories)
+			progress.append((name, format_snapshot(ingester.telemetry.snapshot())))
+		ingester.telemetry.updateJob = record_progress
+		ingester.time_series_ingest(datetime.date(2015, 1, 1), datetime.date(2015, 1, 1), window_days=1)
+		self.assertTrue(len(progress) > 0)
+		for name, line in progress:
+			self.assertEqual(name, 'window 2015-01-01 to 2015-01-01')
+		self.assertTrue(progress[-1][1].endswith('running window 2015-01-01 to 2015-01-01 at 10 with 10 stories'))
+		# finished windows are reported when they finish, not as running
+		self.assertEqual(ingester.telemetry.snapshot()['jobs'], {})
+
+class PageSizerTest(unittest.TestCase):
+
+	def testGrowsTowardTargetSeconds(self):
+		sizer = PageSizer(10, min_rows=1, max_rows=1000, target_seconds=10.0)
+		for i in range(20):
+			sizer.record(sizer.rows(), 0, sizer.rows() * 0.1)
+		self.assertTrue(95 <= sizer.rows() <= 100)
+
+	def testGrowsTowardTargetBytes(self):
+		sizer = PageSizer(10, min_rows=1, max_rows=1000, target_bytes=5000, target_seconds=10.0)
+		for i in range(20):
+			sizer.record(sizer.rows(), sizer.rows() * 100, 0.001)
+		self.assertTrue(45 <= sizer.rows() <= 50)
+
+	def testShrinksTowardTargets(self):
+		sizer = PageSizer(400, min_rows=1, max_rows=1000, target_seconds=10.0)
+		sizer.record(400, 0, 400.0)
+		self.assertEqual(sizer.rows(), 205)
+
+	def testAtMostDoubles(self):
+		sizer = PageSizer(10, min_rows=1, max_rows=1000, target_seconds=10.0)
+		sizer.record(10, 0, 0.01)
+		self.assertEqual(sizer.rows(), 20)
+
+	def testHalvesOnError(self):
+		sizer = PageSizer(40, min_rows=1, max_rows=1000)
+		sizer.recordError()
+		self.assertEqual(sizer.rows(), 20)
+
+	def testNoGrowthWhileFailing(self):
+		sizer = PageSizer(40, min_rows=1, max_rows=1000, target_seconds=10.0)
+		sizer.recordError()
+		sizer.recordError()
+		self.assertEqual(sizer.rows(), 10)
+		while sizer.error_rate * 0.8 > 0.2:
+			sizer.record(10, 0, 0.01)
+			self.assertEqual(sizer.rows(), 10)
+		sizer.record(10, 0, 0.01)
+		self.assertEqual(sizer.rows(), 20)
+
+	def testStaysWithinBounds(self):
+		sizer = PageSizer(40, min_rows=5, max_rows=60, target_seconds=10.0)
+		for i in range(5):
+			sizer.recordError()
+		self.assertEqual(sizer.rows(), 5)
+		for i in range(20):
+			sizer.record(sizer.rows(), 0, 0.01)
+		self.assertEqual(sizer.rows(), 60)
+		self.assertEqual(PageSizer(1000, max_rows=60).rows(), 60)
@@ -0,0 +1,28 @@
+import json, os, errno, tempfile
+
+class FileCheckpoint(object):
+    '''
+    Remembers a position (anything json can hold) in a small file.  Saves are atomic: the new
+    value goes to a temp file that is synced and then renamed over the old one, so a crash leaves
+    either the old position or the new one, never half of one.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self, default=None):
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return default
+
+    def save(self, value):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._path)), prefix='.checkpoint')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._path)
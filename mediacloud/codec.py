@@ -0,0 +1,122 @@
+import json, zlib
+
+class CompressedField(object):
+    '''
+    A story field value that is still compressed.  It only gets decompressed when someone reads it.
+    '''
+
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def decode(self):
+        return json.loads(zlib.decompress(self.data))
+
+class LazyStory(dict):
+    '''
+    A story whose compressed fields are decompressed the first time they are read.  Copying it
+    with dict(story) keeps the fields compressed, and saving it again doesn't recompress them.
+    '''
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, CompressedField):
+            value = value.decode()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def copy(self):
+        return LazyStory(self)
+
+    def items(self):
+        return [ (key, self[key]) for key in self ]
+
+    def iteritems(self):
+        return ( (key, self[key]) for key in self )
+
+    def values(self):
+        return [ self[key] for key in self ]
+
+    def itervalues(self):
+        return ( self[key] for key in self )
+
+class FieldCompressionCodec(object):
+    '''
+    Compresses the heavy fields of a story (as zlib'd json) when it is saved.  Turn it on with
+    StoryDatabase.setCodec(FieldCompressionCodec()).  The database can't see inside compressed
+    fields, so don't compress anything you query or aggregate on server-side.  Values smaller
+    than min_size bytes are left alone because they don't compress well.
+    '''
+
+    # not story_links, which the link graph queries aggregate on
+    DEFAULT_FIELDS = ['story_sentences', 'story_text']
+
+    def __init__(self, fields=None, level=6, min_size=256):
+        self.fields = list(fields) if fields is not None else list(self.DEFAULT_FIELDS)
+        self._level = level
+        self._min_size = min_size
+        self._raw_bytes = { field:0 for field in self.fields }
+        self._compressed_bytes = { field:0 for field in self.fields }
+
+    def encode(self, story, pack):
+        '''
+        Return a shallow copy of the story with its heavy fields compressed.  pack turns the
+        compressed bytes into something the backend can store.
+        '''
+        encoded = dict(story)
+        for field in self.fields:
+            value = encoded.get(field)
+            if value is None:
+                continue
+            if isinstance(value, CompressedField):
+                encoded[field] = pack(value.data)
+                continue
+            raw = json.dumps(value)
+            if len(raw) < self._min_size:
+                continue
+            data = zlib.compress(raw, self._level)
+            self._raw_bytes[field] += len(raw)
+            self._compressed_bytes[field] += len(data)
+            encoded[field] = pack(data)
+        return encoded
+
+    def decode(self, story, unpack):
+        '''
+        Wrap a story read from the backend so its compressed fields are decompressed on access.
+        unpack returns the compressed bytes from a stored value, or None if it isn't compressed.
+        '''
+        for field in self.fields:
+            if field in story:
+                data = unpack(story[field])
+                if data is not None:
+                    story[field] = CompressedField(data)
+        return LazyStory(story)
+
+    def compressionRatio(self):
+        compressed_bytes = sum(self._compressed_bytes.values())
+        if compressed_bytes == 0:
+            return 1.0
+        return float(sum(self._raw_bytes.values())) / compressed_bytes
+
+    def stats(self):
+        '''
+        Bytes in and out for each field this codec has compressed so far
+        '''
+        return { field: {
+                    'raw_bytes': self._raw_bytes[field],
+                    'compressed_bytes': self._compressed_bytes[field],
+                    'ratio': float(self._raw_bytes[field]) / self._compressed_bytes[field] if self._compressed_bytes[field] else 1.0
+                 } for field in self.fields }
@@ -0,0 +1,147 @@
+import json, zlib, struct, threading, Queue
+
+# A snapshot file is a header, then a run of zlib'd chunks of json stories (one per line, in
+# stories_id order), then a zlib'd json index listing each chunk's file offset, size, story count
+# and first/last stories_id, then a fixed-size footer pointing at the index.  The index lets a
+# restore split the chunks up across workers, or only read the chunks in a stories_id range.
+
+HEADER = 'MCSNAP1\n'
+FOOTER = struct.Struct('>Q8s')    # index offset, marker
+FOOTER_MARKER = 'MCSNAPIX'
+
+# fields that only mean something inside the database a story came from
+LOCAL_FIELDS = ['_id', '_change_seq', '_change_type']
+
+def exportSnapshot(db, path, chunk_size=1000, level=6, query=None):
+    '''
+    Stream every story in the StoryDatabase (or those matching the query) to a snapshot file.
+    Returns the snapshot's index.
+    '''
+    index = { 'story_count': 0, 'chunks': [] }
+    with open(path, 'wb') as f:
+        f.write(HEADER)
+        chunk = []
+        for story in db.scanStories(query, batch_size=chunk_size):
+            chunk.append(story)
+            if len(chunk) == chunk_size:
+                _writeChunk(f, chunk, level, index)
+                chunk = []
+        if len(chunk) > 0:
+            _writeChunk(f, chunk, level, index)
+        index_offset = f.tell()
+        f.write(zlib.compress(json.dumps(index), level))
+        f.write(FOOTER.pack(index_offset, FOOTER_MARKER))
+    return index
+
+def readSnapshotIndex(path):
+    '''
+    Return the index of a snapshot file, without reading any of the stories
+    '''
+    with open(path, 'rb') as f:
+        return _readIndex(f)
+
+def readSnapshotStories(path, start_after=None, end_at=None):
+    '''
+    Iterate over the stories in a snapshot file, optionally only those in a stories_id range
+    '''
+    with open(path, 'rb') as f:
+        for chunk in _chunksInRange(_readIndex(f), start_after, end_at):
+            for story in _readChunk(f, chunk, start_after, end_at):
+                yield story
+
+def importSnapshot(db, path, workers=4, make_db=None, start_after=None, end_at=None):
+    '''
+    Restore the stories in a snapshot file into the StoryDatabase through its bulk addStories
+    path, skipping any it already has.  workers threads decompress and parse chunks in parallel.
+    If make_db is given each worker also saves through its own database connection from it
+    (good for mongo); otherwise all the saving happens on db in this thread (needed for sqlite).
+    If saving fails the workers are stopped before the error is raised.  Returns the number
+    of stories saved.
+    '''
+    chunks = Queue.Queue()
+    for chunk in _chunksInRange(readSnapshotIndex(path), start_after, end_at):
+        chunks.put(chunk)
+    parsed = Queue.Queue(maxsize=workers*2)
+    saved_counts = []
+    errors = []
+    stop = threading.Event()
+    def work():
+        try:
+            worker_db = make_db() if make_db is not None else None
+            with open(path, 'rb') as f:
+                while not stop.is_set():
+                    try:
+                        chunk = chunks.get_nowait()
+                    except Queue.Empty:
+                        return
+                    stories = _readChunk(f, chunk, start_after, end_at)
+                    if worker_db is not None:
+                        saved_counts.append( worker_db.addStories(stories) )
+                    else:
+                        parsed.put(stories)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            parsed.put(None)
+    threads = [ threading.Thread(target=work) for i in range(workers) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    finished_workers = 0
+    # keep taking from parsed until every worker is done, even after an error, so none of them
+    # is left blocked on a full queue
+    while finished_workers < len(threads):
+        stories = parsed.get()
+        if stories is None:
+            finished_workers += 1
+        elif len(errors) == 0:
+            try:
+                saved_counts.append( db.addStories(stories) )
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return sum(saved_counts)
+
+def _writeChunk(f, stories, level, index):
+    lines = []
+    for story in stories:
+        lines.append( json.dumps( dict( (field, value) for field, value in story.iteritems() if field not in LOCAL_FIELDS ) ) )
+    data = zlib.compress('\n'.join(lines), level)
+    index['chunks'].append({
+        'offset': f.tell(),
+        'length': len(data),
+        'story_count': len(stories),
+        'first_stories_id': stories[0]['stories_id'],
+        'last_stories_id': stories[-1]['stories_id']
+    })
+    index['story_count'] += len(stories)
+    f.write(data)
+
+def _readIndex(f):
+    f.seek(-FOOTER.size, 2)
+    footer_offset = f.tell()
+    index_offset, marker = FOOTER.unpack(f.read(FOOTER.size))
+    if marker != FOOTER_MARKER:
+        raise ValueError('Not a story snapshot file (or it was cut short)')
+    f.seek(index_offset)
+    return json.loads(zlib.decompress(f.read(footer_offset - index_offset)))
+
+def _readChunk(f, chunk, start_after, end_at):
+    f.seek(chunk['offset'])
+    stories = [ json.loads(line) for line in zlib.decompress(f.read(chunk['length'])).split('\n') ]
+    if start_after is not None or end_at is not None:
+        stories = [ story for story in stories if _inRange(story['stories_id'], start_after, end_at) ]
+    return stories
+
+def _chunksInRange(index, start_after, end_at):
+    return [ chunk for chunk in index['chunks']
+             if (start_after is None or chunk['last_stories_id'] > start_after)
+             and (end_at is None or chunk['first_stories_id'] <= end_at) ]
+
+def _inRange(stories_id, start_after, end_at):
+    return (start_after is None or stories_id > start_after) and (end_at is None or stories_id <= end_at)
@@ -1,13 +1,163 @@
-import copy, logging
+import logging, json, os, re, bisect, base64, itertools, math, threading, Queue, time, uuid
+from codec import FieldCompressionCodec
+import snapshot
+
+_pub = None
+
+def _pubsub():
+    # import pubsub once, the first time we need it, instead of on every save
+    global _pub
+    if _pub is None:
+        from pubsub import pub
+        _pub = pub
+    return _pub
 
 class StoryDatabase(object):
 
     # callbacks you can register listeners against
     EVENT_PRE_STORY_SAVE = "preStorySave"
     EVENT_POST_STORY_SAVE = "postStorySave"
+    EVENT_STORIES_SAVED = "storiesSaved"    # once per addStories call, with db_stories and raw_stories lists
+
+    # marks a stored field value as compressed by the codec
+    COMPRESSED_FIELD_MARKER = '_zlib'
+
+    # where the change feed keeps a story's latest change, see setChangeFeed
+    CHANGE_SEQ_FIELD = '_change_seq'
+    CHANGE_TYPE_FIELD = '_change_type'
 
     def __init__(self):
         self._logger = logging.getLogger(__name__)
+        self._codec = None
+        self._event_queue = None
+        self._change_feed = False
+
+    def setCodec(self, codec):
+        '''
+        Opt in to compressing heavy story fields at rest (ie. with a FieldCompressionCodec).
+        Pass None to go back to saving stories as-is; already compressed stories still read fine
+        as long as a codec is set.
+        '''
+        self._codec = codec
+
+    def setChangeFeed(self, enabled=True):
+        '''
+        Opt in to keeping a change feed: every story added or updated from now on is stamped with
+        the next number in a sequence, so consumers can ask for only what changed since they last
+        looked (see changes and consumeChanges).  Turn it on for every connection that writes.
+        Any number of connections can write at once: a change is only handed out once every
+        lower number has been written (or given up on), so consumers never skip past one.
+        '''
+        self._change_feed = enabled
+        if enabled:
+            self._initializeChangeFeed()
+
+    def changes(self, since=0, batch_size=1000):
+        '''
+        Iterate over the stories changed after sequence number since, in order, as dicts with
+        seq, stories_id and type ('insert' or 'update').  A story that changed more than once only
+        shows up at its latest change.
+        '''
+        while True:
+            batch = self._changeBatch(since, batch_size)
+            if len(batch) == 0:
+                return
+            for change in batch:
+                yield change
+            since = batch[-1]['seq']
+
+    def consumeChanges(self, checkpoint, handle_changes, batch_size=1000):
+        '''
+        Pass every change since the checkpoint's position to handle_changes, a list of up to
+        batch_size at a time, saving the position after each list is handled.  If the consumer
+        dies part way through it starts again from the list it was on.  checkpoint is anything
+        with load(default) and save(value), like a mediacloud.checkpoint.FileCheckpoint.  Returns
+        the number of changes handled.
+        '''
+        since = checkpoint.load(0)
+        handled = 0
+        while True:
+            batch = self._changeBatch(since, batch_size)
+            if len(batch) == 0:
+                return handled
+            handle_changes(batch)
+            since = batch[-1]['seq']
+            checkpoint.save(since)
+            handled += len(batch)
+
+    def _stampChanges(self, stories, change_type):
+        if not self._change_feed:
+            return
+        first_seq = self._nextChangeSeqs(len(stories))
+        for i, story in enumerate(stories):
+            story[self.CHANGE_SEQ_FIELD] = first_seq + i
+            story[self.CHANGE_TYPE_FIELD] = change_type
+
+    def _changeFromStory(self, story):
+        return { 'seq': story[self.CHANGE_SEQ_FIELD], 'stories_id': story['stories_id'], 'type': story[self.CHANGE_TYPE_FIELD] }
+
+    def _initializeChangeFeed(self):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def _nextChangeSeqs(self, count):
+        '''
+        Reserve count sequence numbers and return the first one
+        '''
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def _releaseChangeSeqs(self):
+        '''
+        Called once the stories numbered by the last _nextChangeSeqs are saved, or failed to save
+        '''
+        return
+
+    def _changeBatch(self, since, batch_size):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def setAsyncEvents(self, enabled=True):
+        '''
+        Deliver post-save events to listeners on a background thread, so slow listeners don't hold
+        up saving.  Pre-save events are always sent right away, because listeners can change the
+        story before it is saved.  Call flushEvents() to wait until everything is delivered.
+        '''
+        if enabled and self._event_queue is None:
+            self._event_queue = Queue.Queue()
+            worker = threading.Thread(target=self._deliverEvents, args=(self._event_queue,))
+            worker.daemon = True
+            worker.start()
+        elif not enabled and self._event_queue is not None:
+            self.flushEvents()
+            self._event_queue.put(None)
+            self._event_queue = None
+
+    def flushEvents(self):
+        '''
+        Wait for any queued events to reach their listeners
+        '''
+        if self._event_queue is not None:
+            self._event_queue.join()
+
+    def _deliverEvents(self, event_queue):
+        while True:
+            item = event_queue.get()
+            try:
+                if item is None:
+                    return
+                _pubsub().sendMessage(item[0], **item[1])
+            except Exception:
+                self._logger.exception('Event listener failed on %s', item[0])
+            finally:
+                event_queue.task_done()
+
+    def _hasListeners(self, event):
+        topic = _pubsub().getDefaultTopicMgr().getTopic(event, okIfNone=True)
+        return topic is not None and topic.hasListeners()
+
+    def _sendEvent(self, event, kwargs, deferrable=False):
+        if deferrable and self._event_queue is not None:
+            self._event_queue.put( (event, kwargs) )
+        else:
+            _pubsub().sendMessage(event, **kwargs)
 
     def connect(self, db_name, host, port, username, password):
         raise NotImplementedError("Subclasses should implement this!")
@@ -20,7 +170,6 @@ class StoryDatabase(object):
         Save a story based on it's sentences to the database.  Return success or failure boolean.
         This is pairs well with mediacloud.sentencesMatchingByStory(...).  This saves or updates.
         '''
-        from pubsub import pub
         # if nothing to save, bail
         if len(story_sentences)==0:
             return False
@@ -41,17 +190,28 @@ class StoryDatabase(object):
                 'story_sentences': sentences_by_number,
                 'story_sentences_count': len(sentences_by_number)
             }
-            self._saveStory( dict(story_attributes.items() + extra_attributes.items()) )
+            story_attributes.update(extra_attributes)
+            try:
+                self._stampChanges([story_attributes], 'insert')
+                self._saveStory( self._encodeStory(story_attributes) )
+            finally:
+                self._releaseChangeSeqs()
         else:
             # if the story exists already, add any new sentences
-            story = self.getStory(stories_id)
-            all_sentences = dict(story['story_sentences'].items() + sentences_by_number.items())
+            story = self.getStory(stories_id, fields=['story_sentences'])
+            all_sentences = dict(story['story_sentences'])
+            all_sentences.update(sentences_by_number)
             story_attributes = {
                 'stories_id': stories_id,
                 'story_sentences': all_sentences,
                 'story_sentences_count': len(all_sentences)
             }
-            self._updateStory( dict(story_attributes.items() + extra_attributes.items()) )
+            story_attributes.update(extra_attributes)
+            try:
+                self._stampChanges([story_attributes], 'update')
+                self._updateStory( self._encodeStory(story_attributes) )
+            finally:
+                self._releaseChangeSeqs()
         return True
 
     def updateStory(self, story, extra_attributes={}):
@@ -59,38 +219,107 @@ class StoryDatabase(object):
         if not self.storyExists(story['stories_id']):
             return self.addStory(story,extra_attributes)
         else:
-            from pubsub import pub
-            story_to_save = copy.deepcopy( story )
-            story_to_save = dict(story_to_save.items() + extra_attributes.items())
+            story_to_save = self._prepareStory(story, extra_attributes)
             story_to_save['stories_id'] = story['stories_id']
-            if 'story_sentences' in story:
-                story_to_save['story_sentences_count'] = len(story['story_sentences'])
-            pub.sendMessage(self.EVENT_PRE_STORY_SAVE, db_story=story_to_save, raw_story=story)
-            self._updateStory(story_to_save)
-            saved_story = self.getStory( story['stories_id'] )
-            pub.sendMessage(self.EVENT_POST_STORY_SAVE, db_story=saved_story, raw_story=story)
-            self._logger.debug('Updated '+str(story['stories_id']))
+            if self._hasListeners(self.EVENT_PRE_STORY_SAVE):
+                self._sendEvent(self.EVENT_PRE_STORY_SAVE, {'db_story': story_to_save, 'raw_story': story})
+            try:
+                self._stampChanges([story_to_save], 'update')
+                self._updateStory( self._encodeStory(story_to_save) )
+            finally:
+                self._releaseChangeSeqs()
+            if self._hasListeners(self.EVENT_POST_STORY_SAVE):
+                # only read the story back if someone wants to see it
+                saved_story = self.getStory( story['stories_id'] )
+                self._sendEvent(self.EVENT_POST_STORY_SAVE, {'db_story': saved_story, 'raw_story': story}, deferrable=True)
+            self._logger.debug('Updated %s', story['stories_id'])
 
     def addStory(self, story, extra_attributes={}):
         ''' 
         Save a story (python object) to the database. This does NOT update stories.
         Return success or failure boolean.
         '''
-        from pubsub import pub
         if self.storyExists(story['stories_id']):
-            self._logger.warn('Not saving '+str(story['stories_id'])+' - already exists')
+            self._logger.warn('Not saving %s - already exists', story['stories_id'])
             return False
-        story_to_save = copy.deepcopy( story )
-        story_to_save = dict(story_to_save.items() + extra_attributes.items())
+        story_to_save = self._prepareNewStory(story, extra_attributes)
+        if self._hasListeners(self.EVENT_PRE_STORY_SAVE):
+            self._sendEvent(self.EVENT_PRE_STORY_SAVE, {'db_story': story_to_save, 'raw_story': story})
+        try:
+            self._stampChanges([story_to_save], 'insert')
+            self._saveStory( self._encodeStory(story_to_save) )
+        finally:
+            self._releaseChangeSeqs()
+        if self._hasListeners(self.EVENT_POST_STORY_SAVE):
+            # only read the story back if someone wants to see it
+            saved_story = self.getStory( story['stories_id'] )
+            self._sendEvent(self.EVENT_POST_STORY_SAVE, {'db_story': saved_story, 'raw_story': story}, deferrable=True)
+        self._logger.debug('Saved %s', story['stories_id'])
+        return True
+
+    def addStories(self, stories, extra_attributes={}):
+        '''
+        Save a batch of new stories in one go, skipping any that already exist.  Each story gets
+        the same events as in addStory (except the post-save event gets the story as it was
+        saved, instead of reading it back), then one EVENT_STORIES_SAVED for the whole batch.
+        Return how many stories were saved.
+        '''
+        existing_ids = self._existingStoryIds( [ story['stories_id'] for story in stories ] )
+        send_pre_save = self._hasListeners(self.EVENT_PRE_STORY_SAVE)
+        stories_to_save = []
+        raw_stories = []
+        for story in stories:
+            if story['stories_id'] in existing_ids:
+                self._logger.warn('Not saving %s - already exists', story['stories_id'])
+                continue
+            existing_ids.add(story['stories_id'])
+            story_to_save = self._prepareNewStory(story, extra_attributes)
+            if send_pre_save:
+                self._sendEvent(self.EVENT_PRE_STORY_SAVE, {'db_story': story_to_save, 'raw_story': story})
+            stories_to_save.append(story_to_save)
+            raw_stories.append(story)
+        if len(stories_to_save) == 0:
+            return 0
+        try:
+            self._stampChanges(stories_to_save, 'insert')
+            self._saveStories( [ self._encodeStory(story) for story in stories_to_save ] )
+        finally:
+            self._releaseChangeSeqs()
+        if self._hasListeners(self.EVENT_POST_STORY_SAVE):
+            for db_story, raw_story in zip(stories_to_save, raw_stories):
+                self._sendEvent(self.EVENT_POST_STORY_SAVE, {'db_story': db_story, 'raw_story': raw_story}, deferrable=True)
+        if self._hasListeners(self.EVENT_STORIES_SAVED):
+            self._sendEvent(self.EVENT_STORIES_SAVED, {'db_stories': stories_to_save, 'raw_stories': raw_stories}, deferrable=True)
+        self._logger.debug('Saved %d stories', len(stories_to_save))
+        return len(stories_to_save)
+
+    def _prepareNewStory(self, story, extra_attributes):
+        story_to_save = self._prepareStory(story, extra_attributes)
         story_to_save['_stories_id'] = story['stories_id']
+        return story_to_save
+
+    def _prepareStory(self, story, extra_attributes):
+        # A shallow overlay: the top-level dict is new, but big nested values (sentences, links,
+        # raw html) are shared with the caller's story instead of copied.  Pre-save listeners
+        # should replace nested values rather than change them in place.
+        story_to_save = dict(story)
+        story_to_save.update(extra_attributes)
         if 'story_sentences' in story:
             story_to_save['story_sentences_count'] = len(story['story_sentences'])
-        pub.sendMessage(self.EVENT_PRE_STORY_SAVE, db_story=story_to_save, raw_story=story)
-        self._saveStory( story_to_save )
-        saved_story = self.getStory( story['stories_id'] )
-        pub.sendMessage(self.EVENT_POST_STORY_SAVE, db_story=saved_story, raw_story=story)
-        self._logger.debug('Saved '+str(story['stories_id']))
-        return True
+        return story_to_save
+
+    def existingStoryIds(self, story_ids):
+        '''
+        Return the set of these story ids that are already in the database, checked in bulk
+        rather than one storyExists query per story
+        '''
+        return self._existingStoryIds(list(story_ids))
+
+    def _existingStoryIds(self, story_ids):
+        '''
+        Return the set of these story ids that are already in the database
+        '''
+        return set( story_id for story_id in story_ids if self.storyExists(story_id) )
 
     def _updateStory(self, story_attributes):
         raise NotImplementedError("Subclasses should implement this!")
@@ -98,10 +327,23 @@ class StoryDatabase(object):
     def _saveStory(self, story_attributes):
         raise NotImplementedError("Subclasses should implement this!")
 
-    def getStory(self, story_id):
+    def _saveStories(self, stories):
+        for story in stories:
+            self._saveStory(story)
+
+    def getStory(self, story_id, fields=None):
+        '''
+        Return the story with this id, or None.  Pass a list of field names as fields to only get
+        those back (plus _id), which saves a lot when stories have big sentences or links.
+        '''
         raise NotImplementedError("Subclasses should implement this!")
 
-    def storyCount(self):
+    def storyCount(self, exact=True):
+        '''
+        How many stories are saved.  With exact=False the backend may answer from a counter it
+        keeps up to date as stories are saved, which stays fast however big the database gets
+        but can drift if stories are written or removed behind this class's back.
+        '''
         raise NotImplementedError("Subclasses should implement this!")        
 
     def createDatabase(self, db_name):
@@ -110,17 +352,179 @@ class StoryDatabase(object):
     def deleteDatabase(self, db_name):
         raise NotImplementedError("Subclasses should implement this!")
         
-    def getMaxStoryId(self):
+    def getMaxStoryId(self, exact=True):
+        '''
+        The biggest stories_id saved, or 0 if there aren't any.  exact works like in storyCount.
+        '''
         raise NotImplementedError("Subclasses should implement this!")
 
     def initialize(self):
         raise NotImplementedError("Subclasses should implement this!")
 
+    def scanStories(self, query=None, fields=None, batch_size=1000, start_after=None, end_at=None):
+        '''
+        Iterate over all the stories matching the query in stories_id order, fetching batch_size
+        stories at a time so memory stays flat however big the database is.  Every batch is a
+        fresh query that picks up after the last stories_id seen, so there is no long-lived
+        cursor to time out.  To resume an interrupted scan, pass the last stories_id you handled
+        as start_after.  end_at stops the scan after that stories_id (see storyIdRanges).
+        MongoStoryDatabase takes any mongo query.  SqliteStoryDatabase and MemoryStoryDatabase
+        only match fields equal to values, like {'media_id': 1}, and raise ValueError for
+        operators like {'$regex': ...} or {'$or': [...]}.
+        '''
+        query = query or {}
+        if fields is not None and 'stories_id' not in fields:
+            fields = list(fields) + ['stories_id']
+        while True:
+            batch = self._storyBatch(query, fields, start_after, end_at, batch_size)
+            if len(batch) == 0:
+                return
+            for story in batch:
+                yield story
+            start_after = batch[-1]['stories_id']
+
+    def storyIdRanges(self, parts):
+        '''
+        Split the stories into parts stories_id ranges of about equal width, as a list of
+        (start_after, end_at) pairs for scanStories.  The first and last ranges are open-ended,
+        so together they always cover every story (including any with non-numeric ids).
+        '''
+        bounds = self._numericStoryIdBounds()
+        if parts <= 1 or bounds is None or bounds[0] == bounds[1]:
+            return [(None, None)]
+        min_id, max_id = bounds
+        step = int(math.ceil( (max_id - min_id + 1) / float(parts) ))
+        edges = [None] + [ int(min_id) - 1 + step*i for i in range(1, parts) ] + [None]
+        return zip(edges[:-1], edges[1:])
+
+    def exportSnapshot(self, path, chunk_size=1000, query=None):
+        '''
+        Stream all the stories (or those matching the query) to a compressed, chunked snapshot
+        file that importSnapshot can restore from.  Returns the snapshot's index.
+        '''
+        return snapshot.exportSnapshot(self, path, chunk_size, query=query)
+
+    def importSnapshot(self, path, workers=4, make_db=None, start_after=None, end_at=None):
+        '''
+        Restore the stories from a snapshot file through addStories, skipping ones we already
+        have, with workers threads reading chunks in parallel.  Pass make_db to have each worker
+        save through its own connection too (see mediacloud.snapshot.importSnapshot).  Returns
+        the number of stories restored.
+        '''
+        return snapshot.importSnapshot(self, path, workers, make_db, start_after, end_at)
+
+    def _checkEqualityQuery(self, query):
+        # for databases that can only match fields equal to values
+        for field, value in query.iteritems():
+            if field.startswith('$') or (isinstance(value, dict) and any(key.startswith('$') for key in value)):
+                raise ValueError('%s only supports queries matching fields to values, not "%s"' % (self.__class__.__name__, field))
+
+    def _storyBatch(self, query, fields, start_after, end_at, batch_size):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def _numericStoryIdBounds(self):
+        raise NotImplementedError("Subclasses should implement this!")
+
+    def _encodeStory(self, story):
+        if self._codec is None:
+            return story
+        return self._codec.encode(story, self._packCompressedField)
+
+    def _decodeStory(self, story):
+        if self._codec is None or story is None:
+            return story
+        return self._codec.decode(story, self._unpackCompressedField)
+
+    def _packCompressedField(self, data):
+        return { self.COMPRESSED_FIELD_MARKER: data }
+
+    def _unpackCompressedField(self, value):
+        if isinstance(value, dict) and self.COMPRESSED_FIELD_MARKER in value:
+            return value[self.COMPRESSED_FIELD_MARKER]
+        return None
+
+    def _codecFields(self, fields):
+        # compressed fields can only be fetched whole, not by sub-field
+        if self._codec is None or fields is None:
+            return fields
+        codec_fields = []
+        for field in fields:
+            top_field = field.split('.')[0]
+            if top_field in self._codec.fields:
+                field = top_field
+            if field not in codec_fields:
+                codec_fields.append(field)
+        return codec_fields
+
+    def _projectStory(self, story, fields):
+        if fields is None:
+            return story
+        projected = { field:story[field] for field in fields if field in story }
+        if '_id' in story:
+            projected['_id'] = story['_id']
+        return projected
+
+def parallelScan(make_db, handle_story, parts=4, query=None, fields=None, batch_size=1000):
+    '''
+    Scan all the stories matching the query with one thread per stories_id range.  make_db is
+    called in each thread to open its own database connection.  MemoryStoryDatabase has no
+    locking, so only hand back one shared one if nothing writes to it during the scan.
+    handle_story is called with every story (from several threads at once, so it has to be
+    thread-safe).  Returns the number of stories scanned.
+    '''
+    ranges = make_db().storyIdRanges(parts)
+    counts = []
+    errors = []
+    def scanRange(start_after, end_at):
+        try:
+            count = 0
+            for story in make_db().scanStories(query, fields, batch_size, start_after, end_at):
+                handle_story(story)
+                count += 1
+            counts.append(count)
+        except Exception as e:
+            errors.append(e)
+    threads = [ threading.Thread(target=scanRange, args=id_range) for id_range in ranges ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return sum(counts)
+
 class MongoStoryDatabase(StoryDatabase):
 
-    def __init__(self, db_name=None, host='127.0.0.1', port=27017, username=None, password=None):
+    # ways to split the stories across collections, see __init__
+    PARTITION_BY_MONTH = 'month'
+    PARTITION_BY_MEDIA = 'media'
+
+    STORIES_COLLECTION = 'stories'
+    PARTITION_PREFIX = 'stories_'
+    UNDATED_PARTITION = 'stories_undated'
+    # maps stories_id to partition, so lookups by id don't have to hit every partition
+    PARTITION_ROUTES_COLLECTION = 'story_partitions'
+    COUNTERS_COLLECTION = 'counters'
+    STORY_STATS_COUNTER = 'story_stats'
+    # how long a reserved change number holds back the change feed before its writer is assumed dead
+    CHANGE_RESERVATION_TIMEOUT = 300
+
+    def __init__(self, db_name=None, host='127.0.0.1', port=27017, username=None, password=None,
+                 partition_by=None, media_partitions=16):
+        '''
+        By default all the stories go in one "stories" collection.  Set partition_by to
+        PARTITION_BY_MONTH to keep one collection per publish month (so old months can be dropped
+        cheaply with dropPartitionsBefore), or to PARTITION_BY_MEDIA to spread stories over
+        media_partitions collections by media_id.  Always open a partitioned database with the
+        same settings you created it with.
+        '''
         super(MongoStoryDatabase, self).__init__()
         import pymongo
+        if partition_by not in (None, self.PARTITION_BY_MONTH, self.PARTITION_BY_MEDIA):
+            raise ValueError('Unknown partition_by "%s"' % partition_by)
+        self._partition_by = partition_by
+        self._media_partitions = media_partitions
+        self._change_reservations = threading.local()
         self._server = pymongo.MongoClient(host, port)
         if db_name is not None:
             self.selectDatabase(db_name)
@@ -130,44 +534,726 @@ class MongoStoryDatabase(StoryDatabase):
 
     def selectDatabase(self, db_name):
         self._db = self._server[db_name]
+        self._indexed_partitions = set()
+        self._story_stats_checked = False
+        if self._partition_by is not None:
+            self.initialize()
 
     def deleteDatabase(self, ignored):
-        self._db.drop_collection('stories')
-
-    def storyCount(self):
-        self._db.stories.count();
+        for name in self.partitionNames():
+            self._db.drop_collection(name)
+        self._db.drop_collection(self.PARTITION_ROUTES_COLLECTION)
+        self._db[self.COUNTERS_COLLECTION].remove( { "_id": self.STORY_STATS_COUNTER } )
+        self._indexed_partitions = set()
+        self._story_stats_checked = False
 
     def storyExists(self, story_id):
-        story = self.getStory(story_id)
+        if self._partition_by is not None:
+            return self._db[self.PARTITION_ROUTES_COLLECTION].find_one( { "stories_id": story_id }, ['_id'] ) != None
+        story = self.getStory(story_id, fields=['_id'])
         return story != None
 
     def _updateStory(self, story_attributes):
-        story = self.getStory(story_attributes['stories_id'])
+        collection = self._collectionForStoryId(story_attributes['stories_id'])
+        story = collection.find_one( { "stories_id": story_attributes['stories_id'] }, ['_id'] )
         story_attributes['_id'] = story['_id']
-        story_id = self._db.stories.save(story_attributes)
-        story = self.getStory(story_attributes['stories_id'])
-        return story
+        new_collection = collection
+        if self._routingField() in story_attributes:
+            new_collection = self._collectionForStory(story_attributes)
+        if new_collection.name != collection.name:
+            # the story belongs in another partition now (ie. its publish_date changed)
+            new_collection.save(story_attributes)
+            collection.remove( { "_id": story['_id'] } )
+            self._db[self.PARTITION_ROUTES_COLLECTION].update( { "stories_id": story_attributes['stories_id'] },
+                { "$set": { "partition": new_collection.name } } )
+        else:
+            collection.save(story_attributes)
 
     def _saveStory(self, story_attributes):
-        story_db_id = self._db.stories.insert(story_attributes)
-        story = self.getStory(story_attributes['stories_id'])
-        return story
+        self._checkStoryStats()
+        collection = self._collectionForStory(story_attributes)
+        story_db_id = collection.insert(story_attributes)
+        if self._partition_by is not None:
+            self._db[self.PARTITION_ROUTES_COLLECTION].insert( { "stories_id": story_attributes['stories_id'], "partition": collection.name } )
+        self._countNewStories([story_attributes])
+
+    def _checkStoryStats(self):
+        # a database from before the totals were kept has to have its existing stories counted
+        # before the first new one, or the $inc in _countNewStories would start them from zero
+        if not self._story_stats_checked:
+            self._storyStats()
+            self._story_stats_checked = True
+
+    def _countNewStories(self, stories):
+        # keep up the totals storyCount and getMaxStoryId read when exact=False
+        self._db[self.COUNTERS_COLLECTION].update( { "_id": self.STORY_STATS_COUNTER },
+            { "$inc": { "count": len(stories) }, "$max": { "max_stories_id": max(story['stories_id'] for story in stories) } },
+            upsert=True )
+
+    def _saveStories(self, stories):
+        self._checkStoryStats()
+        # one insert per collection instead of one per story
+        stories_by_collection = {}
+        for story in stories:
+            stories_by_collection.setdefault(self._collectionForStory(story).name, []).append(story)
+        for name, collection_stories in stories_by_collection.iteritems():
+            self._db[name].insert(collection_stories)
+            if self._partition_by is not None:
+                self._db[self.PARTITION_ROUTES_COLLECTION].insert( [ { "stories_id": story['stories_id'], "partition": name }
+                                                                     for story in collection_stories ] )
+        self._countNewStories(stories)
 
-    def getStory(self, story_id):
-        stories = self._db.stories.find( { "stories_id": story_id } ).limit(1)
-        if stories.count()==0:
+    def _existingStoryIds(self, story_ids):
+        collection = self._db[self.STORIES_COLLECTION if self._partition_by is None else self.PARTITION_ROUTES_COLLECTION]
+        return set( story['stories_id'] for story in collection.find( { "stories_id": { "$in": story_ids } }, ['stories_id'] ) )
+
+    def getStory(self, story_id, fields=None):
+        collection = self._collectionForStoryId(story_id)
+        if collection is None:
             return None
-        return stories.next()
+        return self._decodeStory( collection.find_one( { "stories_id": story_id }, self._codecFields(fields) ) )
+
+    def findStories(self, query=None, fields=None):
+        '''
+        Iterate over all the stories matching a mongo query.  On a partitioned database this only
+        queries the partitions that could hold matches (by media_id, or by publish_date range),
+        one after the other.
+        '''
+        query = query or {}
+        fields = self._codecFields(fields)
+        partitions = self._partitionsForQuery(query)
+        if len(partitions) == 1:
+            stories = self._db[partitions[0]].find(query, fields)
+        else:
+            stories = itertools.chain.from_iterable( self._db[name].find(query, fields) for name in partitions )
+        if self._codec is None:
+            return stories
+        return itertools.imap(self._decodeStory, stories)
+
+    def partitionNames(self):
+        '''
+        The names of all the collections holding stories, in order
+        '''
+        if self._partition_by is None:
+            return [self.STORIES_COLLECTION]
+        return sorted( name for name in self._db.collection_names() if name.startswith(self.PARTITION_PREFIX) )
+
+    def dropPartition(self, name):
+        '''
+        Throw away all the stories in one partition
+        '''
+        self._db.drop_collection(name)
+        self._db[self.PARTITION_ROUTES_COLLECTION].remove( { "partition": name } )
+        self._indexed_partitions.discard(name)
+        self.refreshStoryStats()
+
+    def dropPartitionsBefore(self, date):
+        '''
+        When partitioned by month, throw away every month before the one the date is in.  Returns
+        the names of the partitions that were dropped.
+        '''
+        if self._partition_by != self.PARTITION_BY_MONTH:
+            raise ValueError('Can only drop partitions by date when partitioned by month')
+        cutoff = self._partitionName( { "publish_date": date } )
+        expired = [ name for name in self.partitionNames() if name != self.UNDATED_PARTITION and name < cutoff ]
+        for name in expired:
+            self.dropPartition(name)
+        return expired
 
-    def getMaxStoryId(self):
-        max_story_id = 0
-        if self._db.stories.count() > 0 :
-            max_story_id = self._db.stories.find().sort("stories_id",-1)[0]['stories_id']
-        return int(max_story_id)
+    def _routingField(self):
+        # the story field that picks its partition; an update without it leaves the story where it is
+        if self._partition_by == self.PARTITION_BY_MONTH:
+            return 'publish_date'
+        elif self._partition_by == self.PARTITION_BY_MEDIA:
+            return 'media_id'
+        return None
+
+    def _partitionName(self, story):
+        if self._partition_by == self.PARTITION_BY_MONTH:
+            publish_date = story.get('publish_date')
+            if hasattr(publish_date, 'strftime'):
+                return self.PARTITION_PREFIX + publish_date.strftime('%Y_%m')
+            match = re.match(r'(\d{4})-(\d{2})', publish_date) if isinstance(publish_date, basestring) else None
+            if match is None:
+                return self.UNDATED_PARTITION
+            return self.PARTITION_PREFIX + '_'.join(match.groups())
+        elif self._partition_by == self.PARTITION_BY_MEDIA:
+            if story.get('media_id') is None:
+                return self.PARTITION_PREFIX + 'media_none'
+            return self.PARTITION_PREFIX + 'media_%d' % (int(story['media_id']) % self._media_partitions)
+        return self.STORIES_COLLECTION
+
+    def _partitionsForQuery(self, query):
+        partitions = self.partitionNames()
+        if self._partition_by == self.PARTITION_BY_MEDIA and isinstance(query.get('media_id'), (int, long)):
+            return [ name for name in partitions if name == self._partitionName(query) ]
+        if self._partition_by == self.PARTITION_BY_MONTH and isinstance(query.get('publish_date'), dict):
+            date_range = query['publish_date']
+            first = self._partitionName( { "publish_date": date_range.get('$gte', date_range.get('$gt')) } )
+            last = self._partitionName( { "publish_date": date_range.get('$lte', date_range.get('$lt')) } )
+            return [ name for name in partitions if name != self.UNDATED_PARTITION
+                     and (first == self.UNDATED_PARTITION or name >= first)
+                     and (last == self.UNDATED_PARTITION or name <= last) ]
+        return partitions
+
+    def _collectionForStory(self, story):
+        name = self._partitionName(story)
+        if self._partition_by is not None:
+            self._indexStoryIds(name)
+        return self._db[name]
+
+    def _indexStoryIds(self, name):
+        if name not in self._indexed_partitions:
+            self._db[name].create_index('stories_id')
+            if self._change_feed:
+                self._db[name].create_index(self.CHANGE_SEQ_FIELD, sparse=True)
+            self._indexed_partitions.add(name)
+
+    def _initializeChangeFeed(self):
+        self._indexed_partitions = set()
+        for name in self.partitionNames():
+            self._indexStoryIds(name)
+
+    def _nextChangeSeqs(self, count):
+        # other connections can write higher numbers before this one writes its stories, so the
+        # reservation is listed in the counter until _releaseChangeSeqs, to hold back _changeBatch
+        token = uuid.uuid4().hex
+        counters = self._db[self.COUNTERS_COLLECTION]
+        counter = counters.find_and_modify( { "_id": self.CHANGE_SEQ_FIELD },
+            { "$inc": { "seq": count }, "$set": { "pending." + token: { "at": time.time() } } }, upsert=True, new=True )
+        first_seq = counter['seq'] - count + 1
+        counters.update( { "_id": self.CHANGE_SEQ_FIELD }, { "$set": { "pending." + token + ".first": first_seq } } )
+        self._change_reservations.token = token
+        return first_seq
+
+    def _releaseChangeSeqs(self):
+        token = getattr(self._change_reservations, 'token', None)
+        if token is not None:
+            self._change_reservations.token = None
+            self._db[self.COUNTERS_COLLECTION].update( { "_id": self.CHANGE_SEQ_FIELD }, { "$unset": { "pending." + token: "" } } )
+
+    def _settledChangeSeq(self):
+        # the highest change number below every reservation still being written
+        counter = self._db[self.COUNTERS_COLLECTION].find_one( { "_id": self.CHANGE_SEQ_FIELD } )
+        if counter is None:
+            return 0
+        live_after = time.time() - self.CHANGE_RESERVATION_TIMEOUT
+        # a reservation without its first number yet could be for anything up to the counter
+        pending = [ reservation.get('first', 0) for reservation in counter.get('pending', {}).values()
+                    if reservation['at'] > live_after ]
+        return min(pending) - 1 if pending else counter['seq']
+
+    def _changeBatch(self, since, batch_size):
+        settled_seq = self._settledChangeSeq()
+        if settled_seq <= since:
+            return []
+        batch = []
+        for name in self.partitionNames():
+            batch += self._db[name].find( { self.CHANGE_SEQ_FIELD: { "$gt": since, "$lte": settled_seq } },
+                ['stories_id', self.CHANGE_SEQ_FIELD, self.CHANGE_TYPE_FIELD] ).sort(self.CHANGE_SEQ_FIELD, 1).limit(batch_size)
+        batch = sorted(batch, key=lambda story: story[self.CHANGE_SEQ_FIELD])[:batch_size]
+        return [ self._changeFromStory(story) for story in batch ]
+
+    def _storyBatch(self, query, fields, start_after, end_at, batch_size):
+        batch = self._storyBatchFromPartitions(query, fields, start_after, end_at, batch_size)
+        if len(batch) == 0 and isinstance(start_after, (int, long, float)) and end_at is None:
+            # mongo only compares numbers to numbers, so carry on with any string ids
+            batch = self._storyBatchFromPartitions(query, fields, u'', end_at, batch_size)
+        return batch
+
+    def _storyBatchFromPartitions(self, query, fields, start_after, end_at, batch_size):
+        id_range = {}
+        if start_after is not None:
+            id_range['$gt'] = start_after
+        if end_at is not None:
+            id_range['$lte'] = end_at
+        if len(id_range) > 0:
+            query = { '$and': [query, { "stories_id": id_range }] } if 'stories_id' in query else dict(query, stories_id=id_range)
+        batch = []
+        for name in self._partitionsForQuery(query):
+            self._indexStoryIds(name)
+            batch += self._db[name].find(query, self._codecFields(fields)).sort("stories_id", 1).limit(batch_size)
+        if self._partition_by is not None:
+            batch = sorted(batch, key=lambda story: story['stories_id'])[:batch_size]
+        return [ self._decodeStory(story) for story in batch ]
+
+    def _numericStoryIdBounds(self):
+        # on a partitioned database the routes collection has every stories_id
+        collection = self._db[self.STORIES_COLLECTION if self._partition_by is None else self.PARTITION_ROUTES_COLLECTION]
+        numeric = { "stories_id": { "$gte": float('-inf') } }   # only matches numbers
+        first = list(collection.find(numeric, ['stories_id']).sort("stories_id", 1).limit(1))
+        if len(first) == 0:
+            return None
+        last = collection.find(numeric, ['stories_id']).sort("stories_id", -1).limit(1)[0]
+        return first[0]['stories_id'], last['stories_id']
+
+    def _collectionForStoryId(self, story_id):
+        if self._partition_by is None:
+            return self._db[self.STORIES_COLLECTION]
+        route = self._db[self.PARTITION_ROUTES_COLLECTION].find_one( { "stories_id": story_id }, ['partition'] )
+        if route is None:
+            return None
+        return self._db[route['partition']]
+
+    def _packCompressedField(self, data):
+        from bson.binary import Binary
+        return { self.COMPRESSED_FIELD_MARKER: Binary(data) }
+
+    def _unpackCompressedField(self, value):
+        data = super(MongoStoryDatabase, self)._unpackCompressedField(value)
+        return None if data is None else str(data)
+
+    def getMaxStoryId(self, exact=True):
+        if not exact:
+            return int(self._storyStats()['max_stories_id'])
+        # on a partitioned database the routes collection has every stories_id
+        if self._partition_by is None:
+            self._indexStoryIds(self.STORIES_COLLECTION)
+        collection = self._db[self.STORIES_COLLECTION if self._partition_by is None else self.PARTITION_ROUTES_COLLECTION]
+        # read straight off the end of the stories_id index
+        newest = list(collection.find({}, { "stories_id": 1, "_id": 0 }).sort("stories_id", -1).limit(1))
+        return int(newest[0]['stories_id']) if len(newest) > 0 else 0
+
+    def refreshStoryStats(self):
+        '''
+        Recount the stories and save the totals storyCount and getMaxStoryId read when
+        exact=False.  Saving stories through this class keeps the totals up to date, so you only
+        need this after stories were added or removed some other way.  Returns the new totals.
+        '''
+        stats = { "count": self.storyCount(), "max_stories_id": self.getMaxStoryId() }
+        self._db[self.COUNTERS_COLLECTION].update( { "_id": self.STORY_STATS_COUNTER }, { "$set": stats }, upsert=True )
+        return stats
+
+    def _storyStats(self):
+        stats = self._db[self.COUNTERS_COLLECTION].find_one( { "_id": self.STORY_STATS_COUNTER } )
+        if stats is None:
+            # a database from before the totals were kept
+            stats = self.refreshStoryStats()
+        return stats
 
     def initialize(self):
-        # nothing to init for mongo
-        return
+        if self._partition_by is not None:
+            routes = self._db[self.PARTITION_ROUTES_COLLECTION]
+            routes.create_index('stories_id', unique=True)
+            routes.create_index('partition')
 
-    def storyCount(self):
+    def storyCount(self, exact=True):
+        if not exact:
+            return self._storyStats()['count']
+        if self._partition_by is not None:
+            return self._db[self.PARTITION_ROUTES_COLLECTION].count()
         return self._db['stories'].count()
+
+class SqliteStoryDatabase(StoryDatabase):
+    '''
+    Keeps stories in a local SQLite file, so single-box jobs and tests don't need a mongod.
+    The bulky story_sentences and story_links fields get their own JSON columns, and the rest
+    of the story is stored as one JSON document.  Writes are committed in batches, so call
+    commit() (or close()) when you are done saving stories.
+    '''
+
+    JSON_COLUMNS = ['story_sentences', 'story_links']
+
+    def __init__(self, db_name=None, db_dir='.', batch_size=500):
+        super(SqliteStoryDatabase, self).__init__()
+        self._db_dir = db_dir
+        self._batch_size = batch_size
+        self._conn = None
+        self._pending_writes = 0
+        if db_name is not None:
+            self.selectDatabase(db_name)
+
+    def createDatabase(self, db_name):
+        self.selectDatabase(db_name)
+
+    def selectDatabase(self, db_name):
+        import sqlite3
+        if self._conn is not None:
+            self.close()
+        path = db_name if db_name == ':memory:' else os.path.join(self._db_dir, db_name+'.sqlite')
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self.initialize()
+
+    def deleteDatabase(self, ignored):
+        self._pending_writes = 0
+        self._conn.rollback()
+        self._conn.execute('DROP TABLE IF EXISTS stories')
+        self._conn.execute("DELETE FROM counters WHERE name = 'story_count'")
+        self._conn.commit()
+        # leave an empty table behind, like mongo does when you write to a dropped collection
+        self.initialize()
+
+    def initialize(self):
+        # stories_id has no type affinity so ids keep whatever type they were saved with (like mongo)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS stories (
+            _id INTEGER PRIMARY KEY,
+            stories_id UNIQUE NOT NULL,
+            media_id,
+            publish_date,
+            story_sentences TEXT,
+            story_links TEXT,
+            story TEXT NOT NULL,
+            change_seq INTEGER,
+            change_type TEXT
+        )''')
+        columns = [ row[1] for row in self._conn.execute('PRAGMA table_info(stories)') ]
+        if 'change_seq' not in columns:
+            # a database from before the change feed existed
+            self._conn.execute('ALTER TABLE stories ADD COLUMN change_seq INTEGER')
+            self._conn.execute('ALTER TABLE stories ADD COLUMN change_type TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS stories_media_id ON stories (media_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS stories_publish_date ON stories (publish_date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS stories_change_seq ON stories (change_seq)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        # triggers keep the story count up to date, so storyCount(exact=False) doesn't have to scan
+        self._conn.execute("INSERT OR IGNORE INTO counters (name, value) SELECT 'story_count', COUNT(*) FROM stories")
+        self._conn.execute("CREATE TRIGGER IF NOT EXISTS stories_counted AFTER INSERT ON stories "
+                           "BEGIN UPDATE counters SET value = value + 1 WHERE name = 'story_count'; END")
+        self._conn.execute("CREATE TRIGGER IF NOT EXISTS stories_uncounted AFTER DELETE ON stories "
+                           "BEGIN UPDATE counters SET value = value - 1 WHERE name = 'story_count'; END")
+        self._conn.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+        self._conn = None
+
+    def storyExists(self, story_id):
+        row = self._conn.execute('SELECT 1 FROM stories WHERE stories_id=? LIMIT 1', (story_id,)).fetchone()
+        return row is not None
+
+    def _updateStory(self, story_attributes):
+        row = self._storyToRow(story_attributes)
+        self._write('UPDATE stories SET stories_id=?, media_id=?, publish_date=?, story_sentences=?, story_links=?, story=?, change_seq=?, change_type=? WHERE stories_id=?',
+            [ row + (story_attributes['stories_id'],) ])
+
+    def _saveStory(self, story_attributes):
+        self._saveStories([story_attributes])
+
+    def _saveStories(self, stories):
+        self._write('INSERT INTO stories (stories_id, media_id, publish_date, story_sentences, story_links, story, change_seq, change_type) VALUES (?,?,?,?,?,?,?,?)',
+            [ self._storyToRow(story) for story in stories ])
+
+    def _existingStoryIds(self, story_ids):
+        existing_ids = set()
+        for i in range(0, len(story_ids), 500):    # stay under sqlite's limit on query parameters
+            chunk = story_ids[i:i+500]
+            rows = self._conn.execute('SELECT stories_id FROM stories WHERE stories_id IN ('+','.join('?'*len(chunk))+')', chunk)
+            existing_ids.update( row[0] for row in rows )
+        return existing_ids
+
+    def getStory(self, story_id, fields=None):
+        # only pull and decode the big json columns if they were asked for
+        json_columns = [ col for col in self.JSON_COLUMNS if fields is None or col in fields ]
+        row = self._conn.execute('SELECT _id, story'+''.join(', '+col for col in json_columns)+' FROM stories WHERE stories_id=? LIMIT 1',
+            (story_id,)).fetchone()
+        if row is None:
+            return None
+        return self._decodeStory( self._projectStory(self._rowToStory(row, json_columns), fields) )
+
+    def _packCompressedField(self, data):
+        # the stories are stored as json, so the compressed bytes have to be text
+        return { self.COMPRESSED_FIELD_MARKER: base64.b64encode(data) }
+
+    def _unpackCompressedField(self, value):
+        data = super(SqliteStoryDatabase, self)._unpackCompressedField(value)
+        return None if data is None else base64.b64decode(data)
+
+    def getMaxStoryId(self, exact=True):
+        # served straight from the stories_id index, so it is always exact
+        max_story_id = self._conn.execute('SELECT MAX(stories_id) FROM stories').fetchone()[0]
+        return int(max_story_id or 0)
+
+    def storyCount(self, exact=True):
+        if not exact:
+            return self._conn.execute("SELECT value FROM counters WHERE name = 'story_count'").fetchone()[0]
+        return self._conn.execute('SELECT COUNT(*) FROM stories').fetchone()[0]
+
+    def _storyBatch(self, query, fields, start_after, end_at, batch_size):
+        # the indexed columns are filtered in sql, anything else in python after decoding
+        self._checkEqualityQuery(query)
+        json_columns = [ col for col in self.JSON_COLUMNS if fields is None or col in fields ]
+        while True:
+            where = []
+            params = []
+            if start_after is not None:
+                where.append('stories_id > ?')
+                params.append(start_after)
+            if end_at is not None:
+                where.append('stories_id <= ?')
+                params.append(end_at)
+            for column in ['stories_id', 'media_id', 'publish_date']:
+                if column in query:
+                    where.append(column+' = ?')
+                    params.append(query[column])
+            sql = 'SELECT _id, story'+''.join(', '+col for col in json_columns)+' FROM stories'
+            if len(where) > 0:
+                sql += ' WHERE '+' AND '.join(where)
+            rows = self._conn.execute(sql+' ORDER BY stories_id LIMIT ?', params+[batch_size]).fetchall()
+            stories = [ self._rowToStory(row, json_columns) for row in rows ]
+            batch = [ self._decodeStory(self._projectStory(story, fields)) for story in stories
+                      if all(story.get(field) == value for field, value in query.iteritems()) ]
+            if len(batch) > 0 or len(rows) < batch_size:
+                return batch
+            # none of these rows matched, so move on to the next ones
+            start_after = stories[-1]['stories_id']
+
+    def _initializeChangeFeed(self):
+        # the change_seq column is always there
+        return
+
+    def _nextChangeSeqs(self, count):
+        # this is committed along with the stories it numbers
+        self._conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('change_seq', 0)")
+        self._conn.execute("UPDATE counters SET value = value + ? WHERE name = 'change_seq'", (count,))
+        return self._conn.execute("SELECT value FROM counters WHERE name = 'change_seq'").fetchone()[0] - count + 1
+
+    def _changeBatch(self, since, batch_size):
+        rows = self._conn.execute('SELECT change_seq, stories_id, change_type FROM stories WHERE change_seq > ? ORDER BY change_seq LIMIT ?',
+            (since, batch_size))
+        return [ { 'seq': row[0], 'stories_id': row[1], 'type': row[2] } for row in rows ]
+
+    def _numericStoryIdBounds(self):
+        bounds = self._conn.execute("SELECT MIN(stories_id), MAX(stories_id) FROM stories WHERE typeof(stories_id) IN ('integer', 'real')").fetchone()
+        return None if bounds[0] is None else bounds
+
+    def _write(self, sql, param_rows):
+        self._conn.executemany(sql, param_rows)
+        self._pending_writes += len(param_rows)
+        if self._pending_writes >= self._batch_size:
+            self.commit()
+
+    def _storyToRow(self, story_attributes):
+        story = dict(story_attributes)
+        story.pop('_id', None)
+        json_columns = tuple( json.dumps(story.pop(col)) if col in story else None for col in self.JSON_COLUMNS )
+        return (story['stories_id'], story.get('media_id'), story.get('publish_date')) + json_columns + \
+            (json.dumps(story), story.get(self.CHANGE_SEQ_FIELD), story.get(self.CHANGE_TYPE_FIELD))
+
+    def _rowToStory(self, row, json_columns):
+        story = json.loads(row[1])
+        for col, value in zip(json_columns, row[2:]):
+            if value is not None:
+                story[col] = json.loads(value)
+        story['_id'] = row[0]
+        return story
+
+class MemoryStoryDatabase(StoryDatabase):
+    '''
+    Keeps stories in a dict in this process, with secondary indexes on media_id, publish_date
+    and guid.  Useful for tests and for short jobs whose stories fit in RAM.  Use dump() and
+    load() to move the whole database to and from a file.  Stories you save and get back are only
+    shallow copies, so don't modify their nested lists or dicts in place.
+    '''
+
+    INDEXED_FIELDS = ['media_id', 'publish_date', 'guid']
+
+    def __init__(self, db_name=None):
+        super(MemoryStoryDatabase, self).__init__()
+        self._databases = {}
+        self.selectDatabase(db_name)
+
+    def createDatabase(self, db_name):
+        self.selectDatabase(db_name)
+
+    def selectDatabase(self, db_name):
+        if db_name not in self._databases:
+            self._databases[db_name] = {
+                'stories': {},
+                'indexes': { field:{} for field in self.INDEXED_FIELDS },
+                'publish_dates': [],   # sorted publish_date keys, for range queries
+                'change_seqs': [],     # sorted change sequence numbers, and the story each belongs to
+                'change_story_ids': [],
+                'next_id': 1,
+                'next_change_seq': 1,
+                'max_stories_id': None
+            }
+        self._db = self._databases[db_name]
+
+    def deleteDatabase(self, ignored):
+        self._db['stories'].clear()
+        for index in self._db['indexes'].values():
+            index.clear()
+        del self._db['publish_dates'][:]
+        del self._db['change_seqs'][:]
+        del self._db['change_story_ids'][:]
+        self._db['max_stories_id'] = None
+
+    def initialize(self):
+        # nothing to init in memory
+        return
+
+    def storyExists(self, story_id):
+        return story_id in self._db['stories']
+
+    def _updateStory(self, story_attributes):
+        old_story = self._db['stories'][story_attributes['stories_id']]
+        self._unindexStory(old_story)
+        story = dict(story_attributes)
+        story['_id'] = old_story['_id']
+        self._putStory(story)
+
+    def _saveStory(self, story_attributes):
+        story = dict(story_attributes)
+        story['_id'] = self._db['next_id']
+        self._db['next_id'] += 1
+        self._putStory(story)
+
+    def getStory(self, story_id, fields=None):
+        story = self._db['stories'].get(story_id)
+        if story is None:
+            return None
+        if fields is None:
+            return self._decodeStory(dict(story))
+        return self._decodeStory(self._projectStory(story, fields))
+
+    def getStories(self, query=None, fields=None):
+        '''
+        Return the stories whose fields equal all the values in the query dict.  Indexed fields
+        are looked up in their index, anything else is checked story by story.  Pass a list of
+        field names as fields to only get those back.
+        '''
+        query = query or {}
+        candidate_ids = None
+        for field in self.INDEXED_FIELDS:
+            if field in query:
+                ids = self._db['indexes'][field].get(query[field], set())
+                candidate_ids = ids if candidate_ids is None else candidate_ids & ids
+        if candidate_ids is None:
+            candidates = self._db['stories'].itervalues()
+        else:
+            candidates = ( self._db['stories'][story_id] for story_id in candidate_ids )
+        return [ self._decodeStory(dict(story) if fields is None else self._projectStory(story, fields)) for story in candidates
+                 if all(story.get(field) == value for field, value in query.iteritems()) ]
+
+    def getStoriesPublishedBetween(self, start_date, end_date):
+        '''
+        Return the stories with start_date <= publish_date <= end_date (compared as saved, so
+        pass dates in the same string format the stories use).
+        '''
+        publish_dates = self._db['publish_dates']
+        index = self._db['indexes']['publish_date']
+        first = bisect.bisect_left(publish_dates, start_date)
+        last = bisect.bisect_right(publish_dates, end_date)
+        return [ self._decodeStory(dict(self._db['stories'][story_id]))
+                 for publish_date in publish_dates[first:last]
+                 for story_id in index[publish_date] ]
+
+    def getMaxStoryId(self, exact=True):
+        # stories are never removed one at a time, so the biggest id ever saved is exact
+        if self._db['max_stories_id'] is None:
+            return 0
+        return int(self._db['max_stories_id'])
+
+    def storyCount(self, exact=True):
+        return len(self._db['stories'])
+
+    def scanStories(self, query=None, fields=None, batch_size=1000, start_after=None, end_at=None):
+        # the stories are already in memory, so just walk a sorted snapshot of the ids
+        query = query or {}
+        self._checkEqualityQuery(query)
+        if fields is not None and 'stories_id' not in fields:
+            fields = list(fields) + ['stories_id']
+        story_ids = sorted(self._db['stories'])
+        first = 0 if start_after is None else bisect.bisect_right(story_ids, start_after)
+        last = len(story_ids) if end_at is None else bisect.bisect_right(story_ids, end_at)
+        for story_id in story_ids[first:last]:
+            story = self._db['stories'].get(story_id)
+            if story is not None and all(story.get(field) == value for field, value in query.iteritems()):
+                yield self._decodeStory(dict(story) if fields is None else self._projectStory(story, fields))
+
+    def _numericStoryIdBounds(self):
+        story_ids = [ story_id for story_id in self._db['stories'] if isinstance(story_id, (int, long, float)) ]
+        if len(story_ids) == 0:
+            return None
+        return min(story_ids), max(story_ids)
+
+    def loadStories(self, stories):
+        '''
+        Bulk load already-prepared stories (ie. from dump()) straight into the database, replacing
+        any with the same stories_id.  This doesn't send any save events.
+        '''
+        count = 0
+        for story in stories:
+            if story['stories_id'] in self._db['stories']:
+                self._unindexStory(self._db['stories'][story['stories_id']])
+            story = dict(self._encodeStory(story))
+            story['_id'] = self._db['next_id']
+            self._db['next_id'] += 1
+            self._putStory(story)
+            count += 1
+        return count
+
+    def dump(self, path):
+        '''
+        Write all the stories to a file, one json document per line
+        '''
+        with open(path, 'w') as f:
+            for story in self._db['stories'].itervalues():
+                story = self._decodeStory(dict(story))
+                del story['_id']
+                f.write(json.dumps(story)+'\n')
+        return len(self._db['stories'])
+
+    def load(self, path):
+        '''
+        Bulk load all the stories from a file written by dump()
+        '''
+        with open(path, 'r') as f:
+            return self.loadStories( json.loads(line) for line in f if line.strip() )
+
+    def _initializeChangeFeed(self):
+        # nothing to init in memory
+        return
+
+    def _nextChangeSeqs(self, count):
+        first_seq = self._db['next_change_seq']
+        self._db['next_change_seq'] += count
+        return first_seq
+
+    def _changeBatch(self, since, batch_size):
+        change_seqs = self._db['change_seqs']
+        batch = []
+        for i in range(bisect.bisect_right(change_seqs, since), len(change_seqs)):
+            story = self._db['stories'].get(self._db['change_story_ids'][i])
+            # skip changes that were superseded by a later one
+            if story is not None and story.get(self.CHANGE_SEQ_FIELD) == change_seqs[i]:
+                batch.append(self._changeFromStory(story))
+                if len(batch) == batch_size:
+                    break
+        return batch
+
+    def _putStory(self, story):
+        story_id = story['stories_id']
+        self._db['stories'][story_id] = story
+        if self._db['max_stories_id'] is None or story_id > self._db['max_stories_id']:
+            self._db['max_stories_id'] = story_id
+        if self.CHANGE_SEQ_FIELD in story:
+            position = bisect.bisect(self._db['change_seqs'], story[self.CHANGE_SEQ_FIELD])
+            self._db['change_seqs'].insert(position, story[self.CHANGE_SEQ_FIELD])
+            self._db['change_story_ids'].insert(position, story_id)
+        for field in self.INDEXED_FIELDS:
+            if field in story:
+                ids = self._db['indexes'][field].setdefault(story[field], set())
+                if field == 'publish_date' and len(ids) == 0:
+                    bisect.insort(self._db['publish_dates'], story[field])
+                ids.add(story_id)
+
+    def _unindexStory(self, story):
+        story_id = story['stories_id']
+        for field in self.INDEXED_FIELDS:
+            if field not in story:
+                continue
+            index = self._db['indexes'][field]
+            index[story[field]].discard(story_id)
+            if len(index[story[field]]) == 0:
+                del index[story[field]]
+                if field == 'publish_date':
+                    publish_dates = self._db['publish_dates']
+                    del publish_dates[bisect.bisect_left(publish_dates, story[field])]
@@ -1,6 +1,7 @@
 
-import unittest, os, json
+import unittest, os, json, tempfile, shutil, threading
 from mediacloud.storage import *
+from mediacloud.checkpoint import FileCheckpoint
 
 class StorageTest(unittest.TestCase):
 
@@ -93,6 +94,7 @@ class StorageTest(unittest.TestCase):
         db.addStory(story1)
         db.addStory(story2)
         self.assertEquals(db.storyCount(),2)
+        self.assertEquals(db.storyCount(exact=False),2)
         db.deleteDatabase(self.TEST_DB_NAME)       
 
     def _addStoryToDb(self, db):
@@ -100,6 +102,7 @@ class StorageTest(unittest.TestCase):
         db.createDatabase(self.TEST_DB_NAME)
         worked = db.addStory(story)
         self.assertTrue(worked)
+        self.assertFalse('_stories_id' in story)    # the caller's story is left alone
         worked = db.addStory(story)
         self.assertFalse(worked)
         saved_story = db.getStory(story['stories_id'])
@@ -117,6 +120,179 @@ class StorageTest(unittest.TestCase):
         self.assertFalse(db.storyExists('43223535'))
         db.deleteDatabase(self.TEST_DB_NAME)
 
+    def _getStoryFieldsFromDb(self, db):
+        story = self._getFakeStory()
+        db.createDatabase(self.TEST_DB_NAME)
+        db.addStory(story)
+        saved_story = db.getStory(story['stories_id'], fields=['stories_id', 'title'])
+        self.assertEquals(saved_story['stories_id'], story['stories_id'])
+        self.assertEquals(saved_story['title'], story['title'])
+        self.assertTrue('_id' in saved_story)
+        self.assertFalse('story_sentences' in saved_story)
+        self.assertFalse('story_text' in saved_story)
+        saved_story = db.getStory(story['stories_id'], fields=['story_sentences'])
+        self.assertEquals(len(saved_story['story_sentences']), 4)
+        self.assertEquals(db.getStory('43223535', fields=['title']), None)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _compressStoryFieldsInDb(self, db):
+        story = self._getFakeStory()
+        codec = FieldCompressionCodec(min_size=0)
+        db.setCodec(codec)
+        db.createDatabase(self.TEST_DB_NAME)
+        db.addStory(story, {'group': 'test'})
+        self.assertTrue(codec.compressionRatio() > 1)
+        self.assertTrue(codec.stats()['story_sentences']['compressed_bytes'] > 0)
+        saved_story = db.getStory(story['stories_id'])
+        self.assertEquals(saved_story['story_sentences'], story['story_sentences'])
+        self.assertEquals(saved_story['story_text'], story['story_text'])
+        self.assertEquals(saved_story['group'], 'test')
+        # re-saving a story we read back shouldn't break the compressed fields
+        db.updateStory(saved_story, {'category': 'editorial'})
+        saved_story = db.getStory(story['stories_id'], fields=['story_sentences', 'category'])
+        self.assertEquals(saved_story['story_sentences'], story['story_sentences'])
+        self.assertEquals(saved_story['category'], 'editorial')
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _scanStoriesInDb(self, db):
+        db.createDatabase(self.TEST_DB_NAME)
+        story_ids = [101, 102, 103, 205, 307]
+        for story_id in reversed(story_ids):
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            story['media_id'] = story_id % 2
+            db.addStory(story)
+        scanned = [ s['stories_id'] for s in db.scanStories(batch_size=2) ]
+        self.assertEquals(scanned, story_ids)
+        scanned = [ s['stories_id'] for s in db.scanStories({'media_id': 1}, fields=['title'], batch_size=2) ]
+        self.assertEquals(scanned, [101, 103, 205, 307])
+        # resume after a story we already handled
+        scanned = [ s['stories_id'] for s in db.scanStories(batch_size=2, start_after=103) ]
+        self.assertEquals(scanned, [205, 307])
+        ranges = db.storyIdRanges(3)
+        self.assertEquals(len(ranges), 3)
+        scanned = []
+        for start_after, end_at in ranges:
+            scanned += [ s['stories_id'] for s in db.scanStories(batch_size=2, start_after=start_after, end_at=end_at) ]
+        self.assertEquals(scanned, story_ids)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _rejectOperatorScanOfDb(self, db):
+        # for the databases that can only scan by equality
+        db.createDatabase(self.TEST_DB_NAME)
+        db.addStory(self._getFakeStory())
+        self.assertRaises(ValueError, list, db.scanStories({'title': {'$regex': 'Kenyan'}}))
+        self.assertRaises(ValueError, list, db.scanStories({'$or': [{'media_id': 1}, {'media_id': 2}]}))
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _addStoriesToDb(self, db):
+        db.createDatabase(self.TEST_DB_NAME)
+        stories = []
+        for story_id in [101, 102, 103]:
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            stories.append(story)
+        db.addStory(stories[0])
+        self.assertEquals(db.existingStoryIds([101, 102, 103]), set([101]))
+        self.assertEquals(db.addStories(stories, {'group': 'test'}), 2)
+        self.assertEquals(db.storyCount(), 3)
+        saved_story = db.getStory(103)
+        self.assertEquals(saved_story['group'], 'test')
+        self.assertEquals(saved_story['story_sentences_count'], 4)
+        self.assertFalse('group' in db.getStory(101))
+        self.assertEquals(db.addStories(stories), 0)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _sendSaveEventsFromDb(self, db):
+        from pubsub import pub
+        events = []
+        def onPostSave(db_story, raw_story):
+            events.append( ('post', db_story['stories_id']) )
+        def onStoriesSaved(db_stories, raw_stories):
+            events.append( ('batch', len(db_stories)) )
+        pub.subscribe(onPostSave, StoryDatabase.EVENT_POST_STORY_SAVE)
+        pub.subscribe(onStoriesSaved, StoryDatabase.EVENT_STORIES_SAVED)
+        try:
+            db.createDatabase(self.TEST_DB_NAME)
+            story = self._getFakeStory()
+            db.addStory(story)
+            self.assertEquals(events, [('post', story['stories_id'])])
+            # now deliver them on the background thread
+            db.setAsyncEvents()
+            story['stories_id'] = 101
+            other_story = self._getFakeStory()
+            other_story['stories_id'] = 102
+            db.addStories([story, other_story])
+            db.flushEvents()
+            self.assertEquals(events[1:], [('post', 101), ('post', 102), ('batch', 2)])
+            db.setAsyncEvents(False)
+            db.deleteDatabase(self.TEST_DB_NAME)
+        finally:
+            pub.unsubscribe(onPostSave, StoryDatabase.EVENT_POST_STORY_SAVE)
+            pub.unsubscribe(onStoriesSaved, StoryDatabase.EVENT_STORIES_SAVED)
+
+    def _snapshotDb(self, db):
+        db.createDatabase(self.TEST_DB_NAME)
+        for story_id in range(1, 26):
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            db.addStory(story)
+        snapshot_file = tempfile.NamedTemporaryFile(delete=False)
+        snapshot_file.close()
+        try:
+            index = db.exportSnapshot(snapshot_file.name, chunk_size=10)
+            self.assertEquals(index['story_count'], 25)
+            self.assertEquals([ (c['first_stories_id'], c['last_stories_id']) for c in index['chunks'] ], [(1, 10), (11, 20), (21, 25)])
+            restored_db = MemoryStoryDatabase(self.TEST_DB_NAME)
+            self.assertEquals(restored_db.importSnapshot(snapshot_file.name, workers=2), 25)
+            self.assertEquals(restored_db.getMaxStoryId(), 25)
+            self.assertEquals(restored_db.getStory(7)['story_sentences'], self._getFakeStory()['story_sentences'])
+            # restoring again doesn't duplicate anything
+            self.assertEquals(restored_db.importSnapshot(snapshot_file.name), 0)
+            partial_db = MemoryStoryDatabase(self.TEST_DB_NAME)
+            self.assertEquals(partial_db.importSnapshot(snapshot_file.name, start_after=8, end_at=12), 4)
+            # a failed save stops the workers instead of leaving them blocked
+            failing_db = MemoryStoryDatabase(self.TEST_DB_NAME)
+            def fail(stories):
+                raise ValueError('disk full')
+            failing_db.addStories = fail
+            thread_count = threading.active_count()
+            self.assertRaises(ValueError, failing_db.importSnapshot, snapshot_file.name, workers=1)
+            self.assertEquals(threading.active_count(), thread_count)
+        finally:
+            os.remove(snapshot_file.name)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def _followChangeFeedOfDb(self, db):
+        db.createDatabase(self.TEST_DB_NAME)
+        db.setChangeFeed()
+        stories = []
+        for story_id in [101, 102, 103]:
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            stories.append(story)
+        db.addStory(stories[0])
+        db.addStories(stories[1:])
+        changes = list(db.changes())
+        self.assertEquals([ (c['stories_id'], c['type']) for c in changes ], [(101, 'insert'), (102, 'insert'), (103, 'insert')])
+        db.updateStory(stories[0], {'category': 'editorial'})
+        changes = list(db.changes(since=changes[-1]['seq']))
+        self.assertEquals([ (c['stories_id'], c['type']) for c in changes ], [(101, 'update')])
+        # a consumer only sees what changed since its last checkpoint
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            checkpoint = FileCheckpoint(os.path.join(checkpoint_dir, 'feed.json'))
+            handled = []
+            self.assertEquals(db.consumeChanges(checkpoint, handled.extend, batch_size=2), 3)
+            self.assertEquals(sorted(c['stories_id'] for c in handled), [101, 102, 103])
+            self.assertEquals(db.consumeChanges(checkpoint, handled.extend), 0)
+            db.updateStory(stories[2], {'category': 'news'})
+            self.assertEquals(db.consumeChanges(FileCheckpoint(os.path.join(checkpoint_dir, 'feed.json')), handled.extend), 1)
+            self.assertEquals(handled[-1]['stories_id'], 103)
+        finally:
+            shutil.rmtree(checkpoint_dir)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
     def _testMaxStoryIdInDb(self, db):
         story1 = self._getFakeStory()
         story1['stories_id'] = "10000000000"
@@ -127,8 +303,24 @@ class StorageTest(unittest.TestCase):
         db.addStory(story1)
         db.addStory(story2)
         self.assertEquals(db.getMaxStoryId(),20000000000)
+        self.assertEquals(db.getMaxStoryId(exact=False),20000000000)
         db.deleteDatabase(self.TEST_DB_NAME)           
 
+    def _keepStoryStatsOfDb(self, db):
+        db.createDatabase(self.TEST_DB_NAME)
+        db.deleteDatabase(self.TEST_DB_NAME)
+        self.assertEquals(db.storyCount(exact=False), 0)
+        self.assertEquals(db.getMaxStoryId(exact=False), 0)
+        story = self._getFakeStory()
+        db.addStory(story)
+        db.addStories([ dict(story, stories_id=story_id) for story_id in range(100, 110) ])
+        db.updateStory(story, {'category': 'news'})
+        self.assertEquals(db.storyCount(exact=False), 11)
+        self.assertEquals(db.storyCount(exact=False), db.storyCount())
+        self.assertEquals(db.getMaxStoryId(exact=False), story['stories_id'])
+        db.deleteDatabase(self.TEST_DB_NAME)
+        self.assertEquals(db.storyCount(exact=False), 0)
+
     def _getFakeStory(self):
         my_file = open(os.path.dirname(os.path.realpath(__file__))+'/fixtures/story_27456565.json', 'r')
         return json.loads( my_file.read() )
@@ -147,6 +339,30 @@ class MongoStorageTest(StorageTest):
         db = MongoStoryDatabase()
         self._testMaxStoryIdInDb(db)
 
+    def testGetStoryFields(self):
+        db = MongoStoryDatabase()
+        self._getStoryFieldsFromDb(db)
+
+    def testCompressStoryFields(self):
+        db = MongoStoryDatabase()
+        self._compressStoryFieldsInDb(db)
+
+    def testScanStories(self):
+        db = MongoStoryDatabase()
+        self._scanStoriesInDb(db)
+
+    def testAddStories(self):
+        db = MongoStoryDatabase()
+        self._addStoriesToDb(db)
+
+    def testSnapshot(self):
+        db = MongoStoryDatabase()
+        self._snapshotDb(db)
+
+    def testChangeFeed(self):
+        db = MongoStoryDatabase()
+        self._followChangeFeedOfDb(db)
+
     def testStoryExists(self):
         db = MongoStoryDatabase()
         self._checkStoryExistsInDb(db)
@@ -163,6 +379,59 @@ class MongoStorageTest(StorageTest):
         db = MongoStoryDatabase()
         self._countStoriesInDb(db)
 
+    def testStoryStats(self):
+        self._keepStoryStatsOfDb(MongoStoryDatabase())
+
+    def testChangeFeedWithConcurrentWriters(self):
+        writer = MongoStoryDatabase(self.TEST_DB_NAME)
+        other_writer = MongoStoryDatabase(self.TEST_DB_NAME)
+        writer.setChangeFeed()
+        other_writer.setChangeFeed()
+        stories = []
+        for story_id in [101, 102, 103]:
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            stories.append(story)
+        writer.addStory(stories[0])
+        since = writer._settledChangeSeq()
+        # the writer has its number for 102 but hasn't saved it yet when 103 goes in
+        story_to_save = writer._prepareNewStory(stories[1], {})
+        writer._stampChanges([story_to_save], 'insert')
+        other_writer.addStory(stories[2])
+        self.assertEquals([ c['stories_id'] for c in writer.changes(since=since - 1) ], [101])
+        writer._saveStory(writer._encodeStory(story_to_save))
+        writer._releaseChangeSeqs()
+        self.assertEquals([ c['stories_id'] for c in writer.changes(since=since - 1) ], [101, 102, 103])
+        # a writer that dies with a number reserved only holds the feed back for a while
+        writer._nextChangeSeqs(1)
+        other_writer.addStory(dict(stories[0], stories_id=104))
+        self.assertEquals(len(list(writer.changes(since=since))), 2)
+        writer.CHANGE_RESERVATION_TIMEOUT = 0
+        self.assertEquals([ c['stories_id'] for c in writer.changes(since=since) ], [102, 103, 104])
+        writer._releaseChangeSeqs()
+        writer.CHANGE_RESERVATION_TIMEOUT = MongoStoryDatabase.CHANGE_RESERVATION_TIMEOUT
+        # a save that fails gives its number back straight away
+        def fail(story):
+            raise ValueError('cannot encode')
+        writer._encodeStory = fail
+        self.assertRaises(ValueError, writer.addStory, dict(stories[0], stories_id=105))
+        other_writer.addStory(dict(stories[0], stories_id=106))
+        self.assertEquals([ c['stories_id'] for c in writer.changes(since=since) ], [102, 103, 104, 106])
+        writer.deleteDatabase(self.TEST_DB_NAME)
+
+    def testStoryStatsOfExistingDatabase(self):
+        db = MongoStoryDatabase()
+        db.createDatabase(self.TEST_DB_NAME)
+        db.deleteDatabase(self.TEST_DB_NAME)
+        # stories saved before the totals were kept
+        story = self._getFakeStory()
+        db._db[db.STORIES_COLLECTION].insert([ dict(story, stories_id=story_id) for story_id in range(100, 120) ])
+        db = MongoStoryDatabase(self.TEST_DB_NAME)
+        db.addStory(story)
+        self.assertEquals(db.storyCount(exact=False), 21)
+        self.assertEquals(db.getMaxStoryId(exact=False), story['stories_id'])
+        db.deleteDatabase(self.TEST_DB_NAME)
+
     def testAddStoryFromSentencesWithAttributes(self):
         db = MongoStoryDatabase()
         self._addStoryFromSentencesToDbWithAttributes(db)
@@ -175,3 +444,277 @@ class MongoStorageTest(StorageTest):
         db = MongoStoryDatabase()
         self._updateStoryFromSentencesToDb(db)
 
+
+class MongoPartitionedStorageTest(StorageTest):
+
+    def _db(self, partition_by=MongoStoryDatabase.PARTITION_BY_MONTH):
+        return MongoStoryDatabase(partition_by=partition_by)
+
+    def testGetMaxStoryId(self):
+        self._testMaxStoryIdInDb(self._db())
+
+    def testScanStories(self):
+        self._scanStoriesInDb(self._db())
+
+    def testAddStories(self):
+        self._addStoriesToDb(self._db())
+
+    def testChangeFeed(self):
+        self._followChangeFeedOfDb(self._db())
+
+    def testStoryExists(self):
+        self._checkStoryExistsInDb(self._db())
+
+    def testAddStory(self):
+        self._addStoryToDb(self._db())
+
+    def testUpdateStory(self):
+        self._updateStoryInDb(self._db())
+
+    def testStoryCount(self):
+        self._countStoriesInDb(self._db(MongoStoryDatabase.PARTITION_BY_MEDIA))
+
+    def testStoryStats(self):
+        self._keepStoryStatsOfDb(self._db())
+
+    def testUpdateStoryFromSentences(self):
+        self._updateStoryFromSentencesToDb(self._db())
+
+    def testPartialUpdateKeepsPartition(self):
+        db = self._db()
+        db.createDatabase(self.TEST_DB_NAME)
+        db.deleteDatabase(self.TEST_DB_NAME)
+        story_sentences = self._getFakeStorySentences(1)['207593389']
+        db.addStoryFromSentences(story_sentences)
+        # the update only has the new sentences, no publish_date
+        db.addStoryFromSentences(self._getFakeStorySentences(2)['207593389'])
+        self.assertEquals(db.partitionNames(), ['stories_2014_03'])
+        self.assertTrue(db.storyExists(story_sentences[0]['stories_id']))
+        # an update with a publish_date still moves it
+        db.updateStory({'stories_id': story_sentences[0]['stories_id'], 'publish_date': '2014-04-02 00:00:00'})
+        db.dropPartitionsBefore('2014-04-01')
+        self.assertTrue(db.storyExists(story_sentences[0]['stories_id']))
+        self.assertEquals(db.dropPartitionsBefore('2014-05-01'), ['stories_2014_04'])
+        self.assertFalse(db.storyExists(story_sentences[0]['stories_id']))
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def testDropOldPartitions(self):
+        db = self._db()
+        db.createDatabase(self.TEST_DB_NAME)
+        old_story = self._getFakeStory()
+        new_story = self._getFakeStory()
+        new_story['stories_id'] = 27456566
+        new_story['publish_date'] = '2015-01-02 10:00:00'
+        db.addStory(old_story)
+        db.addStory(new_story)
+        self.assertEquals(db.partitionNames(), ['stories_2010_11', 'stories_2015_01'])
+        self.assertEquals(len(list(db.findStories({'publish_date': {'$gte': '2015-01-01'}}))), 1)
+        self.assertEquals(len(list(db.findStories({'media_id': old_story['media_id']}))), 2)
+        self.assertEquals(db.dropPartitionsBefore('2015-01-01'), ['stories_2010_11'])
+        self.assertFalse(db.storyExists(old_story['stories_id']))
+        self.assertTrue(db.storyExists(new_story['stories_id']))
+        self.assertEquals(db.storyCount(), 1)
+        self.assertEquals(db.storyCount(exact=False), 1)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+    def testMediaPartitions(self):
+        db = self._db(MongoStoryDatabase.PARTITION_BY_MEDIA)
+        db.createDatabase(self.TEST_DB_NAME)
+        story = self._getFakeStory()
+        db.addStory(story)
+        self.assertEquals(db.partitionNames(), ['stories_media_%d' % (story['media_id'] % 16)])
+        self.assertEquals(db.getStory(story['stories_id'])['title'], story['title'])
+        self.assertEquals(len(list(db.findStories({'media_id': story['media_id']}))), 1)
+        self.assertEquals(len(list(db.findStories({'media_id': story['media_id']+1}))), 0)
+        db.deleteDatabase(self.TEST_DB_NAME)
+
+class SqliteStorageTest(StorageTest):
+
+    def setUp(self):
+        self._db_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._db_dir)
+
+    def _db(self):
+        return SqliteStoryDatabase(db_dir=self._db_dir)
+
+    def testManageDatabsae(self):
+        self._createThenDeleteDb(self._db())
+
+    def testGetMaxStoryId(self):
+        self._testMaxStoryIdInDb(self._db())
+
+    def testGetStoryFields(self):
+        self._getStoryFieldsFromDb(self._db())
+
+    def testCompressStoryFields(self):
+        self._compressStoryFieldsInDb(self._db())
+
+    def testScanStories(self):
+        self._scanStoriesInDb(self._db())
+
+    def testScanStoriesWithOperators(self):
+        self._rejectOperatorScanOfDb(self._db())
+
+    def testAddStories(self):
+        self._addStoriesToDb(self._db())
+
+    def testSaveEvents(self):
+        self._sendSaveEventsFromDb(self._db())
+
+    def testSnapshot(self):
+        self._snapshotDb(self._db())
+
+    def testChangeFeed(self):
+        self._followChangeFeedOfDb(self._db())
+
+    def testStoryExists(self):
+        self._checkStoryExistsInDb(self._db())
+
+    def testAddStory(self):
+        self._addStoryToDb(self._db())
+
+    def testUpdateStory(self):
+        self._updateStoryInDb(self._db())
+
+    def testStoryCount(self):
+        self._countStoriesInDb(self._db())
+
+    def testStoryStats(self):
+        self._keepStoryStatsOfDb(self._db())
+
+    def testAddStoryFromSentencesWithAttributes(self):
+        self._addStoryFromSentencesToDbWithAttributes(self._db())
+
+    def testAddStoryFromSentences(self):
+        self._addStoryFromSentencesToDb(self._db())
+
+    def testUpdateStoryFromSentences(self):
+        self._updateStoryFromSentencesToDb(self._db())
+
+    def testParallelScan(self):
+        db = self._db()
+        db.createDatabase(self.TEST_DB_NAME)
+        for story_id in range(1, 51):
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            db.addStory(story)
+        db.commit()
+        def make_db():
+            other_db = self._db()
+            other_db.selectDatabase(self.TEST_DB_NAME)
+            return other_db
+        scanned = []
+        self.assertEquals(parallelScan(make_db, lambda s: scanned.append(s['stories_id']), parts=4, batch_size=7), 50)
+        self.assertEquals(sorted(scanned), range(1, 51))
+
+    def testImportSnapshot(self):
+        source_db = MemoryStoryDatabase(self.TEST_DB_NAME)
+        for story_id in range(1, 26):
+            story = self._getFakeStory()
+            story['stories_id'] = story_id
+            source_db.addStory(story)
+        snapshot_path = os.path.join(self._db_dir, 'snapshot')
+        source_db.exportSnapshot(snapshot_path, chunk_size=4)
+        db = self._db()
+        db.createDatabase(self.TEST_DB_NAME)
+        self.assertEquals(db.importSnapshot(snapshot_path, workers=3), 25)
+        self.assertEquals(db.storyCount(), 25)
+        self.assertEquals(db.getStory(25)['title'], story['title'])
+
+    def testSurvivesReopen(self):
+        db = self._db()
+        db.createDatabase(self.TEST_DB_NAME)
+        story = self._getFakeStory()
+        db.addStory(story)
+        db.close()
+        db = self._db()
+        db.selectDatabase(self.TEST_DB_NAME)
+        self.assertEquals(db.storyCount(), 1)
+        self.assertEquals(db.getStory(story['stories_id'])['story_sentences'], story['story_sentences'])
+
+class MemoryStorageTest(StorageTest):
+
+    def testManageDatabsae(self):
+        self._createThenDeleteDb(MemoryStoryDatabase())
+
+    def testGetMaxStoryId(self):
+        self._testMaxStoryIdInDb(MemoryStoryDatabase())
+
+    def testGetStoryFields(self):
+        self._getStoryFieldsFromDb(MemoryStoryDatabase())
+
+    def testCompressStoryFields(self):
+        self._compressStoryFieldsInDb(MemoryStoryDatabase())
+
+    def testScanStories(self):
+        self._scanStoriesInDb(MemoryStoryDatabase())
+
+    def testScanStoriesWithOperators(self):
+        self._rejectOperatorScanOfDb(MemoryStoryDatabase())
+
+    def testAddStories(self):
+        self._addStoriesToDb(MemoryStoryDatabase())
+
+    def testSaveEvents(self):
+        self._sendSaveEventsFromDb(MemoryStoryDatabase())
+
+    def testSnapshot(self):
+        self._snapshotDb(MemoryStoryDatabase())
+
+    def testChangeFeed(self):
+        self._followChangeFeedOfDb(MemoryStoryDatabase())
+
+    def testStoryExists(self):
+        self._checkStoryExistsInDb(MemoryStoryDatabase())
+
+    def testAddStory(self):
+        self._addStoryToDb(MemoryStoryDatabase())
+
+    def testUpdateStory(self):
+        self._updateStoryInDb(MemoryStoryDatabase())
+
+    def testStoryCount(self):
+        self._countStoriesInDb(MemoryStoryDatabase())
+
+    def testStoryStats(self):
+        self._keepStoryStatsOfDb(MemoryStoryDatabase())
+
+    def testAddStoryFromSentencesWithAttributes(self):
+        self._addStoryFromSentencesToDbWithAttributes(MemoryStoryDatabase())
+
+    def testAddStoryFromSentences(self):
+        self._addStoryFromSentencesToDb(MemoryStoryDatabase())
+
+    def testUpdateStoryFromSentences(self):
+        self._updateStoryFromSentencesToDb(MemoryStoryDatabase())
+
+    def testIndexes(self):
+        db = MemoryStoryDatabase(self.TEST_DB_NAME)
+        story = self._getFakeStory()
+        db.addStory(story)
+        self.assertEquals(len(db.getStories({'media_id': story['media_id']})), 1)
+        self.assertEquals(len(db.getStories({'guid': story['guid'], 'language': 'en'})), 1)
+        self.assertEquals(len(db.getStories({'media_id': -1})), 0)
+        self.assertEquals(len(db.getStoriesPublishedBetween('2010-11-24', '2010-11-25')), 1)
+        self.assertEquals(len(db.getStoriesPublishedBetween('2010-11-25', '2010-11-26')), 0)
+        db.updateStory(story, {'media_id': 12})
+        self.assertEquals(len(db.getStories({'media_id': story['media_id']})), 0)
+        self.assertEquals(len(db.getStories({'media_id': 12})), 1)
+
+    def testDumpAndLoad(self):
+        db = MemoryStoryDatabase(self.TEST_DB_NAME)
+        story = self._getFakeStory()
+        db.addStory(story)
+        dump_file = tempfile.NamedTemporaryFile(delete=False)
+        dump_file.close()
+        try:
+            self.assertEquals(db.dump(dump_file.name), 1)
+            other_db = MemoryStoryDatabase(self.TEST_DB_NAME)
+            self.assertEquals(other_db.load(dump_file.name), 1)
+        finally:
+            os.remove(dump_file.name)
+        self.assertTrue(other_db.storyExists(story['stories_id']))
+        self.assertEquals(other_db.getStory(story['stories_id'])['story_sentences_count'], 4)
+        self.assertEquals(len(other_db.getStories({'media_id': story['media_id']})), 1)